@@ -280,7 +280,7 @@ export default function ListenerChatsPage() {
           setMessages(prev => prev.map(msg => 
             msg.id === data.message_id ? { ...msg, is_delivered: true } : msg
           ));
-        } else if (data.type === 'message_read') {
+        } else if (data.type === 'message_read' || data.type === 'messages_read') {
           // Update existing message to read status
           const messageIds = data.message_ids || [data.message_id];
           console.log('📖 Received read receipt for messages:', messageIds);
@@ -45,6 +45,7 @@ export const API_CONFIG = {
     NOTIFICATIONS: "/api/notifications/",
     NOTIFICATION_DETAIL: "/api/notifications/",
     NOTIFICATION_MARK_ALL_READ: "/api/notifications/mark-all-read/",
+    NOTIFICATION_MARK_READ: "/api/notifications/mark-read/",
     NOTIFICATION_STATS: "/api/notifications/stats/",
     NOTIFICATION_SETTINGS: "/api/notifications/settings/",
     CREATE_MESSAGE_NOTIFICATION: "/api/notifications/create-message/",
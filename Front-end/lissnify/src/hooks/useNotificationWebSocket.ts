@@ -12,6 +12,7 @@ export interface Notification {
   updated_at: string;
   chat_room_id?: number;
   message_id?: number;
+  message_count?: number | null;
   sender_username: string;
   recipient_username: string;
 }
@@ -129,6 +130,21 @@ export const useNotificationWebSocket = (onNotificationReceived?: () => void) =>
     }
   };
 
+  // Mark many at once: any of notification_ids, up_to_id, before (ISO timestamp) and room_id
+  const markManyAsRead = (scope: {
+    notification_ids?: number[];
+    up_to_id?: number;
+    before?: string;
+    room_id?: number;
+  }) => {
+    if (socket && isConnected) {
+      socket.send(JSON.stringify({
+        type: 'mark_read',
+        ...scope
+      }));
+    }
+  };
+
   const getUnreadCount = () => {
     if (socket && isConnected) {
       socket.send(JSON.stringify({
@@ -164,6 +180,7 @@ export const useNotificationWebSocket = (onNotificationReceived?: () => void) =>
     unreadCount,
     newNotification,
     markAsRead,
+    markManyAsRead,
     getUnreadCount,
     connect,
     disconnect,
@@ -12,6 +12,7 @@ export interface Notification {
   updated_at: string;
   chat_room_id?: number;
   message_id?: number;
+  message_count?: number | null;
   sender_username: string;
   recipient_username: string;
 }
@@ -26,6 +27,7 @@ export interface NotificationStats {
 
 export interface NotificationSettings {
   message_notifications: boolean;
+  coalesce_message_notifications: boolean;
   connection_notifications: boolean;
   system_notifications: boolean;
   email_notifications: boolean;
@@ -213,14 +213,32 @@ export const startDirectChat = async (listener_id: string): Promise<ApiResponse>
   });
 }
 
-export const getMessages = async (room_id: number): Promise<ApiResponse> => {
-  return apiCall(`/chat/${room_id}/messages/`, {
+export interface MessagePageCursor {
+  before?: number;
+  after?: number;
+  limit?: number;
+}
+
+// History is paginated by message id: `next` loads older messages (pass it as
+// `before`), `prev` loads newer ones (pass it as `after`).
+export const getMessages = async (room_id: number, cursor: MessagePageCursor = {}): Promise<ApiResponse & { next?: number | null; prev?: number | null }> => {
+  const params = new URLSearchParams();
+  Object.entries(cursor).forEach(([key, value]) => {
+    if (value !== undefined) params.append(key, String(value));
+  });
+  const query = params.toString() ? `?${params.toString()}` : '';
+
+  const response = await apiCall<any>(`/chat/${room_id}/messages/${query}`, {
     method: 'GET',
     headers: {
       'Authorization': `Bearer ${localStorage.getItem('adminToken') || ''}`,
       'Content-Type': 'application/json',
     },  
   });
+  if (!response.success || !response.data) {
+    return response;
+  }
+  return { ...response, data: response.data.results, next: response.data.next, prev: response.data.prev };
 }
 
 export const acceptConnection = async (connectionId: number, action: 'accept' | 'reject'): Promise<ApiResponse> => {
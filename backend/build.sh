@@ -8,8 +8,9 @@ pip install -r requirements.txt
 # Collect static files
 python manage.py collectstatic --noinput
 
-# Run database migrations
-python manage.py migrate
+# Run database migrations. --fake-initial adopts api tables created before
+# the app had migrations of its own
+python manage.py migrate --fake-initial
 
 # Create superuser if it doesn't exist (optional)
 # python manage.py shell -c "from django.contrib.auth import get_user_model; User = get_user_model(); User.objects.filter(username='admin').exists() or User.objects.create_superuser('admin', 'admin@example.com', 'admin')"
@@ -63,7 +63,8 @@ fi
 
 # Run database migrations
 echo "Running database migrations..."
-python manage.py migrate --noinput
+# --fake-initial adopts api tables created before the app had migrations of its own
+python manage.py migrate --noinput --fake-initial
 
 # Collect static files
 echo "Collecting static files..."
@@ -208,6 +208,33 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Chat write-behind mode: each worker buffers outgoing messages and persists
+# them with one bulk insert every CHAT_WRITE_BEHIND_FLUSH_MS milliseconds or
+# CHAT_WRITE_BEHIND_BATCH_SIZE messages, whichever comes first.
+CHAT_WRITE_BEHIND = config('CHAT_WRITE_BEHIND', default=False, cast=bool)
+CHAT_WRITE_BEHIND_FLUSH_MS = config('CHAT_WRITE_BEHIND_FLUSH_MS', default=50, cast=int)
+CHAT_WRITE_BEHIND_BATCH_SIZE = config('CHAT_WRITE_BEHIND_BATCH_SIZE', default=200, cast=int)
+
+# Per-connection outbound queues (chat_api/outbound.py): how many frames may
+# wait in this process for a socket's flush task before read receipts,
+# typing and presence frames are shed. Frames already handed to the server
+# aren't counted, so this doesn't detect clients that stop reading.
+CHAT_OUTBOUND_MAX_QUEUE = config('CHAT_OUTBOUND_MAX_QUEUE', default=500, cast=int)
+
+# Notification retention (`manage.py prune_notifications`): days to keep read
+# and unread notifications, with per-type overrides written as
+# "type:days,type:days" (e.g. "message:14,system:90"). 0 keeps forever.
+NOTIFICATION_RETENTION_READ_DAYS = config('NOTIFICATION_RETENTION_READ_DAYS', default=30, cast=int)
+NOTIFICATION_RETENTION_UNREAD_DAYS = config('NOTIFICATION_RETENTION_UNREAD_DAYS', default=180, cast=int)
+NOTIFICATION_RETENTION_READ_OVERRIDES = config(
+    'NOTIFICATION_RETENTION_READ_OVERRIDES', default='',
+    cast=lambda v: {t.strip(): int(d) for t, d in (item.split(':') for item in v.split(',') if item.strip())},
+)
+NOTIFICATION_RETENTION_UNREAD_OVERRIDES = config(
+    'NOTIFICATION_RETENTION_UNREAD_OVERRIDES', default='',
+    cast=lambda v: {t.strip(): int(d) for t, d in (item.split(':') for item in v.split(',') if item.strip())},
+)
+
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = config('EMAIL_HOST', default='smtp.gmail.com')
 EMAIL_PORT = config('EMAIL_PORT', default=587, cast=int)
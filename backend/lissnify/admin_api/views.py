@@ -74,7 +74,7 @@ class DashboardStatsView(APIView):
 
         # --- Chat Stats ---
         total_chat_rooms = ChatRoom.objects.count()
-        one_to_one_chats = ChatRoom.objects.filter(type='one_to_one').count()
+        one_to_one_chats = ChatRoom.objects.filter(type='one-to-one').count()
         community_chats = ChatRoom.objects.filter(type='community').count()
 
         # --- Daily User Growth (Last 7 Days) ---
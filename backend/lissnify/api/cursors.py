@@ -0,0 +1,22 @@
+# api/cursors.py
+"""
+Keyset pagination cursors shared by the notification list and the chat inbox.
+A cursor is the (timestamp, id) of the last row on a page, written as whole
+microseconds since the epoch and the id, e.g. "1718000000123456:42".
+"""
+from datetime import datetime, timedelta, timezone
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def encode_cursor(at, row_id):
+    # Whole microseconds, so the cursor round-trips exactly
+    return f"{(at - EPOCH) // MICROSECOND}:{row_id}"
+
+
+def decode_cursor(cursor):
+    """(timestamp, id) from a cursor; ValueError if it is malformed"""
+    micros, _, row_id = cursor.partition(':')
+    return EPOCH + int(micros) * MICROSECOND, int(row_id)
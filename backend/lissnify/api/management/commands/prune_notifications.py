@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from api.retention import prune_notifications
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete notifications past their retention (NOTIFICATION_RETENTION_* settings) "
+        "in small batches, and report the rows and bytes reclaimed. Safe to run from cron "
+        "while the site is live."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows deleted per transaction")
+        parser.add_argument('--sleep-ms', type=int, default=0, help="Pause between batches")
+        parser.add_argument('--max-batches', type=int, default=None, help="Stop after this many batches")
+        parser.add_argument('--dry-run', action='store_true', help="Only count what would be deleted")
+
+    def handle(self, *args, **options):
+        report = prune_notifications(
+            batch_size=options['batch_size'],
+            pause=options['sleep_ms'] / 1000,
+            max_batches=options['max_batches'],
+            dry_run=options['dry_run'],
+        )
+
+        verb = 'would delete' if options['dry_run'] else 'deleted'
+        total_rows = total_bytes = 0
+        for notification_type, is_read, days, rows, reclaimed in report:
+            state = 'read' if is_read else 'unread'
+            size = f", {reclaimed} bytes" if reclaimed is not None else ''
+            self.stdout.write(f"{notification_type:<20} {state:<6} older than {days}d: {verb} {rows} rows{size}")
+            total_rows += rows
+            total_bytes += reclaimed or 0
+
+        measured = any(reclaimed is not None for *_, reclaimed in report)
+        size = f", {total_bytes} bytes" if measured else ''
+        self.stdout.write(self.style.SUCCESS(f"Total: {verb} {total_rows} rows{size}"))
@@ -0,0 +1,254 @@
+# Generated by Django 5.2.6 on 2026-10-18 13:26
+
+import django.contrib.auth.models
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('Category_name', models.CharField(max_length=255)),
+                ('description', models.TextField(default='No description')),
+                ('slug', models.SlugField(blank=True, max_length=255, null=True, unique=True)),
+                ('icon', models.CharField(blank=True, max_length=255, null=True)),
+                ('meta_title', models.CharField(blank=True, max_length=255, null=True)),
+                ('meta_description', models.TextField(blank=True, null=True)),
+                ('supportText', models.TextField(blank=True, default='No Support text')),
+            ],
+            options={
+                'db_table': 'category',
+            },
+        ),
+        migrations.CreateModel(
+            name='Testimonial',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('role', models.CharField(blank=True, max_length=100, null=True)),
+                ('feedback', models.TextField()),
+                ('rating', models.PositiveIntegerField(default=5)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'testimonial',
+            },
+        ),
+        migrations.CreateModel(
+            name='User',
+            fields=[
+                ('last_login', models.DateTimeField(blank=True, null=True, verbose_name='last login')),
+                ('first_name', models.CharField(blank=True, max_length=150, verbose_name='first name')),
+                ('last_name', models.CharField(blank=True, max_length=150, verbose_name='last name')),
+                ('is_active', models.BooleanField(default=True, help_text='Designates whether this user should be treated as active. Unselect this instead of deleting accounts.', verbose_name='active')),
+                ('date_joined', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date joined')),
+                ('u_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('full_name', models.CharField(max_length=255, unique=True)),
+                ('email', models.EmailField(max_length=255, unique=True)),
+                ('password', models.CharField(max_length=255)),
+                ('token', models.CharField(blank=True, max_length=255, null=True)),
+                ('otp', models.CharField(blank=True, max_length=6, null=True)),
+                ('otp_verified', models.BooleanField(default=False)),
+                ('status', models.BooleanField(default=False)),
+                ('user_type', models.CharField(blank=True, max_length=255, null=True)),
+                ('user_status', models.CharField(blank=True, default='active', max_length=255)),
+                ('temp_preferences', models.JSONField(blank=True, default=list)),
+                ('DOB', models.DateField(blank=True, null=True)),
+                ('is_superuser', models.BooleanField(default=False)),
+                ('is_staff', models.BooleanField(default=False)),
+                ('profile_image', models.CharField(blank=True, max_length=255, null=True)),
+                ('groups', models.ManyToManyField(blank=True, help_text='The groups this user belongs to. A user will get all permissions granted to each of their groups.', related_name='user_set', related_query_name='user', to='auth.group', verbose_name='groups')),
+                ('user_permissions', models.ManyToManyField(blank=True, help_text='Specific permissions for this user.', related_name='user_set', related_query_name='user', to='auth.permission', verbose_name='user permissions')),
+            ],
+            options={
+                'db_table': 'user',
+            },
+            managers=[
+                ('objects', django.contrib.auth.models.UserManager()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Blog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=255)),
+                ('slug', models.SlugField(blank=True, null=True, unique=True)),
+                ('image', models.ImageField(blank=True, null=True, upload_to='blogs/')),
+                ('description', models.TextField()),
+                ('date', models.DateTimeField(auto_now_add=True)),
+                ('meta_title', models.CharField(blank=True, max_length=255, null=True)),
+                ('meta_description', models.TextField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='blogs', to=settings.AUTH_USER_MODEL)),
+                ('category', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='blogs', to='api.category')),
+            ],
+            options={
+                'db_table': 'blog',
+            },
+        ),
+        migrations.CreateModel(
+            name='CommunityPost',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('post_type', models.CharField(choices=[('listener', 'Listener'), ('seeker', 'Seeker')], max_length=20)),
+                ('title', models.CharField(max_length=255)),
+                ('content', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('is_verified', models.BooleanField(default=False)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='community_posts', to=settings.AUTH_USER_MODEL)),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='community_posts', to='api.category')),
+            ],
+            options={
+                'db_table': 'community_post',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='CommunityPostComment',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('content', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='community_post_comments', to=settings.AUTH_USER_MODEL)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='comments', to='api.communitypost')),
+            ],
+            options={
+                'db_table': 'community_post_comment',
+                'ordering': ['created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Listener',
+            fields=[
+                ('description', models.TextField(default='No description')),
+                ('l_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('language', models.CharField(blank=True, default='English', max_length=50)),
+                ('rating', models.DecimalField(decimal_places=2, default=0.0, max_digits=3)),
+                ('preferences', models.ManyToManyField(to='api.category')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'listener',
+            },
+        ),
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('notification_type', models.CharField(choices=[('message', 'Message'), ('connection_request', 'Connection Request'), ('connection_accepted', 'Connection Accepted'), ('connection_rejected', 'Connection Rejected'), ('system', 'System')], default='message', max_length=50)),
+                ('title', models.CharField(max_length=255)),
+                ('message', models.TextField()),
+                ('is_read', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('chat_room_id', models.IntegerField(blank=True, null=True)),
+                ('message_id', models.IntegerField(blank=True, null=True)),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='sent_notifications', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'notification',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='NotificationSettings',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_notifications', models.BooleanField(default=True)),
+                ('connection_notifications', models.BooleanField(default=True)),
+                ('system_notifications', models.BooleanField(default=True)),
+                ('email_notifications', models.BooleanField(default=True)),
+                ('push_notifications', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='notification_settings', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'notification_settings',
+            },
+        ),
+        migrations.CreateModel(
+            name='Seeker',
+            fields=[
+                ('s_id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('preferences', models.ManyToManyField(to='api.category')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'seeker',
+            },
+        ),
+        migrations.CreateModel(
+            name='BlogLike',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('blog', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='likes', to='api.blog')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='blog_likes', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'blog_like',
+                'unique_together': {('user', 'blog')},
+            },
+        ),
+        migrations.CreateModel(
+            name='CommunityPostLike',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='likes', to='api.communitypost')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='community_post_likes', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'community_post_like',
+                'unique_together': {('user', 'post')},
+            },
+        ),
+        migrations.CreateModel(
+            name='Rating',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('rating', models.PositiveIntegerField(choices=[(1, 1), (2, 2), (3, 3), (4, 4), (5, 5)], help_text='Rating from 1 to 5 stars')),
+                ('feedback', models.TextField(help_text='Detailed feedback from seeker', max_length=500)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('listener', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ratings_received', to='api.listener')),
+                ('seeker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ratings_given', to='api.seeker')),
+            ],
+            options={
+                'db_table': 'rating',
+                'ordering': ['-created_at'],
+                'unique_together': {('seeker', 'listener')},
+            },
+        ),
+        migrations.CreateModel(
+            name='Connections',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('pending', models.BooleanField(default=True)),
+                ('accepted', models.BooleanField(default=False)),
+                ('rejected', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('listener', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='connections', to='api.listener')),
+                ('seeker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='connections', to='api.seeker')),
+            ],
+            options={
+                'db_table': 'connections',
+                'unique_together': {('seeker', 'listener')},
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-18 13:30
+
+from django.db import migrations, models
+
+
+def flag_existing_digests(apps, schema_editor):
+    """Digests used to be told apart only as sender-less message notifications for a room"""
+    Notification = apps.get_model('api', 'Notification')
+    Notification.objects.filter(
+        notification_type='message', sender__isnull=True, chat_room_id__isnull=False, message_count__isnull=True,
+    ).update(is_digest=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_notification_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='is_digest',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('is_digest', True)), fields=['chat_room_id', 'recipient'], name='notif_digest_room_idx'),
+        ),
+        migrations.RunPython(flag_existing_digests, migrations.RunPython.noop),
+    ]
@@ -151,6 +151,7 @@ class Notification(models.Model):
         ('connection_request', 'Connection Request'),
         ('connection_accepted', 'Connection Accepted'),
         ('connection_rejected', 'Connection Rejected'),
+        ('rating', 'Rating'),
         ('system', 'System'),
     ]
     
@@ -167,10 +168,39 @@ class Notification(models.Model):
     # Optional fields for message notifications
     chat_room_id = models.IntegerField(null=True, blank=True)
     message_id = models.IntegerField(null=True, blank=True)
+    # Set on coalesced message notifications: how many messages the row stands for
+    message_count = models.PositiveIntegerField(null=True, blank=True)
+    # Set on community digests (chat_api.digest): one per member and room
+    is_digest = models.BooleanField(default=False)
     
     class Meta:
         db_table = 'notification'
         ordering = ['-created_at']
+        # One per filter combination NotificationListView supports, each
+        # ending in its (created_at, id) keyset order
+        indexes = [
+            models.Index(fields=['recipient', 'created_at', 'id'], name='notif_recipient_created_idx'),
+            models.Index(fields=['recipient', 'is_read', 'created_at', 'id'], name='notif_read_created_idx'),
+            models.Index(fields=['recipient', 'notification_type', 'created_at', 'id'], name='notif_type_created_idx'),
+            models.Index(
+                fields=['recipient', 'notification_type', 'is_read', 'created_at', 'id'],
+                name='notif_type_read_created_idx',
+            ),
+            # Retention pruning walks expired rows of each type and read state
+            models.Index(fields=['notification_type', 'is_read', 'created_at'], name='notif_retention_idx'),
+            # Digest refreshes look up a room's digests by member
+            models.Index(
+                fields=['chat_room_id', 'recipient'], condition=models.Q(is_digest=True), name='notif_digest_room_idx',
+            ),
+        ]
+        constraints = [
+            # At most one unread coalesced notification per conversation
+            models.UniqueConstraint(
+                fields=['recipient', 'chat_room_id'],
+                condition=models.Q(is_read=False, message_count__isnull=False),
+                name='notif_one_live_per_room',
+            ),
+        ]
     
     def __str__(self):
         return f"{self.recipient.full_name} - {self.title}"
@@ -178,6 +208,8 @@ class Notification(models.Model):
 class NotificationSettings(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='notification_settings')
     message_notifications = models.BooleanField(default=True)
+    # One updating notification per conversation instead of one per message
+    coalesce_message_notifications = models.BooleanField(default=True)
     connection_notifications = models.BooleanField(default=True)
     system_notifications = models.BooleanField(default=True)
     email_notifications = models.BooleanField(default=True)
@@ -0,0 +1,229 @@
+# api/notification_counts.py
+"""
+Per-user notification counters: total, unread and one per notification type.
+
+NotificationStatsView, NotificationListView's `total`, the notification
+socket's unread count and pushed `unread_count` frames all read them from
+here. Counters are adjusted as notifications are created, marked read or
+unread and deleted; a user without counters is rebuilt from the database
+with one conditional aggregate, and counters expire after COUNTER_TTL,
+which also bounds any drift from an adjustment racing a rebuild.
+"""
+import threading
+import traceback
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, Q
+
+from chat_api.cache import get_redis
+from .models import Notification
+
+COUNTER_TTL = 60 * 60
+
+NOTIFICATION_TYPES = [notification_type for notification_type, _ in Notification.NOTIFICATION_TYPES]
+FIELDS = ['total', 'unread'] + [f'type_{notification_type}' for notification_type in NOTIFICATION_TYPES]
+
+
+class MemoryNotificationCounter:
+    """In-process stand-in used when the channel layer isn't Redis (tests, local dev)"""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, user_ids):
+        with self._lock:
+            return {user_id: dict(self._counts[user_id]) if user_id in self._counts else None for user_id in user_ids}
+
+    def set_many(self, counts_by_user):
+        with self._lock:
+            for user_id, counts in counts_by_user.items():
+                self._counts[user_id] = dict(counts)
+
+    def add(self, deltas_by_user):
+        with self._lock:
+            for user_id, deltas in deltas_by_user.items():
+                counts = self._counts.get(user_id)
+                if counts is None:
+                    continue
+                for field, delta in deltas.items():
+                    counts[field] = max(counts.get(field, 0) + delta, 0)
+
+    def delete(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._counts.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+class RedisNotificationCounter:
+    """One hash per user, `notifications:counts:<user_id>`, holding FIELDS"""
+
+    # Only adjust users that already have counters; a miss is rebuilt from the DB
+    ADD_SCRIPT = """
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            for i = 1, #ARGV, 2 do
+                if redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1]) < 0 then
+                    redis.call('HSET', KEYS[1], ARGV[i], 0)
+                end
+            end
+        end
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._add = client.register_script(self.ADD_SCRIPT)
+
+    @staticmethod
+    def key(user_id):
+        return f"notifications:counts:{user_id}"
+
+    def get_many(self, user_ids):
+        user_ids = list(user_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hgetall(self.key(user_id))
+        return {
+            user_id: {field: int(value) for field, value in counts.items()} if counts else None
+            for user_id, counts in zip(user_ids, pipe.execute())
+        }
+
+    def set_many(self, counts_by_user):
+        if not counts_by_user:
+            return
+        pipe = self.client.pipeline()
+        for user_id, counts in counts_by_user.items():
+            pipe.delete(self.key(user_id))
+            pipe.hset(self.key(user_id), mapping=counts)
+            pipe.expire(self.key(user_id), COUNTER_TTL)
+        pipe.execute()
+
+    def delete(self, user_ids):
+        keys = [self.key(user_id) for user_id in user_ids]
+        if keys:
+            self.client.delete(*keys)
+
+    def add(self, deltas_by_user):
+        for user_id, deltas in deltas_by_user.items():
+            args = [item for field, delta in deltas.items() for item in (field, delta)]
+            if args:
+                self._add(keys=[self.key(user_id)], args=args)
+
+
+_counter = None
+
+
+def get_notification_counter():
+    global _counter
+    if _counter is None:
+        client = get_redis()
+        _counter = RedisNotificationCounter(client) if client is not None else MemoryNotificationCounter()
+    return _counter
+
+
+def count_expressions():
+    """Conditional counts for every field, for one aggregate over a user's notifications"""
+    expressions = {
+        'total': Count('id'),
+        'unread': Count('id', filter=Q(is_read=False)),
+    }
+    for notification_type in NOTIFICATION_TYPES:
+        expressions[f'type_{notification_type}'] = Count('id', filter=Q(notification_type=notification_type))
+    return expressions
+
+
+def get_notification_counts_many(user_ids):
+    """{user_id: counts} from the counter service; misses are rebuilt with one grouped query"""
+    user_ids = list(user_ids)
+    counter = get_notification_counter()
+    try:
+        counts = counter.get_many(user_ids)
+    except Exception:
+        traceback.print_exc()
+        counts = {user_id: None for user_id in user_ids}
+
+    missing = [user_id for user_id, user_counts in counts.items() if user_counts is None]
+    if missing:
+        rebuilt = {user_id: dict.fromkeys(FIELDS, 0) for user_id in missing}
+        rows = (
+            Notification.objects.filter(recipient_id__in=missing)
+            .values('recipient_id')
+            .annotate(**count_expressions())
+        )
+        for row in rows:
+            rebuilt[row.pop('recipient_id')] = row
+        try:
+            counter.set_many(rebuilt)
+        except Exception:
+            traceback.print_exc()
+        counts.update(rebuilt)
+    return {user_id: {field: user_counts.get(field, 0) for field in FIELDS} for user_id, user_counts in counts.items()}
+
+
+def get_notification_counts(user):
+    """{total, unread, type_<type>...} for `user`"""
+    return get_notification_counts_many([user.u_id])[user.u_id]
+
+
+def _adjust(deltas_by_user):
+    """Apply counter deltas once the surrounding transaction commits"""
+    deltas_by_user = {user_id: deltas for user_id, deltas in deltas_by_user.items() if any(deltas.values())}
+    if not deltas_by_user:
+        return
+
+    def apply():
+        try:
+            get_notification_counter().add(deltas_by_user)
+        except Exception:
+            traceback.print_exc()
+
+    transaction.on_commit(apply)
+
+
+def count_created(notifications):
+    deltas = defaultdict(lambda: defaultdict(int))
+    for notification in notifications:
+        user_deltas = deltas[notification.recipient_id]
+        user_deltas['total'] += 1
+        user_deltas[f'type_{notification.notification_type}'] += 1
+        if not notification.is_read:
+            user_deltas['unread'] += 1
+    _adjust(deltas)
+
+
+def count_marked_read(user_id, count):
+    """`count` of `user_id`'s notifications went from unread to read"""
+    _adjust({user_id: {'unread': -count}})
+
+
+def count_marked_unread(user_id, count):
+    """`count` of `user_id`'s notifications went from read back to unread"""
+    _adjust({user_id: {'unread': count}})
+
+
+def count_deleted(notification):
+    _adjust({notification.recipient_id: {
+        'total': -1,
+        f'type_{notification.notification_type}': -1,
+        'unread': 0 if notification.is_read else -1,
+    }})
+
+
+def invalidate_notification_counts(user_ids):
+    """Drop counters for `user_ids` after changes too broad to adjust; the next read rebuilds them"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+
+    def drop():
+        try:
+            get_notification_counter().delete(user_ids)
+        except Exception:
+            traceback.print_exc()
+
+    drop()
+    transaction.on_commit(drop)
@@ -0,0 +1,399 @@
+# api/notifications.py
+import asyncio
+import logging
+import os
+import threading
+from collections import defaultdict
+
+from asgiref.sync import SyncToAsync, async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Notification, NotificationSettings
+from .notification_counts import count_created, count_deleted, count_marked_read, get_notification_counts_many
+from .serializers import NotificationSerializer
+
+logger = logging.getLogger(__name__)
+
+# NotificationSettings switch that gates each notification type
+SETTING_FOR_TYPE = {
+    'message': 'message_notifications',
+    'connection_request': 'connection_notifications',
+    'connection_accepted': 'connection_notifications',
+    'connection_rejected': 'connection_notifications',
+    'rating': 'system_notifications',
+    'system': 'system_notifications',
+}
+
+
+def message_notification_text(message, count=1):
+    """Title and body used for a chat message notification standing for `count` messages"""
+    if count > 1:
+        title = f'{count} new messages, latest from {message.author.full_name}'
+    else:
+        title = f'New message from {message.author.full_name}'
+    body = f'{message.content[:100]}{"..." if len(message.content) > 100 else ""}'
+    return title, body
+
+
+def create_message_notifications(message, recipient_ids):
+    """
+    Fan a chat message out to `recipient_ids` as 'message' notifications.
+    Returns the created Notification rows.
+    """
+    return fan_out_message_notifications([(message, recipient_ids)])
+
+
+def fan_out_message_notifications(deliveries):
+    """
+    Create 'message' notifications for a batch of (message, recipient_ids).
+
+    Settings for every recipient are read in one query and missing settings
+    are created in bulk with their defaults. Recipients who coalesce get
+    their conversation's live notification replaced (see
+    coalesce_message_notifications); the rest get one row per message, all
+    written with a single bulk_create. Returns the created Notification rows.
+    """
+    deliveries = [(message, list(recipient_ids)) for message, recipient_ids in deliveries]
+    all_recipients = {user_id for _, recipient_ids in deliveries for user_id in recipient_ids}
+    if not all_recipients:
+        return []
+
+    modes = {
+        user_id: (enabled, coalesce)
+        for user_id, enabled, coalesce in NotificationSettings.objects.filter(user_id__in=all_recipients)
+        .values_list('user_id', 'message_notifications', 'coalesce_message_notifications')
+    }
+    missing = [user_id for user_id in all_recipients if user_id not in modes]
+    if missing:
+        NotificationSettings.objects.bulk_create(
+            [NotificationSettings(user_id=user_id) for user_id in missing],
+            ignore_conflicts=True,
+        )
+        defaults = NotificationSettings()
+        modes.update({
+            user_id: (defaults.message_notifications, defaults.coalesce_message_notifications) for user_id in missing
+        })
+
+    notifications = []
+    coalesced = {}
+    for message, recipient_ids in deliveries:
+        title, body = message_notification_text(message)
+        for user_id in recipient_ids:
+            enabled, coalesce = modes[user_id]
+            if not enabled:
+                continue
+            if coalesce:
+                coalesced.setdefault((user_id, message.room_id), []).append(message)
+                continue
+            notifications.append(_message_notification(user_id, message, title, body))
+    notifications = Notification.objects.bulk_create(notifications)
+    created, replaced = coalesce_message_notifications(coalesced)
+    push_notifications(notifications + created, removed=replaced)
+    return notifications + created
+
+
+def _message_notification(user_id, message, title, body):
+    return Notification(
+        recipient_id=user_id,
+        sender_id=message.author_id,
+        notification_type='message',
+        title=title,
+        message=body,
+        chat_room_id=message.room_id,
+        message_id=message.id,
+    )
+
+
+# Rounds of fold-then-insert before giving up on a conversation whose live
+# notification keeps being created concurrently
+COALESCE_ATTEMPTS = 3
+
+
+def coalesce_message_notifications(pending):
+    """
+    Fold {(recipient id, room id): [messages, oldest first]} into each
+    conversation's live notification: the recipient's unread coalesced
+    'message' notification for that room, which carries the message count and
+    the latest message's preview. An existing live row is deleted and
+    re-inserted with the new count, so its created_at (the list's sort and
+    cursor key) is the latest message's and the conversation rises to the top.
+    A unique constraint keeps it to one live row per conversation, so an
+    insert that loses a race is retried as a fold. Conversations still
+    contended after COALESCE_ATTEMPTS rounds get one plain notification per
+    message instead. Returns (created notifications, replaced notifications).
+    """
+    pending = dict(pending)
+    created, replaced = [], []
+    if not pending:
+        return created, replaced
+
+    with transaction.atomic():
+        for _ in range(COALESCE_ATTEMPTS):
+            live, folded = [], []
+            for notification in _live_message_notifications(pending, lock=True):
+                messages = pending.pop((notification.recipient_id, notification.chat_room_id))
+                live.append(notification)
+                folded.append(_folded(
+                    notification.recipient_id, notification.chat_room_id,
+                    notification.message_count + len(messages), messages[-1],
+                ))
+            if live:
+                # The locks held on the old rows keep concurrent folds of the
+                # same conversations waiting until this commits
+                Notification.objects.filter(id__in=[notification.id for notification in live]).delete()
+                for notification in live:
+                    count_deleted(notification)
+                created.extend(Notification.objects.bulk_create(folded))
+                replaced.extend(live)
+            if not pending:
+                break
+
+            fresh = [
+                _folded(user_id, room_id, len(messages), messages[-1])
+                for (user_id, room_id), messages in pending.items()
+            ]
+            Notification.objects.bulk_create(fresh, ignore_conflicts=True)
+
+            # ignore_conflicts leaves ids unset: read back the rows this insert won
+            for notification in _live_message_notifications(pending):
+                key = (notification.recipient_id, notification.chat_room_id)
+                messages = pending[key]
+                if notification.message_id == messages[-1].id and notification.message_count == len(messages):
+                    del pending[key]
+                    created.append(notification)
+            if not pending:
+                break
+
+        if pending:
+            logger.warning(
+                "Gave up coalescing message notifications for %s, creating one per message", sorted(pending),
+            )
+            created.extend(Notification.objects.bulk_create([
+                _message_notification(user_id, message, *message_notification_text(message))
+                for (user_id, _), messages in pending.items()
+                for message in messages
+            ]))
+    return created, replaced
+
+
+def _folded(user_id, room_id, count, message):
+    """A live coalesced notification standing for `count` messages, `message` the latest"""
+    title, body = message_notification_text(message, count)
+    return Notification(
+        recipient_id=user_id,
+        sender_id=message.author_id,
+        notification_type='message',
+        title=title,
+        message=body,
+        chat_room_id=room_id,
+        message_id=message.id,
+        message_count=count,
+    )
+
+
+def _live_message_notifications(pending, lock=False):
+    """Live coalesced notifications for the (recipient id, room id) keys of `pending`"""
+    notifications = Notification.objects.filter(
+        recipient_id__in={user_id for user_id, _ in pending},
+        chat_room_id__in={room_id for _, room_id in pending},
+        notification_type='message',
+        is_read=False,
+        message_count__isnull=False,
+    ).order_by()
+    if lock:
+        notifications = notifications.select_for_update()
+    # The two IN lists also match other pairings of the same users and rooms
+    return [
+        notification for notification in notifications
+        if (notification.recipient_id, notification.chat_room_id) in pending
+    ]
+
+
+def create_notification(recipient, notification_type, title, message, sender=None, **fields):
+    """
+    Create one notification if `recipient` has that kind switched on, and push
+    it to their sockets. Returns the Notification, or None if it was switched off.
+    """
+    settings, _ = NotificationSettings.objects.get_or_create(user=recipient)
+    if not getattr(settings, SETTING_FOR_TYPE.get(notification_type, 'system_notifications')):
+        return None
+
+    notification = Notification.objects.create(
+        recipient=recipient, sender=sender, notification_type=notification_type, title=title, message=message, **fields,
+    )
+    push_notifications([notification])
+    return notification
+
+
+# Largest `notification_ids` list one mark-read request may carry
+MAX_MARK_READ_IDS = 1000
+
+
+def mark_read_filter(scope):
+    """
+    Q for the notifications a mark-read request covers. `scope` may hold any
+    of `notification_ids` (a list), `up_to_id` (ids at or below it),
+    `before` (an ISO timestamp; created at or before it) and `room_id` (a
+    chat room's message notifications); given together they all apply.
+    Raises ValueError if none is given or one is malformed.
+    """
+    q = Q()
+    if scope.get('notification_ids') is not None:
+        ids = scope['notification_ids']
+        if not isinstance(ids, list) or len(ids) > MAX_MARK_READ_IDS:
+            raise ValueError(f"'notification_ids' must be a list of at most {MAX_MARK_READ_IDS} ids")
+        q &= Q(id__in=[int(notification_id) for notification_id in ids])
+    if scope.get('up_to_id') is not None:
+        q &= Q(id__lte=int(scope['up_to_id']))
+    if scope.get('before') is not None:
+        before = parse_datetime(str(scope['before']))
+        if before is None:
+            raise ValueError("'before' must be an ISO 8601 timestamp")
+        if timezone.is_naive(before):
+            before = timezone.make_aware(before)
+        q &= Q(created_at__lte=before)
+    if scope.get('room_id') is not None:
+        q &= Q(chat_room_id=int(scope['room_id']))
+    if not q:
+        raise ValueError("Give at least one of 'notification_ids', 'up_to_id', 'before' or 'room_id'")
+    return q
+
+
+def mark_notifications_read(user, scope):
+    """
+    Mark `user`'s unread notifications in `scope` (see mark_read_filter) as
+    read with a single UPDATE. Returns how many changed.
+    """
+    updated = Notification.objects.filter(mark_read_filter(scope), recipient=user, is_read=False).update(
+        is_read=True, updated_at=timezone.now(),
+    )
+    count_marked_read(user.u_id, updated)
+    return updated
+
+
+def push_notifications(notifications, updated=(), removed=()):
+    """
+    Count newly created `notifications` and queue them, along with `updated`
+    ones (digests changed in place), for their recipients'
+    `notifications_<u_id>` groups once the surrounding transaction commits.
+    `removed` are deleted notifications that newly created ones replace
+    (folded coalesced notifications); recipients are told their ids. See
+    NotificationDispatcher for how queued pushes are sent.
+    """
+    notifications = [notification for notification in notifications if notification.id is not None]
+    if not notifications and not updated and not removed:
+        return
+    # Registered first, so the pushed unread counts already include these
+    count_created(notifications)
+    ids = [notification.id for notification in [*notifications, *updated]]
+    removed = [(notification.recipient_id, notification.id) for notification in removed]
+    transaction.on_commit(lambda: _dispatcher.enqueue(ids, removed))
+
+
+def notification_events(ids, removed=()):
+    """
+    {recipient id: `notification_batch` event} for the notifications `ids`
+    and the removed (recipient id, notification id) pairs, each carrying the
+    recipient's current unread count.
+    """
+    by_recipient = defaultdict(list)
+    for notification in Notification.objects.filter(id__in=set(ids)).select_related('sender', 'recipient').order_by('id'):
+        by_recipient[notification.recipient_id].append(notification)
+    removed_ids = defaultdict(list)
+    for recipient_id, notification_id in removed:
+        removed_ids[recipient_id].append(notification_id)
+        by_recipient.setdefault(recipient_id, [])
+    counts = get_notification_counts_many(by_recipient)
+    return {
+        recipient_id: {
+            "type": "notification_batch",
+            "notifications": NotificationSerializer(batch, many=True).data,
+            "removed_ids": removed_ids.get(recipient_id, []),
+            "unread_count": counts[recipient_id]['unread'],
+        }
+        for recipient_id, batch in by_recipient.items()
+    }
+
+
+def _main_event_loop():
+    """The running event loop this thread was called from through sync_to_async, if any"""
+    if getattr(SyncToAsync.threadlocal, 'main_event_loop_pid', None) != os.getpid():
+        return None
+    loop = getattr(SyncToAsync.threadlocal, 'main_event_loop', None)
+    return loop if loop is not None and loop.is_running() else None
+
+
+class NotificationDispatcher:
+    """
+    Per-process queue of pushes from committed transactions.
+
+    Commits append to it from whichever thread they ran in and return at
+    once. The first commit after a drain schedules the next one on the event
+    loop, so everything committed until the loop gets round to it (one tick)
+    goes out together: one database hop to load it and one group_send per
+    recipient, made from the event loop rather than the committing thread.
+    With no event loop behind the thread (management commands, cron) the
+    queue is drained on the spot.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = []
+        self._removed = []
+        self._scheduled = False
+        self._drains = set()
+
+    def enqueue(self, ids, removed=()):
+        loop = _main_event_loop()
+        with self._lock:
+            self._ids.extend(ids)
+            self._removed.extend(removed)
+            schedule = loop is not None and not self._scheduled
+            if schedule:
+                self._scheduled = True
+        if loop is None:
+            async_to_sync(self.drain)()
+        elif schedule:
+            loop.call_soon_threadsafe(self._start_drain)
+
+    def _start_drain(self):
+        task = asyncio.ensure_future(self.drain())
+        self._drains.add(task)
+        task.add_done_callback(self._drains.discard)
+
+    def _take(self):
+        with self._lock:
+            ids, removed = self._ids, self._removed
+            self._ids, self._removed = [], []
+            self._scheduled = False
+        return ids, removed
+
+    async def drain(self):
+        """Send everything queued so far: one `notification_batch` event per recipient"""
+        ids, removed = self._take()
+        if not ids and not removed:
+            return
+        try:
+            events = await database_sync_to_async(notification_events)(ids, removed)
+            channel_layer = get_channel_layer()
+            for recipient_id, event in events.items():
+                await channel_layer.group_send(f'notifications_{recipient_id}', event)
+        except Exception:
+            logger.exception("Failed to push notifications %s", sorted(set(ids)))
+
+    async def join(self):
+        """Wait, on the event loop drains run on, until everything queued has been sent"""
+        while self._scheduled or self._drains:
+            if self._drains:
+                await asyncio.gather(*self._drains)
+            else:
+                # Scheduled but not started: give the loop a turn
+                await asyncio.sleep(0)
+
+
+_dispatcher = NotificationDispatcher()
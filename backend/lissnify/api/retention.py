@@ -0,0 +1,107 @@
+# api/retention.py
+"""
+Notification retention: how long notifications are kept, by type and read
+state, and the batched pruning behind `manage.py prune_notifications`.
+
+Each batch is its own short transaction that picks the oldest expired rows
+through the (notification_type, is_read, created_at) index, skipping any row
+another transaction has locked, and deletes them by primary key. A batch
+never holds locks for longer than one bounded DELETE, so the job can run
+alongside normal traffic, or alongside another run of itself. Community
+digests are kept: there is one per member and room, and deleting one would
+bring it back as a new notification. A live coalesced message notification
+is re-inserted for every message it folds in, so its created_at is its
+latest activity and a busy conversation's row never looks expired.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from .models import Notification
+from .notification_counts import NOTIFICATION_TYPES, invalidate_notification_counts
+
+DIGESTS = Q(is_digest=True)
+
+
+def retention_policy():
+    """[(notification type, is_read, days to keep)] for every type and read state; 0 days keeps forever"""
+    policy = []
+    for notification_type in NOTIFICATION_TYPES:
+        for is_read, default, overrides in (
+            (True, settings.NOTIFICATION_RETENTION_READ_DAYS, settings.NOTIFICATION_RETENTION_READ_OVERRIDES),
+            (False, settings.NOTIFICATION_RETENTION_UNREAD_DAYS, settings.NOTIFICATION_RETENTION_UNREAD_OVERRIDES),
+        ):
+            policy.append((notification_type, is_read, overrides.get(notification_type, default)))
+    return policy
+
+
+def expired_notifications(notification_type, is_read, days, now=None):
+    cutoff = (now or timezone.now()) - timedelta(days=days)
+    return (
+        Notification.objects.filter(notification_type=notification_type, is_read=is_read, created_at__lt=cutoff)
+        .exclude(DIGESTS)
+        .order_by('created_at', 'id')
+    )
+
+
+def _row_bytes():
+    """On-disk size of each row where the database can tell us, else None"""
+    if connection.vendor == 'postgresql':
+        return RawSQL(f'pg_column_size({Notification._meta.db_table}.*)', [])
+    return None
+
+
+def prune_batch(notifications, batch_size):
+    """Delete up to `batch_size` rows of `notifications` in one transaction; returns (rows, bytes)"""
+    row_bytes = _row_bytes()
+    if row_bytes is not None:
+        notifications = notifications.annotate(row_bytes=row_bytes)
+    fields = ['id', 'recipient_id'] + (['row_bytes'] if row_bytes is not None else [])
+
+    with transaction.atomic():
+        rows = list(notifications.select_for_update(skip_locked=True).values_list(*fields)[:batch_size])
+        if rows:
+            Notification.objects.filter(id__in=[row[0] for row in rows]).delete()
+            invalidate_notification_counts({row[1] for row in rows})
+    reclaimed = sum(row[2] or 0 for row in rows) if row_bytes is not None else None
+    return len(rows), reclaimed
+
+
+def prune_notifications(batch_size=1000, pause=0.0, max_batches=None, dry_run=False, now=None):
+    """
+    Delete every notification past its retention, `batch_size` rows at a
+    time, sleeping `pause` seconds between batches and stopping after
+    `max_batches` if given. With `dry_run`, only counts what would go.
+
+    Returns [(notification type, is_read, days, rows, bytes)] for each
+    policy entry; bytes is None where the database can't measure row size.
+    """
+    now = now or timezone.now()
+    measured = _row_bytes() is not None
+    report = []
+    batches = 0
+    for notification_type, is_read, days in retention_policy():
+        if not days:
+            continue
+        notifications = expired_notifications(notification_type, is_read, days, now)
+        if dry_run:
+            report.append((notification_type, is_read, days, notifications.count(), None))
+            continue
+
+        rows = reclaimed = 0
+        while max_batches is None or batches < max_batches:
+            deleted, deleted_bytes = prune_batch(notifications, batch_size)
+            batches += 1
+            rows += deleted
+            reclaimed += deleted_bytes or 0
+            if deleted < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+        report.append((notification_type, is_read, days, rows, reclaimed if measured else None))
+    return report
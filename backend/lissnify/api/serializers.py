@@ -199,10 +199,10 @@ class NotificationSerializer(serializers.ModelSerializer):
         model = Notification
         fields = [
             'id', 'recipient', 'sender', 'notification_type', 'title', 'message',
-            'is_read', 'created_at', 'updated_at', 'chat_room_id', 'message_id',
+            'is_read', 'created_at', 'updated_at', 'chat_room_id', 'message_id', 'message_count', 'is_digest',
             'sender_full_name', 'recipient_full_name'
         ]
-        read_only_fields = ['id', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'created_at', 'updated_at', 'is_digest']
 
 class NotificationCreateSerializer(serializers.ModelSerializer):
     class Meta:
@@ -221,7 +221,7 @@ class NotificationSettingsSerializer(serializers.ModelSerializer):
     class Meta:
         model = NotificationSettings
         fields = [
-            'message_notifications', 'connection_notifications', 
+            'message_notifications', 'coalesce_message_notifications', 'connection_notifications', 
             'system_notifications', 'email_notifications', 'push_notifications'
         ]
 
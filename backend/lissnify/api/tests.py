@@ -1,3 +1,288 @@
-from django.test import TestCase
+import asyncio
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from rest_framework.test import APIClient
+
+from api.models import Notification, NotificationSettings, User
+from api.notification_counts import invalidate_notification_counts
+from api.notifications import _dispatcher, create_notification, fan_out_message_notifications
+from chat_api.models import ChatRoom, Message
+from chat_api.testing import ChatTestCase
+
+
+class NotificationPushTests(ChatTestCase):
+    """Notifications created in one commit reach each recipient as one event"""
+
+    def test_one_event_per_recipient_per_commit(self):
+        author = User.objects.create(full_name='Author', email='author@example.com')
+        recipient = User.objects.create(full_name='Recipient', email='recipient@example.com')
+        NotificationSettings.objects.create(user=recipient, coalesce_message_notifications=False)
+        room = ChatRoom.objects.create()
+        messages = [Message.objects.create(room=room, author=author, content=f'hi {i}') for i in range(2)]
+
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        with mock.patch('api.notifications.get_channel_layer', return_value=channel_layer), \
+                self.captureOnCommitCallbacks(execute=True):
+            fan_out_message_notifications([(message, [recipient.u_id]) for message in messages])
+
+        channel_layer.group_send.assert_called_once()
+        group, event = channel_layer.group_send.call_args.args
+        self.assertEqual(group, f'notifications_{recipient.u_id}')
+        self.assertEqual([n['message'] for n in event['notifications']], ['hi 0', 'hi 1'])
+        self.assertEqual(event['unread_count'], 2)
+
+    def test_commits_in_one_tick_share_an_event(self):
+        recipient = User.objects.create(full_name='Recipient', email='recipient@example.com')
+        commits = []
+        for title in ('first', 'second'):
+            with self.captureOnCommitCallbacks() as callbacks:
+                create_notification(recipient, 'system', title, '')
+            commits.append(callbacks)
+
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            with mock.patch('api.notifications._main_event_loop', return_value=loop):
+                # Both commit from the loop's thread, so no drain can run in between
+                for callbacks in commits:
+                    for callback in callbacks:
+                        callback()
+            await _dispatcher.join()
+
+        with mock.patch('api.notifications.get_channel_layer', return_value=channel_layer):
+            async_to_sync(run)()
+
+        channel_layer.group_send.assert_called_once()
+        _, event = channel_layer.group_send.call_args.args
+        self.assertEqual([n['title'] for n in event['notifications']], ['first', 'second'])
+        self.assertEqual(event['unread_count'], 2)
+
+
+class NotificationCoalescingTests(ChatTestCase):
+    """Message notifications collapse into one live row per conversation"""
+
+    def test_one_live_row_per_conversation(self):
+        author = User.objects.create(full_name='Author', email='author@example.com')
+        recipient = User.objects.create(full_name='Recipient', email='recipient@example.com')
+        room = ChatRoom.objects.create()
+
+        def send(content):
+            message = Message.objects.create(room=room, author=author, content=content)
+            with self.captureOnCommitCallbacks(execute=True):
+                return fan_out_message_notifications([(message, [recipient.u_id])])
+
+        first = send('one')
+        with self.captureOnCommitCallbacks(execute=True):
+            create_notification(recipient, 'system', 'Since', 'Body')
+        send('two')
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        with mock.patch('api.notifications.get_channel_layer', return_value=channel_layer):
+            live = send('three')
+        live = Notification.objects.get(recipient=recipient, notification_type='message')
+        self.assertEqual((live.title, live.message, live.message_count), ('3 new messages, latest from Author', 'three', 3))
+        self.assertNotEqual(live.id, first[0].id)
+
+        # Each fold re-inserts the row: the conversation is back on top of the
+        # list, and sockets are told which id it replaced
+        client = APIClient()
+        client.force_authenticate(recipient)
+        listed = client.get('/api/notifications/', {'include_total': 'false'}).json()['notifications']
+        self.assertEqual([n['title'] for n in listed], [live.title, 'Since'])
+        _, event = channel_layer.group_send.call_args.args
+        self.assertEqual([n['id'] for n in event['notifications']], [live.id])
+        self.assertEqual(len(event['removed_ids']), 1)
+        self.assertEqual(event['unread_count'], 2)
+
+        Notification.objects.filter(id=live.id).update(is_read=True)
+        send('four')
+        self.assertEqual(
+            Notification.objects.filter(recipient=recipient, notification_type='message', is_read=False).get().message_count, 1,
+        )
+        self.assertEqual(Notification.objects.filter(recipient=recipient, notification_type='message').count(), 2)
+
+        response = client.patch(f'/api/notifications/{live.id}/', {'is_read': False}, format='json')
+        self.assertEqual(response.status_code, 409)
+
+    def test_contended_conversations_fall_back_to_one_row_per_message(self):
+        author = User.objects.create(full_name='Author', email='author@example.com')
+        recipient = User.objects.create(full_name='Recipient', email='recipient@example.com')
+        room = ChatRoom.objects.create()
+        messages = [Message.objects.create(room=room, author=author, content=f'm{i}') for i in range(2)]
+
+        # No rounds left: as if every attempt lost its race
+        with mock.patch('api.notifications.COALESCE_ATTEMPTS', 0), \
+                self.assertLogs('api.notifications', 'WARNING'):
+            notifications = fan_out_message_notifications([(message, [recipient.u_id]) for message in messages])
+
+        self.assertEqual([n.message_id for n in notifications], [m.id for m in messages])
+        self.assertEqual(
+            list(Notification.objects.filter(recipient=recipient).values_list('message_count', flat=True)),
+            [None, None],
+        )
+
+
+class NotificationCountTests(ChatTestCase):
+    """Stats come from counters that follow creates, reads and deletes"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(full_name='Reader', email='reader@example.com')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def stats(self):
+        response = self.client.get('/api/notifications/stats/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_counters_follow_changes(self):
+        for notification_type in ('system', 'connection_request', 'rating'):
+            with self.captureOnCommitCallbacks(execute=True):
+                create_notification(self.user, notification_type, 'Title', 'Body')
+        self.stats()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            notification = Notification.objects.get(notification_type='system')
+            self.client.patch(f'/api/notifications/{notification.id}/', {'is_read': True}, format='json')
+            other = Notification.objects.get(notification_type='connection_request')
+            self.client.delete(f'/api/notifications/{other.id}/')
+
+        # Warm counters (and a user in no chat rooms): nothing touches the database
+        with self.assertNumQueries(0):
+            stats = self.stats()
+        self.assertEqual(stats, {
+            'total_notifications': 2,
+            'unread_notifications': 1,
+            'message_notifications': 0,
+            'connection_notifications': 0,
+            'system_notifications': 2,
+        })
+        self.assertEqual(stats, self.rebuilt_stats())
+
+    def rebuilt_stats(self):
+        invalidate_notification_counts([self.user.u_id])
+        return self.stats()
+
+
+class NotificationListPaginationTests(ChatTestCase):
+    """Cursor pages walk every notification once, even across created_at ties"""
+
+    def test_cursor_pages(self):
+        user = User.objects.create(full_name='Pager', email='pager@example.com')
+        Notification.objects.bulk_create([
+            Notification(recipient=user, notification_type='system', title=f'n{i}', message='')
+            for i in range(5)
+        ])
+        Notification.objects.filter(recipient=user, title__in=['n1', 'n2', 'n3']).update(
+            created_at=Notification.objects.get(title='n1').created_at,
+        )
+        client = APIClient()
+        client.force_authenticate(user)
+
+        seen, cursor = [], ''
+        while True:
+            response = client.get('/api/notifications/', {'page_size': 2, 'cursor': cursor, 'include_total': 'false'})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('total', response.json())
+            seen += [n['id'] for n in response.json()['notifications']]
+            cursor = response.json()['next_cursor']
+            if not cursor:
+                break
+
+        expected = list(Notification.objects.filter(recipient=user).order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+        self.assertEqual(client.get('/api/notifications/', {'cursor': 'junk'}).status_code, 400)
+
+
+@override_settings(
+    NOTIFICATION_RETENTION_READ_DAYS=30,
+    NOTIFICATION_RETENTION_UNREAD_DAYS=180,
+    NOTIFICATION_RETENTION_READ_OVERRIDES={'system': 0},
+    NOTIFICATION_RETENTION_UNREAD_OVERRIDES={},
+)
+class NotificationRetentionTests(ChatTestCase):
+    """Pruning deletes expired notifications in batches and keeps the rest"""
+
+    def test_prune_by_type_and_read_state(self):
+        user = User.objects.create(full_name='Keeper', email='keeper@example.com')
+        ages = {
+            'old read': ('connection_request', True, 40),
+            'recent read': ('connection_request', True, 10),
+            'old unread': ('connection_request', False, 40),
+            'ancient unread': ('connection_request', False, 200),
+            'kept system': ('system', True, 400),
+        }
+        for title, (notification_type, is_read, days) in ages.items():
+            for _ in range(3):
+                notification = Notification.objects.create(
+                    recipient=user, notification_type=notification_type, is_read=is_read, title=title, message='',
+                )
+                Notification.objects.filter(id=notification.id).update(created_at=timezone.now() - timedelta(days=days))
+        digest = Notification.objects.create(recipient=user, notification_type='message', chat_room_id=1, is_digest=True, is_read=True, title='digest', message='')
+        Notification.objects.filter(id=digest.id).update(created_at=timezone.now() - timedelta(days=400))
+
+        out = StringIO()
+        call_command('prune_notifications', batch_size=2, stdout=out)
+
+        remaining = set(Notification.objects.values_list('title', flat=True))
+        self.assertEqual(remaining, {'recent read', 'old unread', 'kept system', 'digest'})
+        self.assertIn('Total: deleted 6 rows', out.getvalue())
+
+    def test_live_coalesced_row_is_kept_while_active(self):
+        author = User.objects.create(full_name='Author', email='author@example.com')
+        recipient = User.objects.create(full_name='Recipient', email='recipient@example.com')
+        room = ChatRoom.objects.create()
+        fan_out_message_notifications([(Message.objects.create(room=room, author=author, content='long ago'), [recipient.u_id])])
+        Notification.objects.filter(recipient=recipient).update(created_at=timezone.now() - timedelta(days=400))
+
+        fan_out_message_notifications([(Message.objects.create(room=room, author=author, content='today'), [recipient.u_id])])
+        call_command('prune_notifications', stdout=StringIO())
+
+        live = Notification.objects.get(recipient=recipient)
+        self.assertEqual((live.message, live.message_count), ('today', 2))
+
+
+class NotificationBulkReadTests(ChatTestCase):
+    """Bulk mark-read scopes each run as one UPDATE"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(full_name='Reader', email='bulk@example.com')
+        self.notifications = [
+            Notification.objects.create(
+                recipient=self.user, notification_type='message', title=f'n{i}', message='', chat_room_id=i % 2,
+            )
+            for i in range(6)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.client.get('/api/notifications/stats/')
+
+    def mark_read(self, **scope):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/notifications/mark-read/', scope, format='json')
+        return response
+
+    def test_scopes(self):
+        ids = [n.id for n in self.notifications]
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.mark_read(notification_ids=ids[:2]).json()['updated'], 2)
+        self.assertEqual([q['sql'].split()[0] for q in queries].count('UPDATE'), 1)
+        self.assertEqual(self.mark_read(up_to_id=ids[3], room_id=1).json()['updated'], 1)
+        self.assertEqual(self.mark_read(before=timezone.now().isoformat()).json()['updated'], 3)
+        self.assertFalse(Notification.objects.filter(recipient=self.user, is_read=False).exists())
+        self.assertEqual(self.client.get('/api/notifications/stats/').json()['unread_notifications'], 0)
+
+        self.assertEqual(self.mark_read().status_code, 400)
+        self.assertEqual(self.mark_read(before='yesterday').status_code, 400)
+        self.assertEqual(self.mark_read(notification_ids='1,2').status_code, 400)
@@ -1,6 +1,6 @@
 # myapp/urls.py
 from django.urls import path
-from .views import RegisterView,UserProfileView, LoginView,OTPView,ForgotPassword,CategoryList,ListenersBasedOnPreference,ConnectionRequest,ConnectionList,AcceptConnection,AcceptedListSeeker,TestAPIView,LogoutView,ListenerListCreateView,getConnectionListForListener,BlogCreateView,BlogDetailBySlugView,ListenerProfile,NotificationListView,NotificationDetailView,NotificationMarkAllReadView,NotificationStatsView,NotificationSettingsView,CreateMessageNotificationView,TestNotificationView,TestimonialView,TestimonialDetailView,BlogLikeView,BlogLikeToggleView,BlogLikesListView,CommunityPostListView,CommunityPostDetailView,CommunityPostLikeView,CommunityPostCommentView,RatingCreateView,RatingListView,RatingStatsView,RatingUpdateView,RatingDeleteView
+from .views import RegisterView,UserProfileView, LoginView,OTPView,ForgotPassword,CategoryList,ListenersBasedOnPreference,ConnectionRequest,ConnectionList,AcceptConnection,AcceptedListSeeker,TestAPIView,LogoutView,ListenerListCreateView,getConnectionListForListener,BlogCreateView,BlogDetailBySlugView,ListenerProfile,NotificationListView,NotificationDetailView,NotificationMarkAllReadView,NotificationMarkReadView,NotificationStatsView,NotificationSettingsView,CreateMessageNotificationView,TestNotificationView,TestimonialView,TestimonialDetailView,BlogLikeView,BlogLikeToggleView,BlogLikesListView,CommunityPostListView,CommunityPostDetailView,CommunityPostLikeView,CommunityPostCommentView,RatingCreateView,RatingListView,RatingStatsView,RatingUpdateView,RatingDeleteView
 
 urlpatterns = [
     path('register/', RegisterView.as_view(),name='register'),
@@ -27,6 +27,7 @@ urlpatterns = [
     path('notifications/', NotificationListView.as_view(), name='notification-list'),
     path('notifications/<int:notification_id>/', NotificationDetailView.as_view(), name='notification-detail'),
     path('notifications/mark-all-read/', NotificationMarkAllReadView.as_view(), name='notification-mark-all-read'),
+    path('notifications/mark-read/', NotificationMarkReadView.as_view(), name='notification-mark-read'),
     path('notifications/stats/', NotificationStatsView.as_view(), name='notification-stats'),
     path('notifications/settings/', NotificationSettingsView.as_view(), name='notification-settings'),
     path('notifications/create-message/', CreateMessageNotificationView.as_view(), name='create-message-notification'),
@@ -8,7 +8,12 @@ from admin_api.serializers import BlogSerializer,Blog
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import random
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from .models import User,Seeker,Listener,Category,Connections,Notification,NotificationSettings,Testimonial,BlogLike,CommunityPost,CommunityPostLike,CommunityPostComment,Rating
+from .cursors import decode_cursor, encode_cursor
+from .notifications import create_notification, mark_notifications_read, push_notifications
+from .notification_counts import count_deleted, count_marked_read, count_marked_unread, get_notification_counts
 from rest_framework_simplejwt.tokens import RefreshToken,TokenError
 from rest_framework.permissions import IsAuthenticated # Import IsAuthenticated
 from rest_framework.permissions import AllowAny
@@ -225,6 +230,10 @@ class ConnectionRequest(APIView):
         except Connections.DoesNotExist:
             # Create a new connection
             connection = Connections.objects.create(seeker=seeker, listener=listener)
+            create_notification(
+                listener.user, 'connection_request', 'New connection request',
+                f'{request.user.full_name} wants to connect with you.', sender=request.user,
+            )
             return Response({"message": "Connection request sent."}, status=status.HTTP_201_CREATED)
 
 class ConnectionList(APIView):
@@ -332,6 +341,10 @@ class AcceptConnection(APIView):
             connection.accepted = True
             connection.rejected = False # Ensure rejected is false
             connection.save()
+            create_notification(
+                connection.seeker.user, 'connection_accepted', 'Connection accepted',
+                f'{request.user.full_name} accepted your connection request.', sender=request.user,
+            )
             return Response({"message": "Connection accepted."}, status=status.HTTP_200_OK)
             
         elif action == "reject":
@@ -339,6 +352,10 @@ class AcceptConnection(APIView):
             connection.accepted = False
             connection.rejected = True
             connection.save()
+            create_notification(
+                connection.seeker.user, 'connection_rejected', 'Connection declined',
+                f'{request.user.full_name} declined your connection request.', sender=request.user,
+            )
             return Response({"message": "Connection rejected."}, status=status.HTTP_200_OK)
             
         else:
@@ -584,8 +601,15 @@ class NotificationListView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
-        """Get all notifications for the current user"""
-        notifications = Notification.objects.filter(recipient=request.user)
+        """
+        Get notifications for the current user, newest first.
+
+        Pass the returned `next_cursor` back as `?cursor=` for the next page;
+        it seeks on (created_at, id), so deep pages cost the same as the
+        first. `?page=` offset paging still works. `?include_total=false`
+        leaves out `total`.
+        """
+        notifications = Notification.objects.filter(recipient=request.user).order_by('-created_at', '-id')
         
         # Filter by notification type if provided
         notification_type = request.query_params.get('type')
@@ -598,20 +622,38 @@ class NotificationListView(APIView):
             notifications = notifications.filter(is_read=is_read.lower() == 'true')
         
         # Pagination
-        page_size = int(request.query_params.get('page_size', 20))
-        page = int(request.query_params.get('page', 1))
+        try:
+            page_size = min(max(int(request.query_params.get('page_size', 20)), 1), 100)
+            page = max(int(request.query_params.get('page', 1)), 1)
+        except ValueError:
+            return Response({'error': "'page' and 'page_size' must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+
+        cursor = request.query_params.get('cursor')
         start = (page - 1) * page_size
-        end = start + page_size
-        
-        notifications = notifications[start:end]
+        if cursor:
+            try:
+                created_at, notification_id = decode_cursor(cursor)
+            except (ValueError, OverflowError):
+                return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+            notifications = notifications.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=notification_id)
+            )
+            start = 0
+
+        notifications = list(notifications.select_related('sender', 'recipient')[start:start + page_size + 1])
+        has_more = len(notifications) > page_size
+        notifications = notifications[:page_size]
         serializer = NotificationSerializer(notifications, many=True)
         
-        return Response({
+        data = {
             'notifications': serializer.data,
             'page': page,
             'page_size': page_size,
-            'total': Notification.objects.filter(recipient=request.user).count()
-        }, status=status.HTTP_200_OK)
+            'next_cursor': encode_cursor(notifications[-1].created_at, notifications[-1].id) if has_more else None,
+        }
+        if request.query_params.get('include_total', 'true').lower() != 'false':
+            data['total'] = get_notification_counts(request.user)['total']
+        return Response(data, status=status.HTTP_200_OK)
 
 class NotificationDetailView(APIView):
     permission_classes = [IsAuthenticated]
@@ -629,9 +671,22 @@ class NotificationDetailView(APIView):
         """Mark notification as read/unread"""
         try:
             notification = Notification.objects.get(id=notification_id, recipient=request.user)
+            was_read = notification.is_read
             serializer = NotificationUpdateSerializer(notification, data=request.data, partial=True)
             if serializer.is_valid():
-                serializer.save()
+                try:
+                    with transaction.atomic():
+                        serializer.save()
+                except IntegrityError:
+                    # Reopening an old coalesced notification while a newer one is unread
+                    return Response(
+                        {'error': 'A newer notification for this conversation is already unread'},
+                        status=status.HTTP_409_CONFLICT,
+                    )
+                if notification.is_read and not was_read:
+                    count_marked_read(request.user.u_id, 1)
+                elif was_read and not notification.is_read:
+                    count_marked_unread(request.user.u_id, 1)
                 return Response(serializer.data, status=status.HTTP_200_OK)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         except Notification.DoesNotExist:
@@ -642,6 +697,7 @@ class NotificationDetailView(APIView):
         try:
             notification = Notification.objects.get(id=notification_id, recipient=request.user)
             notification.delete()
+            count_deleted(notification)
             return Response({'message': 'Notification deleted successfully'}, status=status.HTTP_204_NO_CONTENT)
         except Notification.DoesNotExist:
             return Response({'error': 'Notification not found'}, status=status.HTTP_404_NOT_FOUND)
@@ -655,24 +711,45 @@ class NotificationMarkAllReadView(APIView):
             recipient=request.user, 
             is_read=False
         ).update(is_read=True)
+        count_marked_read(request.user.u_id, updated_count)
         
         return Response({
             'message': f'{updated_count} notifications marked as read'
         }, status=status.HTTP_200_OK)
 
+class NotificationMarkReadView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        """
+        Mark a set of notifications as read in one UPDATE. The body takes any
+        of `notification_ids`, `up_to_id`, `before` and `room_id`.
+        """
+        try:
+            updated_count = mark_notifications_read(request.user, request.data)
+        except (TypeError, ValueError) as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'message': f'{updated_count} notifications marked as read',
+            'updated': updated_count,
+            'unread_count': get_notification_counts(request.user)['unread'],
+        }, status=status.HTTP_200_OK)
+
 class NotificationStatsView(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request):
         """Get notification statistics for the current user"""
-        user_notifications = Notification.objects.filter(recipient=request.user)
+        counts = get_notification_counts(request.user)
         
         stats = {
-            'total_notifications': user_notifications.count(),
-            'unread_notifications': user_notifications.filter(is_read=False).count(),
-            'message_notifications': user_notifications.filter(notification_type='message').count(),
-            'connection_notifications': user_notifications.filter(notification_type__in=['connection_request', 'connection_accepted', 'connection_rejected']).count(),
-            'system_notifications': user_notifications.filter(notification_type='system').count(),
+            'total_notifications': counts['total'],
+            'unread_notifications': counts['unread'],
+            'message_notifications': counts['type_message'],
+            'connection_notifications': counts['type_connection_request'] + counts['type_connection_accepted'] + counts['type_connection_rejected'],
+            # Ratings share the system bucket, as they share its setting (SETTING_FOR_TYPE)
+            'system_notifications': counts['type_system'] + counts['type_rating'],
         }
         
         serializer = NotificationStatsSerializer(stats)
@@ -709,6 +786,7 @@ class CreateMessageNotificationView(APIView):
                 return Response({'message': 'Message notifications disabled for this user'}, status=status.HTTP_200_OK)
             
             notification = serializer.save()
+            push_notifications([notification])
             response_serializer = NotificationSerializer(notification)
             return Response(response_serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -728,6 +806,7 @@ class TestNotificationView(APIView):
                 chat_room_id=1,
                 message_id=1
             )
+            push_notifications([notification])
             
             serializer = NotificationSerializer(notification)
             return Response({
@@ -1080,6 +1159,10 @@ class RatingCreateView(APIView):
                 )
             
             rating = serializer.save()
+            create_notification(
+                listener.user, 'rating', 'New rating',
+                f'{request.user.full_name} rated you {rating.rating} out of 5.', sender=request.user,
+            )
             response_serializer = RatingSerializer(rating)
             return Response(response_serializer.data, status=status.HTTP_201_CREATED)
         
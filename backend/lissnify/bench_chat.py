@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the chat hot paths.
+
+Run from backend/lissnify against a development database, e.g.
+    python bench_chat.py unread-fanout --sizes 2 10 50 200
+    python bench_chat.py write-behind --messages 2000 --senders 20
+    python bench_chat.py wire-format --messages 2000 --senders 2
+    python bench_chat.py community --members 5000 --rate 50 --duration 10
+Every scenario works on throwaway users and rooms. Most run inside a
+transaction that is rolled back; scenarios that measure real commits delete
+what they created instead.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import timedelta
+from types import SimpleNamespace
+import django
+
+# Add the project directory to Python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# Set up Django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Lissnify.settings')
+django.setup()
+
+from channels.db import database_sync_to_async
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api.models import Notification, User
+from chat_api.buffer import MessageBuffer
+from chat_api.consumer import RoomEventsMixin
+from chat_api.digest import refresh_room_digests
+from chat_api.models import ChatRoom, Message
+from chat_api.pipeline import send_message
+from chat_api.receipts import with_unread_counts
+from chat_api.unread import get_room_unread_counts
+from chat_api.wire import JsonProtocol, MsgpackProtocol
+
+
+def make_room(participant_count, message_count=20, room_type='group'):
+    """A room of `room_type` with `participant_count` fresh users and some history"""
+    tag = uuid.uuid4().hex[:8]
+    users = User.objects.bulk_create([
+        User(full_name=f'bench-{tag}-{i}', email=f'bench-{tag}-{i}@example.com')
+        for i in range(participant_count)
+    ])
+    room = ChatRoom.objects.create(name=f'bench-{tag}', type=room_type)
+    room.participants.add(*users)
+    Message.objects.bulk_create([
+        Message(room=room, author=users[i % participant_count], content=f'message {i}')
+        for i in range(message_count)
+    ])
+    return room, users
+
+
+def bench_unread_fanout(args):
+    """DB round trips to attach unread counts to one new message"""
+    print(f"{'recipients':>10} {'per socket':>11} {'per send (cold)':>16} {'per send (warm)':>16}")
+    for size in args.sizes:
+        room, users = make_room(size)
+        user_ids = [user.u_id for user in users]
+
+        # Before: every connected socket counted its own unread messages
+        with CaptureQueriesContext(connection) as per_socket:
+            for user in users:
+                list(with_unread_counts(ChatRoom.objects.filter(id=room.id), user).values_list('unread_count'))
+
+        # After: the sender resolves every participant once and ships the map
+        with CaptureQueriesContext(connection) as cold:
+            get_room_unread_counts(room.id, user_ids)
+        with CaptureQueriesContext(connection) as warm:
+            get_room_unread_counts(room.id, user_ids)
+
+        print(f"{size:>10} {len(per_socket):>11} {len(cold):>16} {len(warm):>16}")
+
+
+def bench_write_behind(args):
+    """Messages/sec through the per-message send path versus the write-behind buffer"""
+    room, users = make_room(args.senders, message_count=0)
+    try:
+        per_message = asyncio.run(_send_all(args, users, room, _send_per_message))
+        print(f"{'per-message':<28} {per_message:>10.0f} msg/s   {args.messages} commits")
+        for flush_ms in args.flush_ms:
+            buffer = MessageBuffer(flush_ms, args.batch_size)
+            rate = asyncio.run(_send_all(args, users, room, buffer.submit))
+            label = f"write-behind {flush_ms}ms/{args.batch_size}"
+            print(f"{label:<28} {rate:>10.0f} msg/s")
+    finally:
+        User.objects.filter(u_id__in=[user.u_id for user in users]).delete()
+        room.delete()
+
+
+async def _send_per_message(author, room_id, content):
+    event, _ = await database_sync_to_async(send_message)(author, room_id, content)
+    return event, None
+
+
+async def _send_all(args, users, room, submit):
+    """`args.senders` concurrent clients send `args.messages` in total; rate counts until all are persisted"""
+    per_sender = args.messages // len(users)
+
+    async def client(user):
+        persisted = []
+        for i in range(per_sender):
+            _, future = await submit(user, room.id, f'bench {i}')
+            if future is not None:
+                persisted.append(future)
+        await asyncio.gather(*persisted)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(user) for user in users))
+    return per_sender * len(users) / (time.perf_counter() - started)
+
+
+class FrameRecorder(RoomEventsMixin):
+    """Runs the socket's event handlers and keeps the frames instead of sending them"""
+
+    def __init__(self, user):
+        self.user = user
+        self.frames = []
+
+    async def send_frame(self, payload):
+        self.frames.append(payload)
+
+
+def bench_wire_format(args):
+    """Bytes and encode time per new_message frame over one connection, JSON versus MessagePack"""
+    rng = random.Random(42)
+    words = ['hey', 'thanks', 'feeling', 'better', 'today', 'talk', 'later', 'really', 'helped', 'sleep', 'work', 'okay']
+    authors = [(1000 + i, f'Listener Number {i}') for i in range(args.senders)]
+    recorder = FrameRecorder(SimpleNamespace(u_id=1))
+    started_at = timezone.now()
+
+    async def record():
+        for i in range(args.messages):
+            author_id, name = authors[i % len(authors)]
+            await recorder.chat_message({
+                "type": "chat_message",
+                "message_type": "new_message",
+                "room_id": 42,
+                "message": ' '.join(rng.choice(words) for _ in range(rng.randint(3, 30))),
+                "author": None,
+                "author_id": author_id,
+                "author_full_name": name,
+                "message_id": 500000 + i,
+                "seq": 1 + i,
+                "timestamp": (started_at + timedelta(seconds=i)).isoformat(),
+                "unread_counts": {"1": i % 7},
+            })
+    asyncio.run(record())
+
+    print(f"{'protocol':<10} {'bytes/msg':>10} {'encode us/msg':>14}")
+    for name, protocol in (('json', JsonProtocol()), ('msgpack', MsgpackProtocol())):
+        started = time.perf_counter()
+        encoded = [protocol.encode(frame) for frame in recorder.frames]
+        elapsed = time.perf_counter() - started
+        size = sum(len(data) if isinstance(data, bytes) else len(data.encode('utf-8')) for data in encoded)
+        print(f"{name:<10} {size / len(encoded):>10.1f} {elapsed / len(encoded) * 1e6:>14.2f}")
+
+
+class QueryCounter:
+    """Counts statements run on `connection`, unlike CaptureQueriesContext not capped at 9000"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def bench_community(args):
+    """
+    A paced load of `args.rate` msgs/sec into one room of `args.members`,
+    as an eagerly fanned-out group room versus a lazily fanned-out community
+    room, then the cost of one digest refresh covering every member.
+    """
+    total = args.rate * args.duration
+    print(f"{args.members} members, {args.rate} msg/s for {args.duration}s ({total} messages)")
+    print(f"{'mode':<10} {'achieved msg/s':>15} {'p50 ms':>8} {'p99 ms':>8} {'queries/msg':>12} {'notification rows':>18}")
+    for room_type in ('group', 'community'):
+        room, users = make_room(args.members, message_count=0, room_type=room_type)
+        rng = random.Random(7)
+        notifications_before = Notification.objects.count()
+        latencies = []
+        queries = QueryCounter()
+        with connection.execute_wrapper(queries):
+            started = time.perf_counter()
+            for i in range(total):
+                # Hold the offered rate; a mode that can't keep up falls behind
+                delay = started + i / args.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                sent = time.perf_counter()
+                send_message(rng.choice(users), room.id, f'bench {i}')
+                latencies.append(time.perf_counter() - sent)
+            elapsed = time.perf_counter() - started
+        latencies.sort()
+        rows = Notification.objects.count() - notifications_before
+        print(
+            f"{room_type:<10} {total / elapsed:>15.1f} {latencies[len(latencies) // 2] * 1000:>8.2f}"
+            f" {latencies[int(len(latencies) * 0.99)] * 1000:>8.2f} {queries.count / total:>12.1f} {rows:>18}"
+        )
+
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        started = time.perf_counter()
+        refreshed = refresh_room_digests(ChatRoom.objects.get(id=room.id))
+        elapsed = time.perf_counter() - started
+    print(f"digest refresh: {refreshed} digests in {elapsed * 1000:.2f} ms and {queries.count} queries")
+
+SCENARIOS = {
+    'unread-fanout': bench_unread_fanout,
+    'write-behind': bench_write_behind,
+    'wire-format': bench_wire_format,
+    'community': bench_community,
+}
+
+# Scenarios that need real commits to be meaningful
+COMMITTING = {'write-behind'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2, 10, 50, 200])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--senders', type=int, default=20)
+    parser.add_argument('--flush-ms', type=int, nargs='+', default=[10, 50])
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--members', type=int, default=5000)
+    parser.add_argument('--rate', type=int, default=50)
+    parser.add_argument('--duration', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.scenario in COMMITTING:
+        SCENARIOS[args.scenario](args)
+        return
+
+    with transaction.atomic():
+        SCENARIOS[args.scenario](args)
+        transaction.set_rollback(True)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ChatApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat_api'
+
+    def ready(self):
+        # Register the membership cache's invalidation receivers
+        from . import membership  # noqa: F401
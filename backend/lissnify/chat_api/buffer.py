@@ -0,0 +1,210 @@
+# chat_api/buffer.py
+"""
+Write-behind buffering for chat messages (settings.CHAT_WRITE_BEHIND).
+
+Each worker process queues outgoing messages from all of its rooms and
+persists them with one bulk insert per flush. Each message takes its id
+from the message table's sequence as it is prepared, so it can be broadcast
+before it is written. Callers get a future that resolves once the row is
+committed and should only acknowledge delivery after it does; anything
+still queued when a worker dies is lost and was never acknowledged.
+"""
+import asyncio
+import threading
+import traceback
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from api.notifications import fan_out_message_notifications
+from .models import ChatRoom, Message, MessageReadStatus
+from .pipeline import message_recipients, new_message_event, notification_recipients, record_last_messages
+from .sequence import allocate_seq
+from .unread import count_new_message, get_room_unread_counts, uncount_new_message
+
+
+class MessageIdAllocator:
+    """
+    Hands out Message ids from the table's sequence, one `nextval` per
+    message as it is prepared. Ids are never reserved ahead in blocks: read
+    watermarks, message cursors and `record_last_messages` all rely on ids
+    rising in the order messages were sent, across every worker.
+    """
+
+    def __init__(self):
+        self._high_water = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id'))", [Message._meta.db_table])
+                return cursor.fetchone()[0]
+
+        # No sequence to take from (local sqlite): continue after the highest
+        # id in use, which is only safe with a single worker process
+        with self._lock:
+            self._high_water = max(Message.objects.aggregate(last=Max('id'))['last'] or 0, self._high_water) + 1
+            return self._high_water
+
+
+class PendingMessage:
+    def __init__(self, message, notify_ids, per_message_receipts, event, counted_ids=()):
+        self.message = message
+        self.notify_ids = notify_ids
+        self.per_message_receipts = per_message_receipts
+        self.event = event
+        # Recipients whose unread counters already include this message
+        self.counted_ids = counted_ids
+        self.persisted = None
+
+
+def prepare_message(author, room_id, content, ids):
+    """
+    Build an unsaved message with its id taken and its `new_message` event.
+    The room sequence number is only taken when the message is flushed, so
+    the event carries `seq: None`. Returns None if the room does not exist.
+    """
+    room = ChatRoom.objects.filter(id=room_id).first()
+    if room is None:
+        return None
+
+    participant_ids, recipient_ids = message_recipients(room, author)
+    message = Message(
+        id=ids.next_id(), room=room, author=author, content=content, timestamp=timezone.now(),
+    )
+
+    if room.lazy_fan_out:
+        unread_counts = None
+    else:
+        # The message isn't in the database yet, so count it on top of what
+        # the counters (or a rebuild from the database) already hold. The
+        # counters are bumped now so the next buffered message counts this
+        # one too; a failed flush takes it back out (MessageBuffer._flush)
+        unread_counts = get_room_unread_counts(room.id, participant_ids)
+        for u_id in recipient_ids:
+            unread_counts[u_id] += 1
+        count_new_message(room.id, recipient_ids)
+
+    return PendingMessage(
+        message, notification_recipients(room.id, recipient_ids), room.per_message_receipts,
+        new_message_event(message, unread_counts), counted_ids=recipient_ids,
+    )
+
+
+def persist_batch(pending):
+    """Write a batch of buffered messages, receipts and notifications in one commit"""
+    with transaction.atomic():
+        assign_seqs([item.message for item in pending])
+        Message.objects.bulk_create([item.message for item in pending])
+        record_last_messages([item.message for item in pending])
+        receipts = [
+            MessageReadStatus(message=item.message, user_id=item.message.author_id)
+            for item in pending
+            if item.per_message_receipts
+        ]
+        if receipts:
+            MessageReadStatus.objects.bulk_create(receipts)
+        fan_out_message_notifications([(item.message, item.notify_ids) for item in pending])
+
+
+def assign_seqs(messages):
+    """
+    Number `messages` in each room, in the order they were sent, inside the
+    flush transaction. Taking the numbers at flush rather than when a message
+    is prepared means a sync can never see a later number committed while an
+    earlier one is still buffered. Rooms are locked in id order, so
+    concurrent flushes can't deadlock.
+    """
+    by_room = defaultdict(list)
+    for message in messages:
+        by_room[message.room_id].append(message)
+    for room_id in sorted(by_room):
+        room_messages = by_room[room_id]
+        last = allocate_seq(room_id, len(room_messages))
+        for offset, message in enumerate(room_messages):
+            message.seq = last - len(room_messages) + 1 + offset
+
+
+def uncount_batch(pending):
+    """Take messages that were never written back out of their recipients' unread counters"""
+    for item in pending:
+        uncount_new_message(item.message.room_id, item.counted_ids)
+
+
+class MessageBuffer:
+    def __init__(self, flush_interval_ms, batch_size):
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.ids = MessageIdAllocator()
+        self._loop = None
+        self._queue = None
+        self._task = None
+
+    async def submit(self, author, room_id, content):
+        """
+        Queue a message for the next flush. Returns (`new_message` event, future
+        resolving to the message id once committed), or (None, None) if the
+        room does not exist.
+        """
+        pending = await database_sync_to_async(prepare_message)(author, room_id, content, self.ids)
+        if pending is None:
+            return None, None
+
+        self._ensure_flusher()
+        pending.persisted = self._loop.create_future()
+        self._queue.put_nowait(pending)
+        return pending.event, pending.persisted
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = None
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        try:
+            await database_sync_to_async(persist_batch)(batch)
+        except Exception as exc:
+            traceback.print_exc()
+            await sync_to_async(uncount_batch, thread_sensitive=False)(batch)
+            for item in batch:
+                if not item.persisted.done():
+                    item.persisted.set_exception(exc)
+            return
+
+        for item in batch:
+            if not item.persisted.done():
+                item.persisted.set_result(item.message.id)
+
+
+_buffer = None
+
+
+def get_message_buffer():
+    global _buffer
+    if _buffer is None:
+        _buffer = MessageBuffer(settings.CHAT_WRITE_BEHIND_FLUSH_MS, settings.CHAT_WRITE_BEHIND_BATCH_SIZE)
+    return _buffer
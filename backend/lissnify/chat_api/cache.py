@@ -0,0 +1,34 @@
+# chat_api/cache.py
+from django.conf import settings
+
+_redis = None
+
+
+def redis_url():
+    """URL of the Redis server behind the default channel layer, or None if it isn't Redis"""
+    layer = settings.CHANNEL_LAYERS.get('default', {})
+    if 'Redis' not in layer.get('BACKEND', ''):
+        return None
+
+    hosts = layer.get('CONFIG', {}).get('hosts') or []
+    if not hosts:
+        return None
+
+    host = hosts[0]
+    if isinstance(host, dict):
+        host = host.get('address')
+    if isinstance(host, (list, tuple)):
+        return f"redis://{host[0]}:{host[1]}"
+    return host
+
+
+def get_redis():
+    """Shared synchronous Redis client, or None when the channel layer is in-memory"""
+    global _redis
+    url = redis_url()
+    if url is None:
+        return None
+    if _redis is None:
+        import redis
+        _redis = redis.Redis.from_url(url, decode_responses=True)
+    return _redis
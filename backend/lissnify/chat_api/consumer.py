@@ -1,146 +1,112 @@
 # chat_api/consumers.py
-import json
+import asyncio
 import traceback
+from urllib.parse import parse_qs
+from django.conf import settings
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from .models import Message, ChatRoom, MessageReadStatus
-from api.models import User, Notification, NotificationSettings
+from .receipts import mark_messages_read, messages_read_event
+from .buffer import get_message_buffer
+from .membership import is_room_member
+from .presence import PresenceMixin, room_presence
+from .sync import room_changes
+from .outbound import OutboundQueueMixin
+from .wire import WireProtocolMixin
+from .pipeline import send_message
+from .unread import count_messages_read, get_unread_counts
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        # Extract room_id from URL route
-        self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
-        self.user = self.scope.get("user")
-
-        # Authentication & participation check
-        if not self.user or not self.user.is_authenticated:
-            await self.close()
-            return
-
-        is_participant = await self.is_user_participant(self.user, self.room_id)
-        if not is_participant:
-            await self.close()
-            return
+def room_group_name(room_id):
+    return f'chat_{room_id}'
 
-        # Add to group and accept
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.accept()
 
-    async def disconnect(self, close_code):
-        # Remove from group
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+class RoomEventsMixin(OutboundQueueMixin, WireProtocolMixin):
+    """
+    Chat actions and group event handlers shared by the per-room ChatConsumer
+    and the multiplexed socket. Every action takes the room it acts on and
+    every frame sent to the client carries its `room_id`.
+    """
 
-    async def receive(self, text_data):
-        """Handles messages received from WebSocket client"""
-        try:
-            payload = json.loads(text_data)
-            message_type = payload.get("type", "send_message")
-
-            if message_type == "send_message":
-                await self.handle_send_message(payload)
-            elif message_type == "mark_messages_read":
-                await self.handle_mark_messages_read(payload)
-            elif message_type == "read_messages":
-                await self.handle_read_messages(payload)
-            elif message_type == "mark_specific_messages":
-                await self.handle_mark_specific_messages(payload)
-            else:
-                # Fallback: treat as send_message
-                await self.handle_send_message(payload)
-
-        except Exception:
-            traceback.print_exc()
-
-    async def handle_send_message(self, data):
+    async def send_room_message(self, room_id, data):
         """Handle sending a new message"""
         message_content = (data.get("message") or "").strip()
         if not message_content:
             return
 
-        # Save message to DB
-        new_message = await self.save_message(author=self.user, room_id=self.room_id, content=message_content)
-        if not new_message:
+        if settings.CHAT_WRITE_BEHIND:
+            # Queue for the next group commit; broadcast right away but only
+            # confirm delivery once the row is persisted
+            event, persisted = await get_message_buffer().submit(self.user, room_id, message_content)
+        else:
+            # Save message, sender receipt and notifications in one thread hop and one commit
+            event, persisted = await self.persist_message(self.user, room_id, message_content), None
+        if not event:
             return
 
-        # Mark the message as read for the sender only
-        await self.mark_message_as_read_for_sender(new_message)
+        # Broadcast the new message to the room (everyone)
+        await self.channel_layer.group_send(room_group_name(room_id), event)
 
-        # Create notifications for other participants (DB)
-        await self.create_message_notifications(new_message)
+        if persisted is None:
+            await self.send_delivered(room_id, event["message_id"])
+        else:
+            task = asyncio.ensure_future(self.acknowledge_when_persisted(room_id, event["message_id"], persisted))
+            self.pending_acks.add(task)
+            task.add_done_callback(self.pending_acks.discard)
 
-        # Broadcast the new message to the room (everyone)
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "chat_message",
-                "message_type": "new_message",
-                "message": new_message.content,
-                "author": new_message.author.username,
-                "author_full_name": new_message.author.full_name,
-                "message_id": new_message.id,
-                "timestamp": new_message.timestamp.isoformat(),
-            }
-        )
+    async def acknowledge_when_persisted(self, room_id, message_id, persisted):
+        try:
+            await persisted
+        except Exception:
+            try:
+                await self.send_frame({
+                    "type": "message_failed",
+                    "room_id": int(room_id),
+                    "message_id": message_id,
+                })
+            except Exception:
+                traceback.print_exc()
+            return
+        await self.send_delivered(room_id, message_id)
 
-        # Send delivered confirmation only to the sender (not broadcast)
+    async def send_delivered(self, room_id, message_id):
+        """Send delivered confirmation only to the sender (not broadcast)"""
         try:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 "type": "message_delivered",
-                "message_id": new_message.id,
-            }))
+                "room_id": int(room_id),
+                "message_id": message_id,
+            })
         except Exception:
             traceback.print_exc()
 
-    async def handle_mark_messages_read(self, data):
-        room_id = data.get("room_id")
-        message_ids = data.get("message_ids", [])
-
+    async def mark_room_messages_read(self, room_id, message_ids):
+        """
+        Mark `message_ids` read. This moves the read watermark to the newest
+        of them, so every earlier message in the room is read as well and is
+        included in the broadcast receipt.
+        """
         if not message_ids:
             return
 
-    # Mark these messages as read in DB
-        newly_marked = await self.mark_specific_messages_as_read(self.user, message_ids)
-
-    # Broadcast read receipt to all participants in the room
-        for receipt in newly_marked:
-            await self.channel_layer.group_send(
-                self.room_group_name,
-            {
-                "type": "chat_message",
-                "message_type": "message_read",
-                "message_id": receipt['message_id'],
-                "user_id": receipt['user_id'],
-                "read_at": receipt['read_at'],
-            }
-        )
+        # Mark these messages as read in DB
+        read_ids, read_at, seq = await self.mark_specific_messages_as_read(self.user, room_id, message_ids)
 
+        # Broadcast one aggregated read receipt to all participants in the room
+        await self.broadcast_messages_read(room_id, read_ids, read_at, seq)
 
-    async def handle_read_messages(self, data):
-        """Handle marking all messages in a chatroom as read for the current user"""
-        chatroom_id = data.get("chatroom") or self.room_id
-        if not chatroom_id:
-            return
-
-        newly_marked_messages = await self.mark_all_messages_as_read_in_chatroom(self.user, chatroom_id)
-
-        # Broadcast read events for newly marked messages
-        for read_receipt in newly_marked_messages:
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "chat_message",
-                    "message_type": "message_read",
-                    "message_id": read_receipt['message_id'],
-                    "user_id": read_receipt['user_id'],
-                    "read_at": read_receipt['read_at']
-                }
-            )
+    async def read_room(self, room_id):
+        """Mark all messages in a chatroom as read for the current user"""
+        read_ids, read_at, seq = await self.mark_all_messages_as_read_in_chatroom(self.user, room_id)
+        await self.broadcast_messages_read(room_id, read_ids, read_at, seq)
 
-    async def handle_mark_specific_messages(self, data):
-        """alias to mark specific messages route if used"""
-        await self.handle_mark_messages_read(data)
+    async def broadcast_messages_read(self, room_id, message_ids, read_at, seq):
+        """Send a single `messages_read` event for a batch of new receipts"""
+        if not message_ids:
+            return
+        await self.channel_layer.group_send(
+            room_group_name(room_id),
+            messages_read_event(room_id, self.user.u_id, message_ids, read_at, seq)
+        )
 
     async def chat_message(self, event):
         """
@@ -148,185 +114,209 @@ class ChatConsumer(AsyncWebsocketConsumer):
         Event payloads have a `message_type` key to distinguish events.
         """
         message_type = event.get("message_type", "new_message")
+        room_id = event.get("room_id", getattr(self, "room_id", None))
+        room_id = int(room_id) if room_id is not None else None
 
         if message_type == "new_message":
-            unread_count = await self.get_unread_count_for_room(self.room_id, self.user)
-            await self.send(text_data=json.dumps({
+            # Counts are resolved once by the sender; only look up if missing.
+            # Lazily fanned-out rooms send none and sockets don't query either
+            unread_counts = event.get("unread_counts", {})
+            unread_count = None
+            if unread_counts is not None:
+                unread_count = unread_counts.get(str(self.user.u_id))
+                if unread_count is None:
+                    unread_count = await self.get_unread_count_for_room(room_id, self.user)
+            await self.send_frame({
                 "type": "new_message",
+                "room_id": room_id,
                 "message": event.get("message"),
                 "author": event.get("author"),
+                "author_id": event.get("author_id"),
                 "author_full_name": event.get("author_full_name", event.get("author")),
                 "message_id": event.get("message_id"),
+                "seq": event.get("seq"),
                 "timestamp": event.get("timestamp"),
                 "unread_count": unread_count,
-            }))
+            })
+
+        elif message_type == "messages_read":
+            await self.send_frame({
+                "type": "messages_read",
+                "room_id": room_id,
+                "seq": event.get("seq"),
+                "message_ids": event.get("message_ids", []),
+                "first_message_id": event.get("first_message_id"),
+                "last_message_id": event.get("last_message_id"),
+                "user_id": event.get("user_id"),
+                "read_at": event.get("read_at")
+            })
 
         elif message_type == "message_read":
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 "type": "message_read",
+                "room_id": room_id,
                 "message_id": event.get("message_id"),
                 "user_id": event.get("user_id"),
                 "read_at": event.get("read_at")
-            }))
+            })
 
-    async def notification_message(self, event):
-        """Handles notification messages (like aggregated read receipts)"""
-        notification = event.get("notification", {})
-        await self.send(text_data=json.dumps({
-            "type": notification.get("type", "notification"),
-            **notification
-        }))
-
-    # --- DB Helper Methods ---
-    @database_sync_to_async
-    def is_user_participant(self, user, room_id):
-        return ChatRoom.objects.filter(id=room_id, participants=user).exists()
-
-    @database_sync_to_async
-    def save_message(self, author, room_id, content):
+        elif message_type == "presence" and event.get("user_id") != self.user.u_id:
+            await self.send_frame({
+                "type": "presence",
+                "room_id": room_id,
+                "user_id": event.get("user_id"),
+                "online": event.get("online"),
+            })
+
+        elif message_type == "typing":
+            await self.send_frame({
+                "type": "typing",
+                "room_id": room_id,
+                "user_ids": event.get("user_ids", []),
+                "ttl": event.get("ttl"),
+            })
+
+    async def send_room_changes(self, room_id, since_seq):
+        """Replay what the client missed in `room_id` after `since_seq` as one `sync` frame"""
         try:
-            room = ChatRoom.objects.get(id=room_id)
-            return Message.objects.create(author=author, room=room, content=content)
-        except ChatRoom.DoesNotExist:
-            return None
+            since_seq = max(int(since_seq), 0)
+        except (TypeError, ValueError):
+            return
+        changes = await database_sync_to_async(room_changes)(self.user, room_id, since_seq)
+        await self.send_frame({"type": "sync", **changes})
+
+    async def send_presence_state(self, room_id):
+        state = await database_sync_to_async(room_presence)(room_id)
+        await self.send_frame({"type": "presence_state", **state})
 
     @database_sync_to_async
-    def create_message_notifications(self, message):
+    def persist_message(self, author, room_id, content):
         try:
-            room = ChatRoom.objects.get(id=message.room.id)
-            participants = room.participants.exclude(u_id=message.author.u_id)
-            for participant in participants:
-                settings, _ = NotificationSettings.objects.get_or_create(user=participant)
-                if not settings.message_notifications:
-                    continue
-                Notification.objects.create(
-                    recipient=participant,
-                    sender=message.author,
-                    notification_type='message',
-                    title=f'New message from {message.author.full_name}',
-                    message=f'{message.content[:100]}{"..." if len(message.content) > 100 else ""}',
-                    chat_room_id=message.room.id,
-                    message_id=message.id
-                )
+            event, _ = send_message(author, room_id, content)
+            return event
         except Exception:
             traceback.print_exc()
-
-    @database_sync_to_async
-    def get_room_participants_for_notifications(self, room_id, exclude_user_id):
-        try:
-            room = ChatRoom.objects.get(id=room_id)
-            participants = room.participants.exclude(u_id=exclude_user_id)
-            return list(participants.values('u_id', 'full_name'))
-        except ChatRoom.DoesNotExist:
-            return []
-
-    @database_sync_to_async
-    def get_user_notification_settings(self, user_id):
-        try:
-            settings = NotificationSettings.objects.get(user_id=user_id)
-            return {
-                'message_notifications': settings.message_notifications,
-                'connection_notifications': settings.connection_notifications,
-                'system_notifications': settings.system_notifications,
-            }
-        except NotificationSettings.DoesNotExist:
-            return {
-                'message_notifications': True,
-                'connection_notifications': True,
-                'system_notifications': True,
-            }
+            return None
 
     @database_sync_to_async
     def get_unread_count_for_room(self, room_id, user):
         try:
-            read_message_ids = MessageReadStatus.objects.filter(
-                user=user,
-                message__room_id=room_id
-            ).values_list('message_id', flat=True)
-
-            unread_count = Message.objects.filter(
-                room_id=room_id
-            ).exclude(
-                id__in=read_message_ids
-            ).exclude(
-                author=user
-            ).count()
-
-            return unread_count
+            return get_unread_counts(user, [room_id])[int(room_id)]
         except Exception:
             traceback.print_exc()
             return 0
 
     @database_sync_to_async
-    def get_message_sender(self, message_id):
+    def mark_specific_messages_as_read(self, user, room_id, message_ids):
         try:
-            message = Message.objects.get(id=message_id)
-            return message.author.u_id
-        except Message.DoesNotExist:
-            return None
-
-    @database_sync_to_async
-    def mark_specific_messages_as_read(self, user, message_ids):
-        try:
-            messages = Message.objects.filter(id__in=message_ids)
-            newly_marked_messages = []
-            for message in messages:
-                if message.author.u_id != user.u_id:
-                    read_status, created = MessageReadStatus.objects.get_or_create(
-                        message=message,
-                        user=user
-                    )
-                    if created:
-                        newly_marked_messages.append({
-                            'message_id': message.id,
-                            'user_id': user.u_id,
-                            'read_at': read_status.read_at.isoformat()
-                        })
-            return newly_marked_messages
+            read_ids, read_at, seq = mark_messages_read(user, room_id, message_ids)
+            count_messages_read(user, room_id, len(read_ids))
+            return read_ids, read_at, seq
         except Exception:
             traceback.print_exc()
-            return []
+            return [], None, None
 
     @database_sync_to_async
     def mark_all_messages_as_read_in_chatroom(self, user, chatroom_id):
         try:
-            read_message_ids = MessageReadStatus.objects.filter(
-                user=user,
-                message__room_id=chatroom_id
-            ).values_list('message_id', flat=True)
-
-            unread_messages = Message.objects.filter(
-                room_id=chatroom_id
-            ).exclude(
-                id__in=read_message_ids
-            ).exclude(
-                author=user
-            )
-
-            newly_marked_messages = []
-            for message in unread_messages:
-                read_status, created = MessageReadStatus.objects.get_or_create(
-                    message=message,
-                    user=user
-                )
-                if created:
-                    newly_marked_messages.append({
-                        'message_id': message.id,
-                        'user_id': user.u_id,
-                        'read_at': read_status.read_at.isoformat()
-                    })
-
-            return newly_marked_messages
+            read_ids, read_at, seq = mark_messages_read(user, chatroom_id)
+            count_messages_read(user, chatroom_id, len(read_ids))
+            return read_ids, read_at, seq
         except Exception:
             traceback.print_exc()
-            return []
+            return [], None, None
 
-    @database_sync_to_async
-    def mark_message_as_read_for_sender(self, message):
+
+class ChatConsumer(RoomEventsMixin, PresenceMixin, AsyncWebsocketConsumer):
+    async def connect(self):
+        # Extract room_id from URL route
+        self.room_id = self.scope['url_route']['kwargs']['room_id']
+        self.room_group_name = room_group_name(self.room_id)
+        self.user = self.scope.get("user")
+        self.pending_acks = set()
+
+        # Authentication & participation check
+        if not self.user or not self.user.is_authenticated:
+            await self.close()
+            return
+
+        is_participant = await self.is_user_participant(self.user, self.room_id)
+        if not is_participant:
+            await self.close()
+            return
+
+        # Add to group and accept
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.start_viewing(self.room_id)
+        await self.accept_connection()
+        await self.presence_connected()
+
+        # Resuming clients pass their last cursor; replay after joining the
+        # group so nothing falls between the replay and live events
+        query = parse_qs(self.scope.get('query_string', b'').decode('utf-8'))
+        since_seq = query.get('since_seq', [None])[0]
+        if since_seq is not None:
+            await self.send_room_changes(self.room_id, since_seq)
+
+    async def disconnect(self, close_code):
+        # Remove from group
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await self.presence_disconnected()
+        self.stop_outbound()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """Handles messages received from WebSocket client"""
         try:
-            MessageReadStatus.objects.get_or_create(
-                message=message,
-                user=message.author
-            )
+            payload = self.decode_frame(text_data, bytes_data)
+            message_type = payload.get("type", "send_message")
+
+            if message_type == "send_message":
+                await self.handle_send_message(payload)
+            elif message_type == "mark_messages_read":
+                await self.handle_mark_messages_read(payload)
+            elif message_type == "read_messages":
+                await self.handle_read_messages(payload)
+            elif message_type == "mark_specific_messages":
+                await self.handle_mark_specific_messages(payload)
+            elif message_type == "typing":
+                await self.update_typing(self.room_id, bool(payload.get("is_typing", True)))
+            elif message_type == "get_presence":
+                await self.send_presence_state(self.room_id)
+            elif message_type == "sync":
+                await self.send_room_changes(self.room_id, payload.get("since_seq", 0))
+            else:
+                # Fallback: treat as send_message
+                await self.handle_send_message(payload)
+
         except Exception:
             traceback.print_exc()
+
+    async def handle_send_message(self, data):
+        await self.send_room_message(self.room_id, data)
+
+    async def handle_mark_messages_read(self, data):
+        await self.mark_room_messages_read(self.room_id, data.get("message_ids", []))
+
+    async def handle_read_messages(self, data):
+        """Handle marking all messages in a chatroom as read for the current user"""
+        chatroom_id = data.get("chatroom") or self.room_id
+        if not chatroom_id or str(chatroom_id) != str(self.room_id):
+            return
+        await self.read_room(self.room_id)
+
+    async def handle_mark_specific_messages(self, data):
+        """alias to mark specific messages route if used"""
+        await self.handle_mark_messages_read(data)
+
+    async def notification_message(self, event):
+        """Handles notification messages (like aggregated read receipts)"""
+        notification = event.get("notification", {})
+        await self.send_frame({
+            "type": notification.get("type", "notification"),
+            **notification
+        })
+
+    # --- DB Helper Methods ---
+    @database_sync_to_async
+    def is_user_participant(self, user, room_id):
+        return is_room_member(user, room_id)
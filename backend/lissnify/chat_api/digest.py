@@ -0,0 +1,108 @@
+# chat_api/digest.py
+"""
+Message notifications for lazily fanned-out (community) rooms.
+
+Sending a message in such a room writes no Notification rows. Instead each
+member has at most one digest notification per room ("12 new messages in
+<room>", flagged `is_digest`), brought up to date by
+`manage.py refresh_message_digests` running from cron, never on a request
+path. A refresh updates unread digests in place and replaces read ones with
+a new row, so a digest's `created_at` (the notification list's cursor key)
+never moves. Advancing a read watermark marks the member's digest read
+(`receipts.mark_messages_read`).
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from api.models import Notification, NotificationSettings, User
+from api.notification_counts import count_deleted
+from api.notifications import push_notifications
+from .models import ChatRoom
+from .receipts import participant_last_read_id, participant_unread_counts
+
+
+def digest_text(room_name, unread_count):
+    noun = "message" if unread_count == 1 else "messages"
+    return f"{unread_count} new {noun} in {room_name or 'a community chat'}"
+
+
+def refresh_message_digests(since=None):
+    """
+    Bring the digests of every community room with a message since `since`
+    (a timedelta, or None for all of them) up to date. Returns how many
+    digests were created or updated.
+    """
+    rooms = ChatRoom.objects.filter(type__in=ChatRoom.LAZY_FAN_OUT_TYPES, last_message__isnull=False)
+    if since is not None:
+        rooms = rooms.filter(last_message_at__gte=timezone.now() - since)
+
+    refreshed = 0
+    for room in rooms.only('id', 'name', 'last_message_id', 'last_message_preview').order_by('id').iterator():
+        refreshed += refresh_room_digests(room)
+    return refreshed
+
+
+def refresh_room_digests(room):
+    """
+    Bring the digests of `room`'s members up to date in a few queries however
+    many members it has, and push the changed ones to their sockets. Returns
+    how many digests were created or updated.
+    """
+    behind = list(
+        User.objects.filter(chat_rooms=room.id)
+        .annotate(read_up_to=participant_last_read_id(room.id))
+        .filter(read_up_to__lt=room.last_message_id)
+        .exclude(pk__in=NotificationSettings.objects.filter(message_notifications=False).values('user_id'))
+        .values_list('pk', flat=True)
+    )
+    if not behind:
+        return 0
+
+    with transaction.atomic():
+        existing = {
+            digest.recipient_id: digest
+            for digest in Notification.objects.select_for_update().filter(
+                is_digest=True, chat_room_id=room.id, recipient_id__in=behind,
+            )
+        }
+        stale = [
+            user_id for user_id in behind
+            if user_id not in existing or (existing[user_id].message_id or 0) < room.last_message_id
+        ]
+        if not stale:
+            return 0
+
+        unread_counts = participant_unread_counts(room.id, stale)
+        created, updated, replaced = [], [], []
+        for user_id in stale:
+            unread_count = unread_counts.get(user_id, 0)
+            if not unread_count:
+                continue
+            digest = existing.get(user_id)
+            if digest is None or digest.is_read:
+                if digest is not None:
+                    replaced.append(digest)
+                digest = Notification(
+                    recipient_id=user_id, notification_type='message', is_digest=True, chat_room_id=room.id,
+                )
+                created.append(digest)
+            else:
+                updated.append(digest)
+            digest.title = digest_text(room.name, unread_count)
+            digest.message = room.last_message_preview
+            digest.message_id = room.last_message_id
+
+        if replaced:
+            Notification.objects.filter(id__in=[digest.id for digest in replaced]).delete()
+            for digest in replaced:
+                count_deleted(digest)
+        if created:
+            created = Notification.objects.bulk_create(created)
+        if updated:
+            now = timezone.now()
+            for digest in updated:
+                digest.updated_at = now
+            Notification.objects.bulk_update(updated, ['title', 'message', 'message_id', 'updated_at'])
+        push_notifications(created, updated=updated)
+    return len(created) + len(updated)
+
@@ -0,0 +1,48 @@
+# chat_api/inbox.py
+"""
+The inbox: a user's rooms, most recently active first, each with a preview
+of its newest message and the user's unread count.
+
+Activity comes from the columns the send path keeps on ChatRoom
+(`last_message_at`, falling back to `created_at` for rooms without messages),
+so a page costs a fixed number of queries however many rooms and messages
+there are. Pages are keyset paginated: `next_cursor` encodes the activity
+time and id of the last room returned and is passed back as `before`.
+"""
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+
+from api.cursors import decode_cursor, encode_cursor
+from .membership import get_user_room_ids
+from .models import ChatRoom
+from .serializer import InboxRoomSerializer
+from .unread import get_unread_counts
+
+
+def inbox_page(user, before=None, limit=30, context=None):
+    """
+    One page of `user`'s inbox, newest activity first. `before` is a cursor
+    from a previous page. Returns {rooms, next_cursor}; `next_cursor` is None
+    on the last page.
+    """
+    rooms = (
+        ChatRoom.objects.filter(id__in=get_user_room_ids(user))
+        .annotate(activity_at=Coalesce('last_message_at', 'created_at'))
+        .select_related('last_message')
+        .prefetch_related('participants')
+        .order_by('-activity_at', '-id')
+    )
+    if before:
+        activity_at, room_id = decode_cursor(before)
+        rooms = rooms.filter(Q(activity_at__lt=activity_at) | Q(activity_at=activity_at, id__lt=room_id))
+
+    rooms = list(rooms[:limit + 1])
+    has_more = len(rooms) > limit
+    rooms = rooms[:limit]
+
+    unread_counts = get_unread_counts(user, [room.id for room in rooms])
+    serializer = InboxRoomSerializer(rooms, many=True, context={**(context or {}), 'unread_counts': unread_counts})
+    return {
+        "rooms": serializer.data,
+        "next_cursor": encode_cursor(rooms[-1].activity_at, rooms[-1].id) if has_more else None,
+    }
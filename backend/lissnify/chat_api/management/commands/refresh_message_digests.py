@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from chat_api.digest import refresh_message_digests
+
+
+class Command(BaseCommand):
+    help = (
+        "Bring community room digests up to date and push the changed ones to members. "
+        "Run from cron every minute or so; only rooms with a message in the last "
+        "--since-minutes are looked at."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since-minutes', type=int, default=60, help="Rooms with a message this recent; 0 for every room",
+        )
+
+    def handle(self, *args, **options):
+        minutes = options['since_minutes']
+        refreshed = refresh_message_digests(timedelta(minutes=minutes) if minutes else None)
+        self.stdout.write(self.style.SUCCESS(f"Refreshed {refreshed} digests"))
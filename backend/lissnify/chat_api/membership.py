@@ -0,0 +1,177 @@
+# chat_api/membership.py
+"""
+Cached room membership: user id -> set of chat room ids.
+
+Every "is this user in this room" check goes through `is_room_member` so a
+reconnect storm costs one query per user instead of one join per socket.
+Entries expire after MEMBERSHIP_TTL and are dropped whenever
+`ChatRoom.participants` changes (see the receivers at the bottom).
+"""
+import threading
+import time
+import traceback
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, pre_delete
+from django.dispatch import receiver
+
+from .cache import get_redis
+from .models import ChatRoom
+
+MEMBERSHIP_TTL = 5 * 60
+
+
+class MemoryMembershipCache:
+    """Per-process cache used when the channel layer isn't Redis (tests, local dev)"""
+
+    def __init__(self):
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._rooms.get(user_id)
+            if entry is None:
+                return None
+            expires_at, room_ids = entry
+            if expires_at <= time.monotonic():
+                del self._rooms[user_id]
+                return None
+            return room_ids
+
+    def set(self, user_id, room_ids):
+        with self._lock:
+            self._rooms[user_id] = (time.monotonic() + MEMBERSHIP_TTL, frozenset(room_ids))
+
+    def delete(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._rooms.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+
+
+class RedisMembershipCache:
+    """One string per user, `chat:rooms:<user_id>`, holding comma separated room ids"""
+
+    def __init__(self, client):
+        self.client = client
+
+    @staticmethod
+    def key(user_id):
+        return f"chat:rooms:{user_id}"
+
+    def get(self, user_id):
+        value = self.client.get(self.key(user_id))
+        if value is None:
+            return None
+        return frozenset(int(room_id) for room_id in value.split(',') if room_id)
+
+    def set(self, user_id, room_ids):
+        # An empty string still marks "member of no rooms" as cached
+        self.client.set(self.key(user_id), ','.join(str(room_id) for room_id in room_ids), ex=MEMBERSHIP_TTL)
+
+    def delete(self, user_ids):
+        keys = [self.key(user_id) for user_id in user_ids]
+        if keys:
+            self.client.delete(*keys)
+
+
+_cache = None
+
+
+def get_membership_cache():
+    global _cache
+    if _cache is None:
+        client = get_redis()
+        _cache = RedisMembershipCache(client) if client is not None else MemoryMembershipCache()
+    return _cache
+
+
+def get_user_room_ids(user):
+    """Ids of every chat room `user` participates in, from the cache or one query"""
+    cache = get_membership_cache()
+    try:
+        room_ids = cache.get(user.u_id)
+    except Exception:
+        traceback.print_exc()
+        room_ids = None
+    if room_ids is not None:
+        return room_ids
+
+    room_ids = frozenset(
+        ChatRoom.participants.through.objects.filter(user_id=user.u_id).values_list('chatroom_id', flat=True)
+    )
+    try:
+        cache.set(user.u_id, room_ids)
+    except Exception:
+        traceback.print_exc()
+    return room_ids
+
+
+def is_room_member(user, room_id):
+    try:
+        return int(room_id) in get_user_room_ids(user)
+    except (TypeError, ValueError):
+        return False
+
+
+def member_room_ids(user, room_ids):
+    """
+    The ids among `room_ids` that `user` participates in. Answered from the
+    cache when it holds the user's rooms; a miss looks up only `room_ids`
+    instead of loading every room the user is in.
+    """
+    room_ids = set(room_ids)
+    if not room_ids:
+        return set()
+    try:
+        cached = get_membership_cache().get(user.u_id)
+    except Exception:
+        traceback.print_exc()
+        cached = None
+    if cached is not None:
+        return room_ids & cached
+    return set(
+        ChatRoom.participants.through.objects.filter(user_id=user.u_id, chatroom_id__in=room_ids)
+        .values_list('chatroom_id', flat=True)
+    )
+
+
+def invalidate_memberships(user_ids):
+    """Drop cached rooms for `user_ids`, now and again once the transaction commits"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+
+    def drop():
+        try:
+            get_membership_cache().delete(user_ids)
+        except Exception:
+            traceback.print_exc()
+
+    # Dropping right away covers reads later in this transaction; dropping on
+    # commit covers anyone who re-cached the old rooms in between
+    drop()
+    transaction.on_commit(drop)
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # user.chat_rooms.add/remove/clear: only that user's rooms changed
+        invalidate_memberships([instance.pk])
+    elif action == 'pre_clear':
+        invalidate_memberships(instance.participants.values_list('u_id', flat=True))
+    else:
+        invalidate_memberships(pk_set or [])
+
+
+@receiver(pre_delete, sender=ChatRoom)
+def room_deleted(sender, instance, **kwargs):
+    # Deleting a room cascades to the participants table without m2m_changed
+    invalidate_memberships(instance.participants.values_list('u_id', flat=True))
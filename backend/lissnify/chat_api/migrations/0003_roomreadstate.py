@@ -0,0 +1,73 @@
+# Generated by Django 5.2.6 on 2026-10-18 12:31
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def backfill_read_states(apps, schema_editor):
+    """Seed each participant's watermark with the newest message they have a receipt for"""
+    MessageReadStatus = apps.get_model('chat_api', 'MessageReadStatus')
+    RoomReadState = apps.get_model('chat_api', 'RoomReadState')
+
+    latest_reads = (
+        MessageReadStatus.objects
+        .values('user_id', 'message__room_id')
+        .annotate(last_read=Max('message_id'))
+        .order_by()
+    )
+    RoomReadState.objects.bulk_create(
+        (
+            RoomReadState(
+                room_id=row['message__room_id'],
+                user_id=row['user_id'],
+                last_read_message_id=row['last_read'],
+            )
+            for row in latest_reads.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_api', '0002_messagereadstatus'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='per_message_receipts',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'id'], name='chat_message_room_id_idx'),
+        ),
+        migrations.AddField(
+            model_name='roomreadstate',
+            name='room',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat_api.chatroom'),
+        ),
+        migrations.AddField(
+            model_name='roomreadstate',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='room_read_states', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='roomreadstate',
+            unique_together={('room', 'user')},
+        ),
+        migrations.RunPython(backfill_read_states, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,84 @@
+# Generated by Django 5.2.6 on 2026-10-18 12:42
+
+import django.db.models.deletion
+from django.conf import settings
+from collections import defaultdict
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def merge_direct_rooms(apps, schema_editor):
+    """
+    Normalise the one-to-one room type, give every two-person direct room its
+    canonical pair and fold duplicate rooms for the same pair into the oldest.
+    """
+    ChatRoom = apps.get_model('chat_api', 'ChatRoom')
+    Message = apps.get_model('chat_api', 'Message')
+    RoomReadState = apps.get_model('chat_api', 'RoomReadState')
+    Participants = ChatRoom.participants.through
+
+    # StartDirectChatView used to create rooms as 'one_to_one', outside the choices
+    ChatRoom.objects.filter(type='one_to_one').update(type='one-to-one')
+
+    members = defaultdict(list)
+    rows = Participants.objects.filter(chatroom__type='one-to-one').values_list('chatroom_id', 'user_id')
+    for room_id, user_id in rows.iterator():
+        members[room_id].append(user_id)
+
+    rooms_by_pair = defaultdict(list)
+    for room_id, user_ids in members.items():
+        if len(set(user_ids)) == 2:
+            rooms_by_pair[tuple(sorted(set(user_ids)))].append(room_id)
+
+    try:
+        Notification = apps.get_model('api', 'Notification')
+    except LookupError:
+        Notification = None
+
+    for (low, high), room_ids in rooms_by_pair.items():
+        keep, *duplicates = sorted(room_ids)
+        if duplicates:
+            Message.objects.filter(room_id__in=duplicates).update(room_id=keep)
+            if Notification is not None:
+                Notification.objects.filter(chat_room_id__in=duplicates).update(chat_room_id=keep)
+
+            # Watermarks are message ids, so the merged room keeps the furthest one
+            watermarks = (
+                RoomReadState.objects.filter(room_id__in=room_ids)
+                .values('user_id').annotate(last_read=Max('last_read_message_id')).order_by()
+            )
+            for row in watermarks:
+                RoomReadState.objects.update_or_create(
+                    room_id=keep, user_id=row['user_id'],
+                    defaults={'last_read_message_id': row['last_read']},
+                )
+            ChatRoom.objects.filter(id__in=duplicates).delete()
+
+        ChatRoom.objects.filter(id=keep).update(min_user_id=low, max_user_id=high)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_api', '0003_roomreadstate'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='max_user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='min_user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(merge_direct_rooms, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chatroom',
+            constraint=models.UniqueConstraint(condition=models.Q(('max_user__isnull', False), ('min_user__isnull', False)), fields=('min_user', 'max_user'), name='chat_room_direct_pair_uniq'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.6 on 2026-10-18 12:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def number_existing_messages(apps, schema_editor):
+    """
+    Number existing messages 1..n per room in id order, start each room's
+    counter after its last message and stamp every watermark with that.
+    """
+    qn = schema_editor.connection.ops.quote_name
+    message = qn(apps.get_model('chat_api', 'Message')._meta.db_table)
+    room = qn(apps.get_model('chat_api', 'ChatRoom')._meta.db_table)
+    read_state = qn(apps.get_model('chat_api', 'RoomReadState')._meta.db_table)
+
+    schema_editor.execute(
+        f"UPDATE {message} SET seq = numbered.rn FROM ("
+        f"  SELECT id, ROW_NUMBER() OVER (PARTITION BY room_id ORDER BY id) AS rn FROM {message}"
+        f") AS numbered WHERE {message}.id = numbered.id"
+    )
+    schema_editor.execute(
+        f"UPDATE {room} SET last_seq = COALESCE("
+        f"  (SELECT MAX(seq) FROM {message} WHERE {message}.room_id = {room}.id), 0)"
+    )
+    schema_editor.execute(
+        f"UPDATE {read_state} SET seq = (SELECT last_seq FROM {room} WHERE {room}.id = {read_state}.room_id)"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_api', '0004_direct_room_pair'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='roomreadstate',
+            name='seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(number_existing_messages, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='roomreadstate',
+            index=models.Index(fields=['room', 'seq'], name='chat_readstate_room_seq_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='chat_message_room_seq_uniq'),
+        ),
+    ]
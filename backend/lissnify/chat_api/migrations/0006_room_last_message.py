@@ -0,0 +1,49 @@
+# Generated by Django 5.2.6 on 2026-10-18 12:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_last_messages(apps, schema_editor):
+    """Point every room at its newest message"""
+    qn = schema_editor.connection.ops.quote_name
+    message = qn(apps.get_model('chat_api', 'Message')._meta.db_table)
+    room = qn(apps.get_model('chat_api', 'ChatRoom')._meta.db_table)
+
+    schema_editor.execute(
+        f"UPDATE {room} SET last_message_id = (SELECT MAX(id) FROM {message} WHERE {message}.room_id = {room}.id)"
+    )
+    schema_editor.execute(
+        f"UPDATE {room} SET"
+        f"  last_message_at = (SELECT timestamp FROM {message} WHERE {message}.id = {room}.last_message_id),"
+        f"  last_message_preview = COALESCE((SELECT CASE WHEN LENGTH(content) > 100"
+        f"    THEN SUBSTR(content, 1, 100) || '...' ELSE content END"
+        f"    FROM {message} WHERE {message}.id = {room}.last_message_id), '')"
+        f" WHERE last_message_id IS NOT NULL"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_api', '0005_room_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat_api.message'),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_preview',
+            field=models.CharField(blank=True, default='', max_length=120),
+        ),
+        migrations.RunPython(fill_last_messages, migrations.RunPython.noop),
+    ]
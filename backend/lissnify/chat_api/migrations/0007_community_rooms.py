@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 12:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_api', '0006_room_last_message'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatroom',
+            name='type',
+            field=models.CharField(choices=[('one-to-one', 'One-to-One'), ('group', 'Group'), ('community', 'Community')], default='one-to-one', max_length=20),
+        ),
+    ]
@@ -6,11 +6,41 @@ class ChatRoom(models.Model):
     ROOM_TYPE_CHOICES = (
         ('one-to-one', 'One-to-One'),
         ('group', 'Group'),
+        ('community', 'Community'),
     )
+    # Rooms too large to fan each message out per member: messages are
+    # stored once, unread counts come from read watermarks and notifications
+    # from a per-member digest kept up to date by a periodic job (chat_api.digest)
+    LAZY_FAN_OUT_TYPES = ('community',)
     name=models.CharField(max_length=255, blank=True, null=True)
     type=models.CharField(max_length=20, choices=ROOM_TYPE_CHOICES, default='one-to-one')
     participants=models.ManyToManyField(User, related_name='chat_rooms')
     created_at=models.DateTimeField(auto_now_add=True)
+    # Unread state lives in RoomReadState; per-message receipts are opt-in
+    per_message_receipts=models.BooleanField(default=False)
+    # Canonical pair for one-to-one rooms (lower u_id first), unique per pair
+    min_user=models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    max_user=models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    # Last sequence number handed out in this room; every message and every
+    # read watermark advance takes the next one
+    last_seq=models.BigIntegerField(default=0)
+    # Denormalised by the send path for the inbox: newest message and a preview of it
+    last_message=models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_at=models.DateTimeField(null=True, blank=True)
+    last_message_preview=models.CharField(max_length=120, blank=True, default='')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['min_user', 'max_user'],
+                condition=models.Q(min_user__isnull=False, max_user__isnull=False),
+                name='chat_room_direct_pair_uniq',
+            ),
+        ]
+
+    @property
+    def lazy_fan_out(self):
+        return self.type in self.LAZY_FAN_OUT_TYPES
 
     def __str__(self):
         if self.type == 'community' and self.name:
@@ -22,9 +52,16 @@ class Message(models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='authored_messages')
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    seq = models.BigIntegerField(null=True, blank=True)
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['room', 'id'], name='chat_message_room_id_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'seq'], name='chat_message_room_seq_uniq'),
+        ]
 
     def __str__(self):
         return f"{self.author.full_name}: {self.content[:20]}"
@@ -40,4 +77,22 @@ class MessageReadStatus(models.Model):
         ordering = ['-read_at']
     
     def __str__(self):
-        return f"{self.user.full_name} read message {self.message.id}"    
\ No newline at end of file
+        return f"{self.user.full_name} read message {self.message.id}"
+
+class RoomReadState(models.Model):
+    """Per-participant read watermark: every message up to last_read_message_id is read"""
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_states')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='room_read_states')
+    last_read_message_id = models.BigIntegerField(default=0)
+    # Room sequence number of the latest advance
+    seq = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('room', 'user')
+        indexes = [
+            models.Index(fields=['room', 'seq'], name='chat_readstate_room_seq_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.full_name} read room {self.room_id} up to {self.last_read_message_id}"
@@ -0,0 +1,175 @@
+# chat_api/multiplex.py
+import traceback
+
+from channels.db import database_sync_to_async
+
+from notification_api.consumer import NotificationConsumer
+from .consumer import RoomEventsMixin, room_group_name
+from .membership import member_room_ids
+
+# Frames handled exactly as on /ws/notifications/
+NOTIFICATION_ACTIONS = ('mark_read', 'get_unread_count')
+
+
+class MultiplexConsumer(RoomEventsMixin, NotificationConsumer):
+    """
+    One socket per client for all of its rooms and its notifications.
+
+    Clients join rooms with {"type": "subscribe", "room_ids": [...]} (or a
+    single "room_id") and leave with "unsubscribe"; a subscribe can carry
+    "cursors": {room_id: since_seq} to replay what was missed. Room actions take the
+    same fields as on /ws/chat/<room_id>/ plus "room_id"; room events come
+    back tagged with their "room_id". Notifications arrive as they do on
+    /ws/notifications/.
+
+    Subscribing alone doesn't count as viewing a room: a client sends
+    {"type": "focus", "room_id": ...} for the room it has on screen (one at
+    a time) and "blur" when it leaves it, and only then is the room's
+    persistent message notification skipped for this user.
+    """
+
+    async def connect(self):
+        self.user = self.scope.get("user")
+        self.rooms = set()
+        self.pending_acks = set()
+
+        if not self.user or not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.notification_group_name = f'notifications_{self.user.u_id}'
+        await self.channel_layer.group_add(self.notification_group_name, self.channel_name)
+        await self.accept_connection()
+        await self.presence_connected()
+
+    async def disconnect(self, close_code):
+        for room_id in self.rooms:
+            await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+        self.rooms.clear()
+        if hasattr(self, 'notification_group_name'):
+            await self.channel_layer.group_discard(self.notification_group_name, self.channel_name)
+        await self.presence_disconnected()
+        self.stop_outbound()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            payload = self.decode_frame(text_data, bytes_data)
+            message_type = payload.get("type")
+
+            if message_type in NOTIFICATION_ACTIONS:
+                await super().receive(text_data, bytes_data)
+            elif message_type == "subscribe":
+                await self.subscribe(self.room_ids_of(payload), self.cursors_of(payload))
+            elif message_type == "unsubscribe":
+                await self.unsubscribe(self.room_ids_of(payload))
+            else:
+                await self.handle_room_action(message_type, payload)
+
+        except Exception:
+            traceback.print_exc()
+
+    async def handle_room_action(self, message_type, payload):
+        room_ids = self.room_ids_of(payload)
+        room_id = room_ids[0] if len(room_ids) == 1 else None
+        if room_id not in self.rooms:
+            await self.send_error("Subscribe to the room first.", room_id)
+            return
+
+        if message_type == "send_message":
+            await self.send_room_message(room_id, payload)
+        elif message_type in ("mark_messages_read", "mark_specific_messages"):
+            await self.mark_room_messages_read(room_id, payload.get("message_ids", []))
+        elif message_type == "read_messages":
+            await self.read_room(room_id)
+        elif message_type == "typing":
+            await self.update_typing(room_id, bool(payload.get("is_typing", True)))
+        elif message_type == "get_presence":
+            await self.send_presence_state(room_id)
+        elif message_type == "sync":
+            await self.send_room_changes(room_id, payload.get("since_seq", 0))
+        elif message_type == "focus":
+            await self.focus_room(room_id)
+        elif message_type == "blur":
+            await self.stop_viewing(room_id)
+        else:
+            await self.send_error(f"Unknown message type '{message_type}'.", room_id)
+
+    async def subscribe(self, room_ids, cursors=None):
+        """
+        Join every room in `room_ids` the user belongs to, checked with one
+        membership lookup of just those rooms, then replay what was missed in
+        rooms with a cursor.
+        """
+        member_of = await self.get_member_room_ids(room_ids)
+        joined = [room_id for room_id in room_ids if room_id in member_of]
+        for room_id in joined:
+            if room_id not in self.rooms:
+                await self.channel_layer.group_add(room_group_name(room_id), self.channel_name)
+                self.rooms.add(room_id)
+
+        await self.send_frame({
+            "type": "subscribed",
+            "room_ids": joined,
+            "rejected": [room_id for room_id in room_ids if room_id not in member_of],
+        })
+
+        for room_id in joined:
+            if cursors and room_id in cursors:
+                await self.send_room_changes(room_id, cursors[room_id])
+
+    async def unsubscribe(self, room_ids):
+        left = [room_id for room_id in room_ids if room_id in self.rooms]
+        for room_id in left:
+            await self.channel_layer.group_discard(room_group_name(room_id), self.channel_name)
+            await self.stop_viewing(room_id)
+            self.rooms.discard(room_id)
+
+        await self.send_frame({
+            "type": "unsubscribed",
+            "room_ids": left,
+        })
+
+    async def focus_room(self, room_id):
+        """View `room_id`, and stop viewing the room focused before it"""
+        for other in list(self.viewed_rooms):
+            if other != room_id:
+                await self.stop_viewing(other)
+        await self.start_viewing(room_id)
+
+    async def send_error(self, error, room_id=None):
+        await self.send_frame({
+            "type": "error",
+            "room_id": room_id,
+            "error": error,
+        })
+
+    @staticmethod
+    def room_ids_of(payload):
+        room_ids = payload.get("room_ids")
+        if room_ids is None:
+            room_ids = [payload.get("room_id")]
+        cleaned = []
+        for room_id in room_ids:
+            try:
+                cleaned.append(int(room_id))
+            except (TypeError, ValueError):
+                continue
+        return cleaned
+
+    @staticmethod
+    def cursors_of(payload):
+        """{room_id: since_seq} from "cursors", or from "since_seq" for a single room"""
+        cursors = {}
+        raw = payload.get("cursors")
+        if raw is None and payload.get("since_seq") is not None:
+            raw = {payload.get("room_id"): payload.get("since_seq")}
+        for room_id, since_seq in (raw or {}).items():
+            try:
+                cursors[int(room_id)] = since_seq
+            except (TypeError, ValueError):
+                continue
+        return cursors
+
+    @database_sync_to_async
+    def get_member_room_ids(self, room_ids):
+        return member_room_ids(self.user, room_ids)
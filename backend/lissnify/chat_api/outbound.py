@@ -0,0 +1,142 @@
+# chat_api/outbound.py
+"""
+Per-connection outbound queues for the chat and notification sockets.
+
+Group events are handed to a queue and written to the socket by a
+per-connection flush task, so handlers never wait on encoding and sending.
+Frames go out as soon as the flush task is free. State-like frames (read
+receipts, typing, presence, unread counts) that queue up while it is busy
+are merged with newer ones instead of piling up. Once CHAT_OUTBOUND_MAX_QUEUE
+frames are waiting, the oldest droppable one is shed for each new frame.
+
+This is not slow-client detection. Under daphne a consumer's `send()`
+returns once the frame is handed to the server, not when the client has
+read it, and nothing about the server's or the kernel's socket buffers is
+visible to the application. So a client that stops reading never fills
+this queue. The queue only backs up while the flush task itself is held
+up, e.g. by a slow encoder or a busy event loop. Clients that stop reading
+are dropped by the server's ping timeout (daphne's --ping-timeout).
+"""
+import asyncio
+import itertools
+import traceback
+import weakref
+from collections import OrderedDict
+
+from django.conf import settings
+
+# Frames that may be dropped when a queue is full, oldest first
+DROPPABLE_TYPES = ('messages_read', 'message_read', 'typing', 'presence')
+
+
+def coalesce_key(payload):
+    """Queue key under which a newer frame replaces or merges into an older one, or None"""
+    frame_type = payload.get('type')
+    if frame_type == 'messages_read':
+        return ('messages_read', payload.get('room_id'), payload.get('user_id'))
+    if frame_type == 'typing':
+        return ('typing', payload.get('room_id'))
+    if frame_type == 'presence':
+        return ('presence', payload.get('room_id'), payload.get('user_id'))
+    if frame_type == 'unread_count':
+        return ('unread_count',)
+    return None
+
+
+def merge_frames(queued, payload):
+    """Fold `payload` into a queued frame with the same coalesce key"""
+    if payload.get('type') != 'messages_read':
+        return payload
+    message_ids = sorted(set(queued.get('message_ids', [])) | set(payload.get('message_ids', [])))
+    return {
+        **payload,
+        "message_ids": message_ids,
+        "first_message_id": message_ids[0] if message_ids else None,
+        "last_message_id": message_ids[-1] if message_ids else None,
+        "seq": max(queued.get('seq') or 0, payload.get('seq') or 0) or None,
+    }
+
+
+class OutboundStats:
+    """Process-wide view of the outbound queues, served by OutboundQueueStatsView"""
+
+    def __init__(self):
+        self.connections = weakref.WeakSet()
+        self.dropped = 0
+        self.coalesced = 0
+
+    def snapshot(self):
+        depths = [len(consumer.outbound_frames) for consumer in list(self.connections)]
+        return {
+            "connections": len(depths),
+            "queued_frames": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "coalesced_frames": self.coalesced,
+            "dropped_frames": self.dropped,
+        }
+
+
+outbound_stats = OutboundStats()
+
+
+class OutboundQueueMixin:
+    """
+    Queues `send_frame` calls and writes them from a flush task. Sits in
+    front of WireProtocolMixin, which does the actual encoding and sending.
+    Call `stop_outbound` on disconnect.
+    """
+
+    outbound_frames = ()
+
+    async def send_frame(self, payload):
+        if not isinstance(self.outbound_frames, OrderedDict):
+            self.start_outbound()
+
+        frames = self.outbound_frames
+        key = coalesce_key(payload)
+        if key is not None and key in frames:
+            # Re-queue at the back so it still follows whatever it refers to
+            frames[key] = merge_frames(frames.pop(key), payload)
+            outbound_stats.coalesced += 1
+        else:
+            if len(frames) >= settings.CHAT_OUTBOUND_MAX_QUEUE:
+                self.make_outbound_room()
+            frames[key if key is not None else ('frame', next(self.outbound_counter))] = payload
+        self.outbound_ready.set()
+
+    def start_outbound(self):
+        self.outbound_frames = OrderedDict()
+        self.outbound_counter = itertools.count()
+        self.outbound_ready = asyncio.Event()
+        self.outbound_task = asyncio.ensure_future(self.flush_outbound())
+        outbound_stats.connections.add(self)
+
+    def stop_outbound(self):
+        task = getattr(self, 'outbound_task', None)
+        if task is not None:
+            task.cancel()
+            self.outbound_task = None
+        outbound_stats.connections.discard(self)
+
+    def make_outbound_room(self):
+        """Drop the oldest droppable frame, if there is one"""
+        for key, payload in self.outbound_frames.items():
+            if payload.get('type') in DROPPABLE_TYPES:
+                del self.outbound_frames[key]
+                outbound_stats.dropped += 1
+                return
+
+    async def flush_outbound(self):
+        frames = self.outbound_frames
+        while True:
+            await self.outbound_ready.wait()
+            self.outbound_ready.clear()
+
+            while frames:
+                _, payload = frames.popitem(last=False)
+                try:
+                    await super().send_frame(payload)
+                except Exception:
+                    traceback.print_exc()
+                    self.stop_outbound()
+                    return
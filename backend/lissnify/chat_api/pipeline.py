@@ -0,0 +1,120 @@
+# chat_api/pipeline.py
+from django.db import transaction
+from django.db.models import Q
+
+from api.notifications import create_message_notifications
+from .models import ChatRoom, Message, MessageReadStatus
+from .presence import room_viewers
+from .sequence import allocate_seq
+from .unread import count_new_message, get_room_unread_counts
+
+
+def send_message(author, room_id, content):
+    """
+    Persist a chat message together with the sender's receipt and the
+    recipients' notifications in one transaction. Recipients viewing the
+    room get the message live and no notification.
+
+    Recipients and viewers are looked up before the transaction, and the
+    room's sequence number is taken as its last write: allocate_seq locks the
+    room row until commit, so nothing slow may run after it.
+
+    Returns (the `new_message` group event, the created notifications), or
+    (None, []) if the room does not exist.
+    """
+    room = ChatRoom.objects.filter(id=room_id).first()
+    if room is None:
+        return None, []
+    participant_ids, recipient_ids = message_recipients(room, author)
+    notify_ids = notification_recipients(room.id, recipient_ids)
+
+    with transaction.atomic():
+        message = Message.objects.create(author=author, room=room, content=content)
+
+        # Own messages never count as unread; only rooms that keep
+        # per-message receipts need a row for the sender
+        if room.per_message_receipts:
+            MessageReadStatus.objects.create(message=message, user=author)
+
+        notifications = create_message_notifications(message, notify_ids)
+
+        message.seq = allocate_seq(room.id)
+        Message.objects.filter(id=message.id).update(seq=message.seq)
+        record_last_messages([message])
+
+    if room.lazy_fan_out:
+        return new_message_event(message, None), notifications
+
+    count_new_message(room.id, recipient_ids)
+    unread_counts = get_room_unread_counts(room.id, participant_ids)
+    return new_message_event(message, unread_counts), notifications
+
+
+def notification_recipients(room_id, recipient_ids):
+    """Recipients who need a persistent notification: those not viewing the room right now"""
+    if not recipient_ids:
+        return []
+    viewing = room_viewers(room_id)
+    return [u_id for u_id in recipient_ids if u_id not in viewing]
+
+
+def message_recipients(room, author):
+    """
+    (participant ids, recipient ids) to fan a new message out to. Lazily
+    fanned-out rooms have none: the message is stored once and nobody gets a
+    row, counter or count per message.
+    """
+    if room.lazy_fan_out:
+        return [], []
+    participant_ids = list(room.participants.values_list('u_id', flat=True))
+    return participant_ids, [u_id for u_id in participant_ids if u_id != author.u_id]
+
+
+def message_preview(content):
+    """Inbox preview of a message: its first 100 characters"""
+    content = ' '.join(content.split())
+    return content[:100] + "..." if len(content) > 100 else content
+
+
+def record_last_messages(messages):
+    """
+    Point each room's denormalised activity columns at the newest of
+    `messages`. A room that already shows a newer message (a higher id) is
+    left alone, so concurrent and out-of-order batches can't move it back.
+    """
+    latest = {}
+    for message in messages:
+        if message.room_id not in latest or message.id > latest[message.room_id].id:
+            latest[message.room_id] = message
+
+    for room_id, message in latest.items():
+        ChatRoom.objects.filter(
+            Q(last_message_id__isnull=True) | Q(last_message_id__lt=message.id), id=room_id,
+        ).update(
+            last_message=message,
+            last_message_at=message.timestamp,
+            last_message_preview=message_preview(message.content),
+        )
+
+
+def new_message_event(message, unread_counts):
+    """
+    Group event for a new message, carrying every participant's unread count.
+    `unread_counts` is None for lazily fanned-out rooms, whose sockets don't
+    get a count with each message.
+    """
+    return {
+        "type": "chat_message",
+        "message_type": "new_message",
+        "room_id": message.room_id,
+        "message": message.content,
+        "author": message.author.username,
+        "author_id": message.author_id,
+        "author_full_name": message.author.full_name,
+        "message_id": message.id,
+        "seq": message.seq,
+        "timestamp": message.timestamp.isoformat(),
+        "unread_counts": (
+            {str(u_id): count for u_id, count in unread_counts.items()} if unread_counts is not None else None
+        ),
+    }
@@ -0,0 +1,397 @@
+# chat_api/presence.py
+"""
+Online and typing state with TTL expiry.
+
+A user is online while any of their sockets (chat, multiplexed or
+notifications) is registered; every socket refreshes its entry well within
+PRESENCE_TTL, so a worker that dies without disconnecting drops out on its
+own. A socket with a room on screen (a chat socket, or a multiplexed one
+that sent a "focus" frame for it) also registers as viewing that room,
+under the same TTL; the send path skips persistent notifications for
+anyone viewing the room.
+Typing marks expire after TYPING_TTL unless the client keeps sending typing
+frames, and broadcasts of a room's typing state are limited to one per
+TYPING_BROADCAST_INTERVAL across all workers.
+
+Online/offline transitions are pushed only to rooms that fan out eagerly. In
+a community room every member's transition would go to every member, so
+there presence is pull-only (`get_presence`, RoomPresenceView). Store calls
+touch Redis, not the database, so they run in the thread pool rather than
+queueing behind ORM work on the thread-sensitive executor.
+"""
+import asyncio
+import threading
+import time
+import traceback
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+
+from .cache import get_redis
+from .models import ChatRoom
+
+PRESENCE_TTL = 60
+PRESENCE_REFRESH = PRESENCE_TTL / 3
+TYPING_TTL = 6
+TYPING_BROADCAST_INTERVAL = 2
+
+
+class MemoryPresenceStore:
+    """In-process stand-in used when the channel layer isn't Redis (tests, local dev)"""
+
+    def __init__(self):
+        self._connections = {}
+        self._typing = {}
+        self._viewing = {}
+        self._gates = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _live(entries, now):
+        for key in [key for key, expires_at in entries.items() if expires_at <= now]:
+            del entries[key]
+        return entries
+
+    def connect(self, user_id, channel_name):
+        now = time.time()
+        with self._lock:
+            connections = self._live(self._connections.setdefault(user_id, {}), now)
+            was_online = bool(connections)
+            connections[channel_name] = now + PRESENCE_TTL
+            return not was_online
+
+    def refresh(self, user_id, channel_name):
+        with self._lock:
+            connections = self._connections.get(user_id, {})
+            if channel_name in connections:
+                connections[channel_name] = time.time() + PRESENCE_TTL
+
+    def disconnect(self, user_id, channel_name):
+        with self._lock:
+            connections = self._connections.get(user_id, {})
+            connections.pop(channel_name, None)
+            return not self._live(connections, time.time())
+
+    def online(self, user_ids):
+        now = time.time()
+        with self._lock:
+            return {user_id for user_id in user_ids if self._live(self._connections.get(user_id, {}), now)}
+
+    def set_typing(self, room_id, user_id, is_typing):
+        with self._lock:
+            typing = self._typing.setdefault(room_id, {})
+            if is_typing:
+                typing[user_id] = time.time() + TYPING_TTL
+            else:
+                typing.pop(user_id, None)
+
+    def typing(self, room_id):
+        with self._lock:
+            return set(self._live(self._typing.get(room_id, {}), time.time()))
+
+    def view(self, room_id, user_id, channel_name):
+        with self._lock:
+            self._viewing.setdefault(room_id, {})[(user_id, channel_name)] = time.time() + PRESENCE_TTL
+
+    def leave(self, room_id, user_id, channel_name):
+        with self._lock:
+            self._viewing.get(room_id, {}).pop((user_id, channel_name), None)
+
+    def viewers(self, room_id):
+        with self._lock:
+            return {user_id for user_id, _ in self._live(self._viewing.get(room_id, {}), time.time())}
+
+    def acquire_gate(self, key, seconds):
+        now = time.time()
+        with self._lock:
+            if self._gates.get(key, 0) > now:
+                return False
+            self._gates[key] = now + seconds
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._connections.clear()
+            self._typing.clear()
+            self._viewing.clear()
+            self._gates.clear()
+
+
+class RedisPresenceStore:
+    """
+    `chat:presence:<user_id>` is a sorted set of the user's sockets scored by
+    expiry; `chat:typing:<room_id>` the same for users typing in a room and
+    `chat:viewing:<room_id>` for "<user_id>:<channel>" sockets viewing it.
+    """
+
+    # Returns how many live sockets the user had before this one
+    CONNECT_SCRIPT = """
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+        local before = redis.call('ZCARD', KEYS[1])
+        redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        return before
+    """
+    # Returns how many live sockets the user has left
+    DISCONNECT_SCRIPT = """
+        redis.call('ZREM', KEYS[1], ARGV[2])
+        redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+        return redis.call('ZCARD', KEYS[1])
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._connect = client.register_script(self.CONNECT_SCRIPT)
+        self._disconnect = client.register_script(self.DISCONNECT_SCRIPT)
+
+    @staticmethod
+    def key(user_id):
+        return f"chat:presence:{user_id}"
+
+    @staticmethod
+    def typing_key(room_id):
+        return f"chat:typing:{room_id}"
+
+    @staticmethod
+    def viewing_key(room_id):
+        return f"chat:viewing:{room_id}"
+
+    def connect(self, user_id, channel_name):
+        now = time.time()
+        before = self._connect(
+            keys=[self.key(user_id)],
+            args=[now, now + PRESENCE_TTL, channel_name, PRESENCE_TTL],
+        )
+        return int(before) == 0
+
+    def refresh(self, user_id, channel_name):
+        pipe = self.client.pipeline()
+        pipe.zadd(self.key(user_id), {channel_name: time.time() + PRESENCE_TTL}, xx=True)
+        pipe.expire(self.key(user_id), PRESENCE_TTL)
+        pipe.execute()
+
+    def disconnect(self, user_id, channel_name):
+        remaining = self._disconnect(keys=[self.key(user_id)], args=[time.time(), channel_name])
+        return int(remaining) == 0
+
+    def online(self, user_ids):
+        user_ids = list(user_ids)
+        now = time.time()
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zcount(self.key(user_id), now, '+inf')
+        return {user_id for user_id, count in zip(user_ids, pipe.execute()) if count}
+
+    def set_typing(self, room_id, user_id, is_typing):
+        pipe = self.client.pipeline()
+        if is_typing:
+            pipe.zadd(self.typing_key(room_id), {user_id: time.time() + TYPING_TTL})
+            pipe.expire(self.typing_key(room_id), TYPING_TTL)
+        else:
+            pipe.zrem(self.typing_key(room_id), user_id)
+        pipe.execute()
+
+    def typing(self, room_id):
+        return {int(user_id) for user_id in self.client.zrangebyscore(self.typing_key(room_id), time.time(), '+inf')}
+
+    def view(self, room_id, user_id, channel_name):
+        pipe = self.client.pipeline()
+        pipe.zadd(self.viewing_key(room_id), {f"{user_id}:{channel_name}": time.time() + PRESENCE_TTL})
+        pipe.expire(self.viewing_key(room_id), PRESENCE_TTL)
+        pipe.execute()
+
+    def leave(self, room_id, user_id, channel_name):
+        self.client.zrem(self.viewing_key(room_id), f"{user_id}:{channel_name}")
+
+    def viewers(self, room_id):
+        sockets = self.client.zrangebyscore(self.viewing_key(room_id), time.time(), '+inf')
+        return {int(socket.partition(':')[0]) for socket in sockets}
+
+    def acquire_gate(self, key, seconds):
+        return bool(self.client.set(f"chat:gate:{key}", 1, nx=True, px=int(seconds * 1000)))
+
+
+_store = None
+
+
+def get_presence_store():
+    global _store
+    if _store is None:
+        client = get_redis()
+        _store = RedisPresenceStore(client) if client is not None else MemoryPresenceStore()
+    return _store
+
+
+def room_presence(room_id):
+    """Who of `room_id`'s participants is online and who is typing, in one call"""
+    participant_ids = list(ChatRoom.participants.through.objects.filter(chatroom_id=room_id).values_list('user_id', flat=True))
+    store = get_presence_store()
+    try:
+        online = store.online(participant_ids)
+        typing = store.typing(int(room_id)) & online
+    except Exception:
+        traceback.print_exc()
+        online, typing = set(), set()
+    return {
+        "room_id": int(room_id),
+        "online": sorted(online),
+        "typing": sorted(typing),
+    }
+
+
+def presence_room_ids(user):
+    """Ids of `user`'s rooms that are pushed their online/offline transitions; community rooms are not"""
+    return list(
+        ChatRoom.objects.filter(participants=user)
+        .exclude(type__in=ChatRoom.LAZY_FAN_OUT_TYPES)
+        .values_list('id', flat=True)
+    )
+
+
+def room_viewers(room_id):
+    """Ids of users with a socket in `room_id` right now; empty if the store is unreachable"""
+    try:
+        return get_presence_store().viewers(int(room_id))
+    except Exception:
+        traceback.print_exc()
+        return set()
+
+
+def presence_event(room_id, user_id, online):
+    """Group event for a participant coming online or going offline"""
+    return {
+        "type": "chat_message",
+        "message_type": "presence",
+        "room_id": int(room_id),
+        "user_id": user_id,
+        "online": online,
+    }
+
+
+def typing_event(room_id, typing_user_ids):
+    """Group event carrying everyone currently typing in `room_id`"""
+    return {
+        "type": "chat_message",
+        "message_type": "typing",
+        "room_id": int(room_id),
+        "user_ids": sorted(typing_user_ids),
+        "ttl": TYPING_TTL,
+    }
+
+
+class PresenceMixin:
+    """
+    Registers the socket with the presence store for as long as it is open
+    and announces online/offline transitions to the user's rooms. Call
+    `presence_connected` after accepting and `presence_disconnected` on close,
+    and `start_viewing`/`stop_viewing` as the room comes on and off screen.
+    """
+
+    viewed_rooms = frozenset()
+
+    async def presence_connected(self):
+        try:
+            connect = sync_to_async(get_presence_store().connect, thread_sensitive=False)
+            came_online = await connect(self.user.u_id, self.channel_name)
+        except Exception:
+            traceback.print_exc()
+            return
+        self.presence_task = asyncio.ensure_future(self.keep_presence())
+        if came_online:
+            await self.announce_presence(True)
+
+    async def presence_disconnected(self):
+        for room_id in list(self.viewed_rooms):
+            await self.stop_viewing(room_id)
+        task = getattr(self, 'presence_task', None)
+        if task is None:
+            return
+        task.cancel()
+        self.presence_task = None
+        try:
+            disconnect = sync_to_async(get_presence_store().disconnect, thread_sensitive=False)
+            went_offline = await disconnect(self.user.u_id, self.channel_name)
+        except Exception:
+            traceback.print_exc()
+            return
+        if went_offline:
+            await self.announce_presence(False)
+
+    async def keep_presence(self):
+        while True:
+            await asyncio.sleep(PRESENCE_REFRESH)
+            try:
+                # Copied here: the set changes on the event loop while this runs in a worker thread
+                await sync_to_async(self.refresh_presence, thread_sensitive=False)(list(self.viewed_rooms))
+            except Exception:
+                traceback.print_exc()
+
+    def refresh_presence(self, room_ids):
+        store = get_presence_store()
+        store.refresh(self.user.u_id, self.channel_name)
+        for room_id in room_ids:
+            store.view(room_id, self.user.u_id, self.channel_name)
+
+    async def start_viewing(self, room_id):
+        if not isinstance(self.viewed_rooms, set):
+            self.viewed_rooms = set()
+        self.viewed_rooms.add(int(room_id))
+        try:
+            view = sync_to_async(get_presence_store().view, thread_sensitive=False)
+            await view(int(room_id), self.user.u_id, self.channel_name)
+        except Exception:
+            traceback.print_exc()
+
+    async def stop_viewing(self, room_id):
+        if int(room_id) not in self.viewed_rooms:
+            return
+        self.viewed_rooms.discard(int(room_id))
+        try:
+            leave = sync_to_async(get_presence_store().leave, thread_sensitive=False)
+            await leave(int(room_id), self.user.u_id, self.channel_name)
+        except Exception:
+            traceback.print_exc()
+
+    async def announce_presence(self, online):
+        room_ids = await database_sync_to_async(presence_room_ids)(self.user)
+        for room_id in room_ids:
+            await self.channel_layer.group_send(f'chat_{room_id}', presence_event(room_id, self.user.u_id, online))
+
+    async def update_typing(self, room_id, is_typing):
+        """
+        Record a typing frame and broadcast the room's typing state, at most
+        once per TYPING_BROADCAST_INTERVAL; a frame that falls inside the
+        interval is folded into one trailing broadcast.
+        """
+        store = get_presence_store()
+        try:
+            await sync_to_async(store.set_typing, thread_sensitive=False)(int(room_id), self.user.u_id, is_typing)
+        except Exception:
+            traceback.print_exc()
+            return
+        await broadcast_typing(self.channel_layer, int(room_id))
+
+
+# Rooms with a trailing typing broadcast already scheduled in this process
+_trailing = {}
+
+
+async def broadcast_typing(channel_layer, room_id):
+    store = get_presence_store()
+    if await sync_to_async(store.acquire_gate, thread_sensitive=False)(f"typing:{room_id}", TYPING_BROADCAST_INTERVAL):
+        typing = await sync_to_async(store.typing, thread_sensitive=False)(room_id)
+        await channel_layer.group_send(f'chat_{room_id}', typing_event(room_id, typing))
+    elif room_id not in _trailing:
+        _trailing[room_id] = asyncio.ensure_future(_trailing_broadcast(channel_layer, room_id))
+
+
+async def _trailing_broadcast(channel_layer, room_id):
+    try:
+        await asyncio.sleep(TYPING_BROADCAST_INTERVAL)
+        _trailing.pop(room_id, None)
+        await broadcast_typing(channel_layer, room_id)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        if _trailing.get(room_id) is asyncio.current_task():
+            _trailing.pop(room_id, None)
@@ -0,0 +1,203 @@
+# chat_api/receipts.py
+from django.db import connection, transaction
+from django.db.models import Count, IntegerField, Max, Min, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from api.models import Notification, User
+from api.notification_counts import count_marked_read
+from .models import ChatRoom, Message, MessageReadStatus, RoomReadState
+from .sequence import allocate_seq
+
+
+def mark_messages_read(user, room_id, message_ids=None):
+    """
+    Move `user`'s read watermark in `room_id` forward.
+
+    If `message_ids` is given the watermark moves up to the newest of those
+    that belong to `room_id`, otherwise up to the newest message in the room.
+    A watermark covers everything below it: marking one message read marks
+    every earlier message in the room read too, whether or not it was
+    listed. Ids from other rooms are ignored, and repeating a call is a
+    no-op. Rooms with `per_message_receipts` also get their
+    MessageReadStatus rows, inserted with a single set-based statement.
+    Returns (sorted ids of the newly read messages, read_at isoformat, room
+    sequence number of the advance or None if the watermark didn't move).
+    """
+    read_at = timezone.now()
+
+    messages = Message.objects.filter(room_id=room_id)
+    if message_ids is not None:
+        message_ids = _clean_ids(message_ids)
+        if not message_ids:
+            return [], read_at.isoformat(), None
+        messages = messages.filter(id__in=message_ids)
+
+    up_to_id = messages.aggregate(last=Max('id'))['last']
+    if up_to_id is None:
+        return [], read_at.isoformat(), None
+
+    advanced = advance_read_watermark(user, room_id, up_to_id)
+    if advanced is None:
+        return [], read_at.isoformat(), None
+    previous_id, seq = advanced
+
+    room = ChatRoom.objects.filter(id=room_id).values('type', 'per_message_receipts').first()
+    if room and room['per_message_receipts']:
+        insert_read_receipts(user, room_id, previous_id, up_to_id, read_at)
+    if room and room['type'] in ChatRoom.LAZY_FAN_OUT_TYPES:
+        mark_digest_read(user, room_id, up_to_id)
+
+    newly_read = list(
+        Message.objects.filter(room_id=room_id, id__gt=previous_id, id__lte=up_to_id)
+        .exclude(author=user)
+        .order_by('id')
+        .values_list('id', flat=True)
+    )
+    return newly_read, read_at.isoformat(), seq
+
+
+def advance_read_watermark(user, room_id, up_to_id):
+    """
+    Raise the watermark to `up_to_id`. Returns (the previous watermark, the
+    room sequence number taken by the advance), or None if it was already at
+    or past `up_to_id`.
+    """
+    with transaction.atomic():
+        state, _ = RoomReadState.objects.select_for_update().get_or_create(room_id=room_id, user=user)
+        previous_id = state.last_read_message_id
+        if up_to_id <= previous_id:
+            return None
+        state.last_read_message_id = up_to_id
+        state.seq = allocate_seq(room_id)
+        state.save(update_fields=['last_read_message_id', 'seq', 'updated_at'])
+    return previous_id, state.seq
+
+
+def mark_digest_read(user, room_id, up_to_id):
+    """One UPDATE: `user`'s digest for `room_id` is read once the watermark reaches its message"""
+    updated = Notification.objects.filter(
+        recipient=user, is_digest=True, chat_room_id=room_id, is_read=False, message_id__lte=up_to_id,
+    ).update(is_read=True, updated_at=timezone.now())
+    count_marked_read(user.u_id, updated)
+
+
+def insert_read_receipts(user, room_id, after_id, up_to_id, read_at):
+    """
+    Insert the missing receipts for messages in (after_id, up_to_id] with one
+    INSERT ... SELECT ... ON CONFLICT DO NOTHING. Returns the created ids.
+    """
+    qn = connection.ops.quote_name
+    sql = (
+        f"INSERT INTO {qn(MessageReadStatus._meta.db_table)} (message_id, user_id, read_at) "
+        f"SELECT m.id, %s, %s FROM {qn(Message._meta.db_table)} m "
+        f"WHERE m.room_id = %s AND m.author_id <> %s AND m.id > %s AND m.id <= %s "
+        f"ON CONFLICT (message_id, user_id) DO NOTHING "
+        f"RETURNING message_id"
+    )
+    params = [
+        user.u_id, connection.ops.adapt_datetimefield_value(read_at),
+        room_id, user.u_id, after_id, up_to_id,
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return sorted(row[0] for row in cursor.fetchall())
+
+
+def last_read_id(user, room_ref='pk'):
+    """Expression for `user`'s watermark in the room referenced by OuterRef(`room_ref`)"""
+    return Coalesce(
+        Subquery(
+            RoomReadState.objects.filter(room_id=OuterRef(room_ref), user=user)
+            .values('last_read_message_id')[:1]
+        ),
+        Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def with_unread_counts(rooms, user):
+    """Annotate a ChatRoom queryset with `unread_count` for `user`"""
+    unread = (
+        Message.objects.filter(room_id=OuterRef('pk'), id__gt=OuterRef('last_read_id'))
+        .exclude(author=user)
+        .order_by()
+        .values('room_id')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    return rooms.annotate(
+        last_read_id=last_read_id(user),
+        unread_count=Coalesce(Subquery(unread), Value(0), output_field=IntegerField()),
+    )
+
+
+def participant_last_read_id(room_id):
+    """Expression for the watermark in `room_id` of the User referenced by OuterRef('pk')"""
+    return Coalesce(
+        Subquery(
+            RoomReadState.objects.filter(room_id=room_id, user_id=OuterRef('pk'))
+            .values('last_read_message_id')[:1]
+        ),
+        Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def read_horizon(room_id, exclude_user):
+    """
+    Lowest watermark among the room's other participants, i.e. every message
+    up to it has been read by everyone else. None if nobody else is in the room.
+    """
+    return (
+        User.objects.filter(chat_rooms=room_id)
+        .exclude(pk=exclude_user.pk)
+        .annotate(last_read=participant_last_read_id(room_id))
+        .aggregate(horizon=Min('last_read'))['horizon']
+    )
+
+
+def participant_unread_counts(room_id, user_ids=None):
+    """{user_id: unread count} for the room's participants in one grouped query"""
+    unread = (
+        Message.objects.filter(room_id=room_id, id__gt=OuterRef('last_read'))
+        .exclude(author_id=OuterRef('pk'))
+        .order_by()
+        .values('room_id')
+        .annotate(count=Count('id'))
+        .values('count')
+    )
+    participants = User.objects.filter(chat_rooms=room_id)
+    if user_ids is not None:
+        participants = participants.filter(pk__in=user_ids)
+    return dict(
+        participants.annotate(
+            last_read=participant_last_read_id(room_id),
+            unread=Coalesce(Subquery(unread), Value(0), output_field=IntegerField()),
+        ).values_list('pk', 'unread')
+    )
+
+
+def messages_read_event(room_id, user_id, message_ids, read_at, seq):
+    """Group event announcing that `user_id` has read `message_ids` (sorted) in `room_id`."""
+    return {
+        "type": "chat_message",
+        "message_type": "messages_read",
+        "room_id": int(room_id),
+        "seq": seq,
+        "message_ids": message_ids,
+        "first_message_id": message_ids[0],
+        "last_message_id": message_ids[-1],
+        "user_id": user_id,
+        "read_at": read_at,
+    }
+
+
+def _clean_ids(message_ids):
+    cleaned = set()
+    for message_id in message_ids:
+        try:
+            cleaned.add(int(message_id))
+        except (TypeError, ValueError):
+            continue
+    return sorted(cleaned)
@@ -0,0 +1,26 @@
+# chat_api/rooms.py
+from django.db import IntegrityError, transaction
+
+from .models import ChatRoom
+
+
+def get_or_create_direct_room(user_a, user_b):
+    """
+    The one-to-one room between two users, created on first use.
+
+    Looked up by the canonical (min_user, max_user) pair; when two requests
+    race to create it, the unique constraint lets exactly one insert win and
+    the other picks up its room. Returns (room, created).
+    """
+    low, high = sorted((user_a.u_id, user_b.u_id))
+    room = ChatRoom.objects.filter(min_user_id=low, max_user_id=high).first()
+    if room is not None:
+        return room, False
+
+    try:
+        with transaction.atomic():
+            room = ChatRoom.objects.create(type='one-to-one', min_user_id=low, max_user_id=high)
+            room.participants.add(low, high)
+    except IntegrityError:
+        return ChatRoom.objects.get(min_user_id=low, max_user_id=high), False
+    return room, True
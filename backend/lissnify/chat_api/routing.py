@@ -1,6 +1,9 @@
 # chat_api/routing.py
 from django.urls import re_path
 from .consumer import ChatConsumer
+from .multiplex import MultiplexConsumer
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<room_id>\d+)/$', ChatConsumer.as_asgi()),
+    # One socket for every room plus notifications
+    re_path(r'^/?ws/multiplex/?$', MultiplexConsumer.as_asgi()),
 ]
@@ -0,0 +1,26 @@
+# chat_api/sequence.py
+from django.db import connection
+
+from .models import ChatRoom
+
+
+def allocate_seq(room_id, count=1):
+    """
+    Take the next `count` sequence numbers in `room_id` with one UPDATE ...
+    RETURNING and return the last of them. The row stays locked until the
+    surrounding transaction ends, so numbers are handed out in commit order.
+    Returns None if the room doesn't exist.
+
+    The price is that every send and every read-watermark advance in a room
+    queues on that one row lock for the rest of its transaction, so a busy
+    room's writes are serialized. Keep the transactions that call this short;
+    write-behind takes a whole batch's numbers with one UPDATE per room.
+    """
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"UPDATE {qn(ChatRoom._meta.db_table)} SET last_seq = last_seq + %s WHERE id = %s RETURNING last_seq",
+            [count, room_id],
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
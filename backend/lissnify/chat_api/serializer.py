@@ -2,6 +2,8 @@
 
 from rest_framework import serializers
 from .models import ChatRoom, Message, MessageReadStatus
+from .receipts import read_horizon
+from .unread import get_unread_counts
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -11,20 +13,22 @@ class MessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = ["id", "author_username", "author_full_name", "content", "timestamp", "is_read"]
+        fields = ["id", "seq", "author_username", "author_full_name", "content", "timestamp", "is_read"]
 
     
     
     def get_is_read(self, obj):
-        request_user = self.context["request"].user
-
-    # If current user is the sender → check if ALL recipients have read
-        if obj.author == request_user:
-            participants = obj.room.participants.exclude(pk=request_user.pk)  # ✅ use pk instead of id
-            read_count = MessageReadStatus.objects.filter(
-            message=obj, user__in=participants
-            ).count()
-            return read_count == participants.count()
+        # Sockets have no request and pass the user directly
+        request_user = self.context["user"] if "user" in self.context else self.context["request"].user
+
+    # If current user is the sender → read once every other participant's watermark has passed it
+        if obj.author_id == request_user.pk:
+            # MessageListView resolves the horizon once for the whole page
+            if 'read_horizon' in self.context:
+                horizon = self.context['read_horizon']
+            else:
+                horizon = read_horizon(obj.room_id, request_user)
+            return horizon is None or obj.id <= horizon
 
     # If current user is a recipient → optional, usually False until marked read
         return False
@@ -51,18 +55,27 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         user = getattr(request, "user", None)
 
         if user and user.is_authenticated:
-            read_message_ids = MessageReadStatus.objects.filter(
-                user=user,
-                message__room=obj
-            ).values_list('message_id', flat=True)
-
-            unread_count = Message.objects.filter(
-                room=obj
-            ).exclude(
-                id__in=read_message_ids
-            ).exclude(
-                author=user  # don’t count own messages
-            ).count()
-
-            return unread_count
+            # List views resolve every room's count up front from the counter service
+            unread_counts = self.context.get('unread_counts')
+            if unread_counts is not None and obj.id in unread_counts:
+                return unread_counts[obj.id]
+            return get_unread_counts(user, [obj.id])[obj.id]
         return 0
+
+
+class InboxRoomSerializer(ChatRoomSerializer):
+    last_message = serializers.SerializerMethodField()
+    last_activity_at = serializers.DateTimeField(source='activity_at', read_only=True)
+
+    class Meta(ChatRoomSerializer.Meta):
+        fields = ChatRoomSerializer.Meta.fields + ['last_message', 'last_activity_at']
+
+    def get_last_message(self, obj):
+        if obj.last_message_id is None:
+            return None
+        return {
+            "id": obj.last_message_id,
+            "author_id": obj.last_message.author_id if obj.last_message else None,
+            "preview": obj.last_message_preview,
+            "timestamp": obj.last_message_at,
+        }
@@ -0,0 +1,51 @@
+# chat_api/sync.py
+from .models import ChatRoom, Message, RoomReadState
+from .receipts import read_horizon
+from .serializer import MessageSerializer
+from .unread import get_unread_counts
+
+
+def room_changes(user, room_id, since_seq, limit=200):
+    """
+    Everything that happened in `room_id` after sequence number `since_seq`:
+    new messages (oldest first, at most `limit`) and the read watermarks that
+    moved, in a constant number of queries.
+
+    `seq` in the result is the cursor to resume from next time. When
+    `has_more` is set, call again with it for the rest. A cursor ahead of the
+    room (e.g. after a database restore) comes back with `reset` set and the
+    room replayed from the start.
+    """
+    room_id = int(room_id)
+    last_seq = ChatRoom.objects.filter(id=room_id).values_list('last_seq', flat=True).first() or 0
+    reset = since_seq > last_seq
+    if reset:
+        since_seq = 0
+
+    messages = list(
+        Message.objects.filter(room_id=room_id, seq__gt=since_seq)
+        .select_related('author')
+        .order_by('seq')[:limit + 1]
+    )
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+
+    # Only hand out a cursor for what is actually in this batch, so nothing
+    # between the last returned message and the next one gets skipped
+    reads = RoomReadState.objects.filter(room_id=room_id, seq__gt=since_seq)
+    if has_more:
+        reads = reads.filter(seq__lte=messages[-1].seq)
+    reads = list(reads.order_by('seq').values('user_id', 'last_read_message_id', 'seq'))
+
+    cursor = max([since_seq] + [message.seq for message in messages] + [read['seq'] for read in reads])
+    context = {'user': user, 'read_horizon': read_horizon(room_id, user)}
+    return {
+        "room_id": room_id,
+        "since_seq": since_seq,
+        "seq": cursor,
+        "has_more": has_more,
+        "reset": reset,
+        "messages": MessageSerializer(messages, many=True, context=context).data,
+        "reads": reads,
+        "unread_count": get_unread_counts(user, [room_id])[room_id],
+    }
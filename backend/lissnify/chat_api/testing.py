@@ -0,0 +1,36 @@
+# chat_api/testing.py
+"""
+Test helpers shared by the chat_api and api suites.
+
+The unread counter, membership cache, presence store and notification
+counter are process-wide singletons. Their in-memory stand-ins outlive each
+test's database, so ids reused by the next test would hit stale entries.
+"""
+from django.test import TestCase, TransactionTestCase
+
+from api.notification_counts import get_notification_counter
+from .membership import get_membership_cache
+from .presence import get_presence_store
+from .unread import get_unread_counter
+
+
+def reset_memory_stores():
+    """Empty every in-memory store; Redis-backed ones are left alone"""
+    for store in (get_unread_counter(), get_membership_cache(), get_presence_store(), get_notification_counter()):
+        clear = getattr(store, 'clear', None)
+        if clear is not None:
+            clear()
+
+
+class MemoryStoresMixin:
+    def setUp(self):
+        super().setUp()
+        reset_memory_stores()
+
+
+class ChatTestCase(MemoryStoresMixin, TestCase):
+    pass
+
+
+class ChatTransactionTestCase(MemoryStoresMixin, TransactionTestCase):
+    pass
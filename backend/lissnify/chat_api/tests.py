@@ -1,3 +1,977 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+import msgpack
+from django.db import DatabaseError, connection
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from api.models import Notification, User
+from .buffer import MessageBuffer, MessageIdAllocator, persist_batch, prepare_message
+from .digest import refresh_message_digests
+from .membership import get_user_room_ids, is_room_member, member_room_ids
+from .models import ChatRoom, Message, MessageReadStatus, RoomReadState
+from .outbound import OutboundQueueMixin, merge_frames, outbound_stats
+from .pipeline import send_message
+from .presence import get_presence_store, room_viewers, typing_event
+from .receipts import mark_messages_read, with_unread_counts
+from .rooms import get_or_create_direct_room
+from .routing import websocket_urlpatterns
+from .testing import ChatTestCase, ChatTransactionTestCase
+from .unread import (
+    MemoryUnreadCounter, RedisUnreadCounter, count_messages_read, get_unread_counter, get_unread_counts,
+)
+from .wire import JsonProtocol, MsgpackProtocol, WireProtocolMixin, negotiate_protocol
+
+
+class MessageListViewQueryCountTests(ChatTestCase):
+    """Read state for a page is resolved up front, not per message"""
+
+    def setUp(self):
+        super().setUp()
+        self.seeker = User.objects.create(full_name='Seeker', email='seeker@example.com')
+        self.listener = User.objects.create(full_name='Listener', email='listener@example.com')
+        self.room = ChatRoom.objects.create()
+        self.room.participants.add(self.seeker, self.listener)
+        self.client = APIClient()
+        self.client.force_authenticate(self.seeker)
+
+    def add_messages(self, count):
+        Message.objects.bulk_create([
+            Message(room=self.room, author=self.seeker if i % 2 else self.listener, content=f'message {i}')
+            for i in range(count)
+        ])
+
+    def get_page(self, limit):
+        response = self.client.get(f'/chat/{self.room.id}/messages/', {'limit': limit})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        self.add_messages(200)
+        get_user_room_ids(self.seeker)
+
+        # page, read horizon; membership comes from the cache
+        with self.assertNumQueries(2):
+            small = self.get_page(5)
+        with self.assertNumQueries(2):
+            large = self.get_page(200)
+
+        self.assertEqual(len(small), 5)
+        self.assertEqual(len(large), 200)
+
+    def test_own_messages_are_read_up_to_the_other_participants_watermark(self):
+        self.add_messages(6)
+        ids = list(Message.objects.filter(room=self.room).order_by('id').values_list('id', flat=True))
+        mark_messages_read(self.listener, self.room.id, [ids[3]])
+
+        page = self.get_page(50)
+
+        own = {message['id']: message['is_read'] for message in page if message['author_full_name'] == 'Seeker'}
+        self.assertEqual(own, {ids[1]: True, ids[3]: True, ids[5]: False})
+        self.assertFalse(any(message['is_read'] for message in page if message['author_full_name'] == 'Listener'))
+
+
+class MessageListPaginationTests(ChatTestCase):
+    """Message pages walk by id both ways, whatever the timestamps"""
+
+    def setUp(self):
+        super().setUp()
+        self.seeker = User.objects.create(full_name='Seeker', email='seeker@example.com')
+        self.room = ChatRoom.objects.create()
+        self.room.participants.add(self.seeker)
+        at = timezone.now()
+        # One shared timestamp, so only the id can keep the order stable
+        Message.objects.bulk_create([
+            Message(room=self.room, author=self.seeker, content=f'message {i}', timestamp=at) for i in range(7)
+        ])
+        Message.objects.filter(room=self.room).update(timestamp=at)
+        self.ids = list(Message.objects.filter(room=self.room).order_by('id').values_list('id', flat=True))
+        self.client = APIClient()
+        self.client.force_authenticate(self.seeker)
+
+    def page(self, **params):
+        response = self.client.get(f'/chat/{self.room.id}/messages/', params)
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(set(body), {'results', 'next', 'prev'})
+        return [message['id'] for message in body['results']], body['next'], body['prev']
+
+    def test_walk_back_and_forward(self):
+        ids = self.ids
+        self.assertEqual(self.page(limit=3), (ids[4:], ids[4], None))
+        self.assertEqual(self.page(limit=3, before=ids[4]), (ids[1:4], ids[1], ids[3]))
+        self.assertEqual(self.page(limit=3, before=ids[1]), (ids[:1], None, ids[0]))
+
+        self.assertEqual(self.page(limit=3, after=ids[0]), (ids[1:4], ids[1], ids[3]))
+        self.assertEqual(self.page(limit=3, after=ids[3]), (ids[4:], ids[4], None))
+
+    def test_bad_parameters(self):
+        for params in ({'limit': 0}, {'limit': 'ten'}, {'before': 'x'}, {'before': self.ids[3], 'after': self.ids[1]}):
+            with self.subTest(params):
+                response = self.client.get(f'/chat/{self.room.id}/messages/', params)
+                self.assertEqual(response.status_code, 400)
+
+
+class ReadReceiptTests(ChatTestCase):
+    """Marking read moves one watermark; receipts rows are written only where the room keeps them"""
+
+    def setUp(self):
+        super().setUp()
+        self.seeker = User.objects.create(full_name='Seeker', email='seeker@example.com')
+        self.listener = User.objects.create(full_name='Listener', email='listener@example.com')
+        self.room, _ = get_or_create_direct_room(self.seeker, self.listener)
+        self.ids = [send_message(self.seeker, self.room.id, f'message {i}')[0]['message_id'] for i in range(4)]
+
+    def test_watermark_covers_earlier_messages(self):
+        read_ids, _, seq = mark_messages_read(self.listener, self.room.id, [self.ids[2]])
+        self.assertEqual(read_ids, self.ids[:3])
+        self.assertIsNotNone(seq)
+
+        # Repeating, or naming an already covered message, changes nothing
+        self.assertEqual(mark_messages_read(self.listener, self.room.id, [self.ids[2]])[::2], ([], None))
+        self.assertEqual(mark_messages_read(self.listener, self.room.id, [self.ids[1]])[::2], ([], None))
+
+        self.assertEqual(mark_messages_read(self.listener, self.room.id)[0], self.ids[3:])
+        self.assertFalse(MessageReadStatus.objects.exists())
+
+    def test_rooms_with_per_message_receipts_get_one_row_per_message(self):
+        ChatRoom.objects.filter(id=self.room.id).update(per_message_receipts=True)
+
+        mark_messages_read(self.listener, self.room.id, [self.ids[1]])
+        mark_messages_read(self.listener, self.room.id)
+        mark_messages_read(self.listener, self.room.id)
+
+        self.assertEqual(
+            sorted(MessageReadStatus.objects.filter(user=self.listener).values_list('message_id', flat=True)),
+            self.ids,
+        )
+
+    def test_ids_from_another_room_are_ignored(self):
+        other = ChatRoom.objects.create()
+        other.participants.add(self.seeker, self.listener)
+        foreign = Message.objects.create(room=other, author=self.seeker, content='elsewhere')
+
+        self.assertEqual(mark_messages_read(self.listener, self.room.id, [foreign.id, 'junk'])[::2], ([], None))
+        self.assertFalse(RoomReadState.objects.filter(user=self.listener, last_read_message_id__gt=0).exists())
+
+
+def live_redis():
+    """A client for REDIS_URL if a server answers there, else None"""
+    import redis
+    client = redis.Redis.from_url(os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0'), decode_responses=True)
+    try:
+        client.ping()
+    except redis.RedisError:
+        return None
+    return client
+
+
+class UnreadCounterChecks:
+    """Behaviour both counter stores share; subclasses provide `counter`"""
+
+    def test_increment_read_and_reset(self):
+        self.counter.set_many(1, {10: 2, 11: 0})
+        self.counter.increment(10, [1])
+        self.counter.increment(11, [1], amount=3)
+        self.assertEqual(self.counter.get_many(1, [10, 11, 12]), {10: 3, 11: 3, 12: None})
+
+        self.counter.decrement(1, 10, 5)
+        self.counter.set_room(11, {1: 0})
+        self.assertEqual(self.counter.get_room(10, [1]), {1: 0})
+        self.assertEqual(self.counter.get_many(1, [11]), {11: 0})
+
+    def test_missing_counters_are_left_for_a_rebuild(self):
+        # Incrementing a room nobody has counted yet must not invent a count
+        self.counter.increment(10, [1, 2])
+        self.counter.decrement(2, 10, 1)
+        self.assertEqual(self.counter.get_room(10, [1, 2]), {1: None, 2: None})
+
+
+class MemoryUnreadCounterTests(UnreadCounterChecks, SimpleTestCase):
+    def setUp(self):
+        self.counter = MemoryUnreadCounter()
+
+
+@skipUnless(live_redis(), "needs a Redis server at REDIS_URL")
+class RedisUnreadCounterTests(UnreadCounterChecks, SimpleTestCase):
+    def setUp(self):
+        client = live_redis()
+        self.counter = RedisUnreadCounter(client)
+        self.addCleanup(client.delete, self.counter.key(1), self.counter.key(2))
+        client.delete(self.counter.key(1), self.counter.key(2))
+
+    def test_writes_do_not_extend_the_expiry(self):
+        self.counter.set_many(1, {10: 1})
+        self.counter.client.expire(self.counter.key(1), 5)
+        self.counter.set_room(11, {1: 4})
+        self.assertLessEqual(self.counter.client.ttl(self.counter.key(1)), 5)
+
+
+class UnreadCountRebuildTests(ChatTestCase):
+    """Counters missing from the store are rebuilt from watermarks, then kept up to date"""
+
+    def test_rebuild_after_a_miss(self):
+        seeker = User.objects.create(full_name='Seeker', email='seeker@example.com')
+        listener = User.objects.create(full_name='Listener', email='listener@example.com')
+        room, _ = get_or_create_direct_room(seeker, listener)
+        send_message(seeker, room.id, 'one')
+        send_message(seeker, room.id, 'two')
+        get_unread_counter().clear()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(get_unread_counts(listener, [room.id]), {room.id: 2})
+        send_message(seeker, room.id, 'three')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_unread_counts(listener, [room.id]), {room.id: 3})
+
+        read_ids, _, _ = mark_messages_read(listener, room.id)
+        count_messages_read(listener, room.id, len(read_ids))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_unread_counts(listener, [room.id]), {room.id: 0})
+
+
+class SentUnreadCountsTests(ChatTestCase):
+    """The counts a new_message carries agree with counts rebuilt from the database"""
+
+    def test_event_counts_match_the_database(self):
+        members = [User.objects.create(full_name=f'Member {i}', email=f'member{i}@example.com') for i in range(3)]
+        room = ChatRoom.objects.create(type='group')
+        room.participants.add(*members)
+
+        send_message(members[0], room.id, 'one')
+        send_message(members[0], room.id, 'two')
+        read_ids, _, _ = mark_messages_read(members[1], room.id)
+        count_messages_read(members[1], room.id, len(read_ids))
+        send_message(members[2], room.id, 'three')
+        event, _ = send_message(members[1], room.id, 'four')
+
+        rebuilt = {
+            str(member.u_id): with_unread_counts(ChatRoom.objects.filter(id=room.id), member).get().unread_count
+            for member in members
+        }
+        self.assertEqual(event['unread_counts'], rebuilt)
+        self.assertEqual(rebuilt, {str(members[0].u_id): 2, str(members[1].u_id): 1, str(members[2].u_id): 3})
+
+        # The REST map answers from the same counters
+        for member in members:
+            client = APIClient()
+            client.force_authenticate(member)
+            self.assertEqual(client.get('/chat/unread-counts/').json(), {str(room.id): rebuilt[str(member.u_id)]})
+
+
+class MembershipCacheTests(ChatTestCase):
+    """Membership checks are cached and follow changes to the participants"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(full_name='Member', email='member@example.com')
+        self.room = ChatRoom.objects.create()
+
+    def test_membership_is_cached(self):
+        self.room.participants.add(self.user)
+
+        with self.assertNumQueries(1):
+            self.assertTrue(is_room_member(self.user, self.room.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(is_room_member(self.user, str(self.room.id)))
+            self.assertFalse(is_room_member(self.user, self.room.id + 1))
+
+    def test_checking_some_rooms_does_not_load_them_all(self):
+        self.room.participants.add(self.user)
+        other = ChatRoom.objects.create()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(member_room_ids(self.user, [self.room.id, other.id]), {self.room.id})
+        get_user_room_ids(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(member_room_ids(self.user, [other.id, self.room.id]), {self.room.id})
+
+    def test_participant_changes_invalidate_the_cache(self):
+        self.assertFalse(is_room_member(self.user, self.room.id))
+
+        self.room.participants.add(self.user)
+        self.assertTrue(is_room_member(self.user, self.room.id))
+
+        self.user.chat_rooms.remove(self.room)
+        self.assertFalse(is_room_member(self.user, self.room.id))
+
+        self.room.participants.add(self.user)
+        self.assertTrue(is_room_member(self.user, self.room.id))
+        self.room.participants.clear()
+        self.assertFalse(is_room_member(self.user, self.room.id))
+
+        room_id = self.room.id
+        self.room.participants.add(self.user)
+        self.assertTrue(is_room_member(self.user, room_id))
+        self.room.delete()
+        self.assertFalse(is_room_member(self.user, room_id))
+
+
+class DirectRoomTests(ChatTestCase):
+    def test_direct_room_is_shared_by_the_pair(self):
+        seeker = User.objects.create(full_name='Seeker', email='seeker@example.com')
+        listener = User.objects.create(full_name='Listener', email='listener@example.com')
+
+        room, created = get_or_create_direct_room(seeker, listener)
+        self.assertTrue(created)
+        self.assertEqual(room.type, 'one-to-one')
+        self.assertEqual(set(room.participants.values_list('u_id', flat=True)), {seeker.u_id, listener.u_id})
+
+        with self.assertNumQueries(1):
+            again, created = get_or_create_direct_room(listener, seeker)
+        self.assertFalse(created)
+        self.assertEqual(again.id, room.id)
+
+
+class MessageIdAllocatorTests(ChatTestCase):
+    """Write-behind ids follow send order, even with other writers in between"""
+
+    @skipUnless(connection.vendor == 'postgresql', "needs the message table's sequence")
+    def test_ids_keep_rising(self):
+        author = User.objects.create(full_name='Author', email='author@example.com')
+        room = ChatRoom.objects.create()
+        ids = MessageIdAllocator()
+
+        first = ids.next_id()
+        # Another worker's message, written while ours is still buffered
+        other = Message.objects.create(room=room, author=author, content='elsewhere')
+        self.assertGreater(other.id, first)
+        self.assertGreater(ids.next_id(), other.id)
+
+
+class FailedFlushTests(ChatTestCase):
+    """A write-behind batch that fails to persist leaves no trace in the unread counters"""
+
+    def test_counters_are_restored(self):
+        seeker = User.objects.create(full_name='Seeker', email='seeker@example.com')
+        listener = User.objects.create(full_name='Listener', email='listener@example.com')
+        room, _ = get_or_create_direct_room(seeker, listener)
+        send_message(seeker, room.id, 'stored')
+        self.assertEqual(get_unread_counts(listener, [room.id]), {room.id: 1})
+
+        buffer = MessageBuffer(flush_interval_ms=10, batch_size=10)
+        pending = [prepare_message(seeker, room.id, f'buffered {i}', buffer.ids) for i in range(2)]
+        self.assertEqual(pending[1].event['unread_counts'][str(listener.u_id)], 3)
+
+        async def flush():
+            for item in pending:
+                item.persisted = asyncio.get_running_loop().create_future()
+            with mock.patch('chat_api.buffer.persist_batch', side_effect=DatabaseError('down')):
+                await buffer._flush(pending)
+            return [type(item.persisted.exception()) for item in pending]
+
+        self.assertEqual(async_to_sync(flush)(), [DatabaseError, DatabaseError])
+        self.assertEqual(get_unread_counts(listener, [room.id]), {room.id: 1})
+
+
+class NotificationSuppressionTests(ChatTestCase):
+    """Recipients with the room open get the message live and no notification"""
+
+    def setUp(self):
+        super().setUp()
+        self.seeker = User.objects.create(full_name='Seeker', email='seeker@example.com')
+        self.listener = User.objects.create(full_name='Listener', email='listener@example.com')
+        self.room, _ = get_or_create_direct_room(self.seeker, self.listener)
+
+    def test_viewers_are_skipped(self):
+        store = get_presence_store()
+        store.view(self.room.id, self.listener.u_id, 'listener-socket')
+        self.addCleanup(store.leave, self.room.id, self.listener.u_id, 'listener-socket')
+
+        _, notifications = send_message(self.seeker, self.room.id, 'while you are here')
+        self.assertEqual(notifications, [])
+
+        store.leave(self.room.id, self.listener.u_id, 'listener-socket')
+        _, notifications = send_message(self.seeker, self.room.id, 'after you left')
+        self.assertEqual([n.recipient_id for n in notifications], [self.listener.u_id])
+
+
+class RoomSyncTests(ChatTestCase):
+    """Reconnecting clients get only what changed after their cursor"""
+
+    def setUp(self):
+        super().setUp()
+        self.seeker = User.objects.create(full_name='Seeker', email='seeker@example.com')
+        self.listener = User.objects.create(full_name='Listener', email='listener@example.com')
+        self.room, _ = get_or_create_direct_room(self.seeker, self.listener)
+        self.client = APIClient()
+        self.client.force_authenticate(self.seeker)
+
+    def sync(self, since_seq, **params):
+        response = self.client.get(f'/chat/{self.room.id}/sync/', {'since_seq': since_seq, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_sync_returns_messages_and_reads_after_the_cursor(self):
+        for i in range(3):
+            send_message(self.seeker, self.room.id, f'message {i}')
+        cursor = self.sync(0)['seq']
+        self.assertEqual(cursor, 3)
+
+        send_message(self.seeker, self.room.id, 'while offline')
+        mark_messages_read(self.listener, self.room.id)
+
+        changes = self.sync(cursor)
+        self.assertEqual([message['content'] for message in changes['messages']], ['while offline'])
+        self.assertEqual([read['user_id'] for read in changes['reads']], [self.listener.u_id])
+        self.assertEqual(changes['seq'], 5)
+        self.assertTrue(changes['messages'][0]['is_read'])
+
+        self.assertEqual(self.sync(changes['seq'])['messages'], [])
+
+    def test_sync_pages_through_large_gaps(self):
+        for i in range(5):
+            send_message(self.seeker, self.room.id, f'message {i}')
+
+        first = self.sync(0, limit=3)
+        self.assertTrue(first['has_more'])
+        rest = self.sync(first['seq'], limit=3)
+        self.assertFalse(rest['has_more'])
+        self.assertEqual(len(first['messages']) + len(rest['messages']), 5)
+
+
+    def test_buffered_messages_get_numbers_when_flushed(self):
+        send_message(self.listener, self.room.id, 'earlier')
+        ids = MessageIdAllocator()
+        pending = [prepare_message(self.seeker, self.room.id, f'buffered {i}', ids) for i in range(2)]
+        self.assertEqual([item.event['seq'] for item in pending], [None, None])
+        # Takes a sequence number while the messages are still buffered
+        mark_messages_read(self.seeker, self.room.id)
+
+        # A sync before the flush hands out no cursor past the buffered messages
+        cursor = self.sync(0)['seq']
+        persist_batch(pending)
+        self.assertEqual([item.message.seq for item in pending], [cursor + 1, cursor + 2])
+        self.assertEqual(
+            [message['content'] for message in self.sync(cursor)['messages']], ['buffered 0', 'buffered 1'],
+        )
+
+class InboxTests(ChatTestCase):
+    """The inbox is ordered by room activity and pages with a cursor"""
+
+    def setUp(self):
+        super().setUp()
+        self.seeker = User.objects.create(full_name='Seeker', email='seeker@example.com')
+        self.rooms = []
+        for i in range(3):
+            listener = User.objects.create(full_name=f'Listener {i}', email=f'listener{i}@example.com')
+            room, _ = get_or_create_direct_room(self.seeker, listener)
+            self.rooms.append(room)
+        self.client = APIClient()
+        self.client.force_authenticate(self.seeker)
+
+    def inbox(self, **params):
+        response = self.client.get('/chat/inbox/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_rooms_follow_their_latest_message(self):
+        send_message(self.seeker, self.rooms[2].id, 'older')
+        send_message(self.seeker, self.rooms[0].id, 'x' * 150)
+        send_message(self.seeker, self.rooms[2].id, 'newest')
+
+        rooms = self.inbox()['rooms']
+        self.assertEqual([room['id'] for room in rooms], [self.rooms[2].id, self.rooms[0].id, self.rooms[1].id])
+        self.assertEqual(rooms[0]['last_message']['preview'], 'newest')
+        self.assertEqual(rooms[1]['last_message']['preview'], 'x' * 100 + '...')
+        self.assertIsNone(rooms[2]['last_message'])
+
+    def test_pages_cover_every_room_in_constant_queries(self):
+        for room in self.rooms:
+            send_message(self.seeker, room.id, 'hello')
+        get_user_room_ids(self.seeker)
+
+        with self.assertNumQueries(2):
+            first = self.inbox(limit=2)
+        rest = self.inbox(limit=2, before=first['next_cursor'])
+        self.assertIsNone(rest['next_cursor'])
+        self.assertEqual(
+            [room['id'] for room in first['rooms'] + rest['rooms']],
+            [room.id for room in reversed(self.rooms)],
+        )
+
+
+class CommunityRoomTests(ChatTestCase):
+    """Community messages are stored once and reach members through watermarks and digests"""
+
+    def setUp(self):
+        super().setUp()
+        self.members = [
+            User.objects.create(full_name=f'Member {i}', email=f'member{i}@example.com') for i in range(3)
+        ]
+        self.room = ChatRoom.objects.create(name='Night owls', type='community')
+        self.room.participants.add(*self.members)
+
+    def test_messages_write_no_per_member_rows(self):
+        author, reader, _ = self.members
+        # room, savepoint, message, seq, message's seq, last message, release
+        with self.assertNumQueries(7):
+            event, notifications = send_message(author, self.room.id, 'hello')
+        self.assertEqual(notifications, [])
+        self.assertIsNone(event['unread_counts'])
+
+        send_message(author, self.room.id, 'again')
+        self.assertEqual(get_unread_counts(reader, [self.room.id]), {self.room.id: 2})
+        mark_messages_read(reader, self.room.id)
+        self.assertEqual(get_unread_counts(reader, [self.room.id]), {self.room.id: 0})
+
+    def test_one_digest_per_member_follows_the_watermark(self):
+        author, reader, _ = self.members
+        send_message(author, self.room.id, 'first')
+        send_message(author, self.room.id, 'second')
+
+        self.assertEqual(refresh_message_digests(), 2)
+        self.assertEqual(refresh_message_digests(), 0)
+        digest = Notification.objects.get(recipient=reader)
+        self.assertEqual((digest.title, digest.message, digest.is_digest), ('2 new messages in Night owls', 'second', True))
+
+        send_message(author, self.room.id, 'third')
+        self.assertEqual(refresh_message_digests(), 2)
+        updated = Notification.objects.get(recipient=reader)
+        self.assertEqual((updated.id, updated.created_at, updated.title), (digest.id, digest.created_at, '3 new messages in Night owls'))
+
+        # Reading the room marks the digest read, without a refresh
+        mark_messages_read(reader, self.room.id)
+        self.assertTrue(Notification.objects.get(recipient=reader).is_read)
+
+        send_message(author, self.room.id, 'fourth')
+        refresh_message_digests()
+        reopened = Notification.objects.get(recipient=reader)
+        self.assertNotEqual(reopened.id, digest.id)
+        self.assertEqual((reopened.title, reopened.is_read), ('1 new message in Night owls', False))
+        self.assertFalse(Notification.objects.filter(recipient=author).exists())
+
+    def test_reads_do_not_write_digests(self):
+        author, reader, _ = self.members
+        send_message(author, self.room.id, 'hello')
+        client = APIClient()
+        client.force_authenticate(reader)
+        for url in ('/api/notifications/', '/api/notifications/stats/'):
+            self.assertEqual(client.get(url).status_code, 200)
+        self.assertFalse(Notification.objects.exists())
+
+
+class GatedSocket(OutboundQueueMixin, WireProtocolMixin):
+    """A socket whose writes wait until `gate` is set, like a stalled flush task"""
+
+    def __init__(self):
+        self.scope = {}
+        self.sent = []
+        self.gate = asyncio.Event()
+
+    async def send(self, text_data=None, bytes_data=None):
+        await self.gate.wait()
+        self.sent.append(json.loads(text_data))
+
+
+def read_frame(user_id, message_ids):
+    return {
+        "type": "messages_read", "room_id": 1, "user_id": user_id,
+        "message_ids": message_ids, "seq": message_ids[-1],
+    }
+
+
+@override_settings(CHAT_OUTBOUND_MAX_QUEUE=3)
+class OutboundQueueTests(SimpleTestCase):
+    """Frames queued behind a stalled flush task merge and shed droppable frames oldest first"""
+
+    def run_socket(self, *frames):
+        """Send `frames` while the socket is stalled, then let it drain"""
+        async def run():
+            socket = GatedSocket()
+            for frame in frames:
+                await socket.send_frame(frame)
+                # Let the flush task take the first frame and stall on it
+                await asyncio.sleep(0)
+            queued = list(socket.outbound_frames.values())
+            socket.gate.set()
+            await asyncio.sleep(0.01)
+            socket.stop_outbound()
+            return socket, queued
+        return asyncio.run(run())
+
+    def test_merge_frames(self):
+        merged = merge_frames(read_frame(7, [3, 5]), read_frame(7, [4]))
+        self.assertEqual(
+            (merged['message_ids'], merged['first_message_id'], merged['last_message_id'], merged['seq']),
+            ([3, 4, 5], 3, 5, 5),
+        )
+        self.assertEqual(merge_frames({"type": "unread_count", "count": 1}, {"type": "unread_count", "count": 2})['count'], 2)
+
+    def test_queued_receipts_merge_behind_what_they_refer_to(self):
+        coalesced = outbound_stats.coalesced
+        socket, queued = self.run_socket(
+            {"type": "new_message", "message_id": 1},
+            read_frame(7, [1]),
+            {"type": "new_message", "message_id": 2},
+            read_frame(7, [2]),
+        )
+        self.assertEqual([frame['type'] for frame in queued], ['new_message', 'messages_read'])
+        self.assertEqual(queued[1]['message_ids'], [1, 2])
+        self.assertEqual(outbound_stats.coalesced - coalesced, 1)
+        self.assertEqual(len(socket.sent), 3)
+
+    def test_full_queue_drops_the_oldest_droppable_frame(self):
+        dropped = outbound_stats.dropped
+        socket, queued = self.run_socket(
+            {"type": "new_message", "message_id": 1},
+            {"type": "typing", "room_id": 1, "user_ids": [7]},
+            {"type": "presence", "room_id": 1, "user_id": 7, "online": True},
+            {"type": "new_message", "message_id": 2},
+            {"type": "new_message", "message_id": 3},
+        )
+        self.assertEqual([frame['type'] for frame in queued], ['presence', 'new_message', 'new_message'])
+        self.assertEqual(outbound_stats.dropped - dropped, 1)
+        self.assertEqual(len(socket.sent), 4)
+
+    def test_full_queue_with_nothing_to_drop_keeps_every_frame(self):
+        socket, queued = self.run_socket(*[{"type": "new_message", "message_id": i} for i in range(6)])
+        self.assertEqual(len(queued), 5)
+        self.assertEqual([frame['message_id'] for frame in socket.sent], list(range(6)))
+
+    def test_frames_are_not_held_back(self):
+        async def run():
+            socket = GatedSocket()
+            socket.gate.set()
+            await socket.send_frame({"type": "typing", "room_id": 1, "user_ids": [7]})
+            await asyncio.sleep(0)
+            sent = list(socket.sent)
+            socket.stop_outbound()
+            return sent
+        self.assertEqual(len(asyncio.run(run())), 1)
+
+
+@override_settings(
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}, CHAT_OUTBOUND_MAX_QUEUE=3,
+)
+class OutboundSlowClientTests(ChatTransactionTestCase):
+    """A client that stops reading never backs up the queue: send() returns once the server has the frame"""
+
+    def test_unread_frames_pile_up_past_the_queue(self):
+        seeker = User.objects.create(full_name='Seeker', email='seeker@example.com')
+        listener = User.objects.create(full_name='Listener', email='listener@example.com')
+        room, _ = get_or_create_direct_room(seeker, listener)
+        dropped = outbound_stats.dropped
+
+        async def run():
+            socket = await open_socket(f'/ws/chat/{room.id}/', listener)
+            # The client reads nothing while ten times the queue limit is sent
+            for i in range(30):
+                await get_channel_layer().group_send(f'chat_{room.id}', typing_event(room.id, [i]))
+            await asyncio.sleep(0.1)
+            depth = outbound_stats.snapshot()['max_queue_depth']
+            typing = await frames_of(socket, 'typing')
+            await socket.disconnect()
+            return depth, typing
+
+        depth, typing = async_to_sync(run)()
+        self.assertEqual(depth, 0)
+        self.assertEqual([frame['user_ids'] for frame in typing], [[i] for i in range(30)])
+        self.assertEqual(outbound_stats.dropped, dropped)
+
+
+async def open_socket(path, user, subprotocols=None):
+    socket = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path, subprotocols=subprotocols)
+    socket.scope['user'] = user
+    connected, _ = await socket.connect()
+    assert connected
+    return socket
+
+
+async def frames_of(socket, frame_type, wait=0.3):
+    """Every JSON frame of `frame_type` until none arrives for `wait` seconds"""
+    frames = []
+    while not await socket.receive_nothing(timeout=wait):
+        frame = await socket.receive_json_from()
+        if frame['type'] == frame_type:
+            frames.append(frame)
+    return frames
+
+
+async def receive_type(socket, frame_type):
+    """The next JSON frame of `frame_type`, skipping any others"""
+    while True:
+        frame = await socket.receive_json_from(timeout=2)
+        if frame['type'] == frame_type:
+            return frame
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class MultiplexConsumerTests(ChatTransactionTestCase):
+    """One socket subscribes to rooms, acts in them and carries notifications"""
+
+    def setUp(self):
+        super().setUp()
+        self.seeker = User.objects.create(full_name='Seeker', email='seeker@example.com')
+        self.listener = User.objects.create(full_name='Listener', email='listener@example.com')
+        self.room, _ = get_or_create_direct_room(self.seeker, self.listener)
+        self.elsewhere = ChatRoom.objects.create()
+        self.elsewhere.participants.add(self.listener)
+
+    def test_subscribe_gates_room_actions(self):
+        async def run():
+            socket = await open_socket('/ws/multiplex/', self.seeker)
+            await socket.send_json_to({'type': 'send_message', 'room_id': self.room.id, 'message': 'early'})
+            early = await receive_type(socket, 'error')
+
+            await socket.send_json_to({'type': 'subscribe', 'room_ids': [self.room.id, self.elsewhere.id]})
+            subscribed = await receive_type(socket, 'subscribed')
+            await socket.send_json_to({'type': 'send_message', 'room_id': self.room.id, 'message': 'hello'})
+            sent = await receive_type(socket, 'new_message')
+
+            await socket.send_json_to({'type': 'unsubscribe', 'room_id': self.room.id})
+            unsubscribed = await receive_type(socket, 'unsubscribed')
+            await socket.send_json_to({'type': 'typing', 'room_id': self.room.id})
+            late = await receive_type(socket, 'error')
+            await socket.disconnect()
+            return early, subscribed, sent, unsubscribed, late
+
+        early, subscribed, sent, unsubscribed, late = async_to_sync(run)()
+        self.assertEqual((early['error'], early['room_id']), ('Subscribe to the room first.', self.room.id))
+        self.assertEqual((subscribed['room_ids'], subscribed['rejected']), ([self.room.id], [self.elsewhere.id]))
+        self.assertEqual((sent['room_id'], sent['message']), (self.room.id, 'hello'))
+        self.assertEqual(unsubscribed['room_ids'], [self.room.id])
+        self.assertEqual(late['error'], 'Subscribe to the room first.')
+        self.assertEqual(list(Message.objects.values_list('content', flat=True)), ['hello'])
+
+    def test_subscribe_replays_from_cursors(self):
+        send_message(self.listener, self.room.id, 'before')
+        cursor = ChatRoom.objects.get(id=self.room.id).last_seq
+        send_message(self.listener, self.room.id, 'while away')
+
+        async def run():
+            socket = await open_socket('/ws/multiplex/', self.seeker)
+            await socket.send_json_to({'type': 'subscribe', 'room_ids': [self.room.id], 'cursors': {str(self.room.id): cursor}})
+            await receive_type(socket, 'subscribed')
+            replay = await receive_type(socket, 'sync')
+            await socket.disconnect()
+            return replay
+
+        replay = async_to_sync(run)()
+        self.assertEqual(replay['room_id'], self.room.id)
+        self.assertEqual([message['content'] for message in replay['messages']], ['while away'])
+
+    def test_only_the_focused_room_counts_as_viewed(self):
+        async def notified(socket, frame):
+            if frame:
+                await socket.send_json_to({**frame, 'room_id': self.room.id})
+            # Frames are handled in order, so the reply means the one above is done
+            await socket.send_json_to({'type': 'get_presence', 'room_id': self.room.id})
+            await receive_type(socket, 'presence_state')
+            _, notifications = await database_sync_to_async(send_message)(self.seeker, self.room.id, 'hi')
+            return [n.recipient_id for n in notifications]
+
+        async def run():
+            socket = await open_socket('/ws/multiplex/', self.listener)
+            await socket.send_json_to({'type': 'subscribe', 'room_id': self.room.id})
+            await receive_type(socket, 'subscribed')
+            phases = [await notified(socket, frame) for frame in (None, {'type': 'focus'}, {'type': 'blur'})]
+            await socket.disconnect()
+            return phases
+
+        subscribed, focused, blurred = async_to_sync(run)()
+        self.assertEqual(subscribed, [self.listener.u_id])
+        self.assertEqual(focused, [])
+        self.assertEqual(blurred, [self.listener.u_id])
+
+    def test_notification_actions_are_forwarded(self):
+        notification = Notification.objects.create(
+            recipient=self.seeker, notification_type='system', title='Welcome', message='',
+        )
+
+        async def run():
+            socket = await open_socket('/ws/multiplex/', self.seeker)
+            await socket.send_json_to({'type': 'get_unread_count'})
+            before = await receive_type(socket, 'unread_count')
+            await socket.send_json_to({'type': 'mark_read', 'notification_id': notification.id})
+            after = await receive_type(socket, 'unread_count')
+            await socket.disconnect()
+            return before, after
+
+        before, after = async_to_sync(run)()
+        self.assertEqual((before['count'], after['count']), (1, 0))
+        self.assertTrue(Notification.objects.get(id=notification.id).is_read)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class PresenceTests(ChatTransactionTestCase):
+    """Rooms hear about online/offline transitions and throttled typing, not every socket and keystroke"""
+
+    def setUp(self):
+        super().setUp()
+        self.seeker = User.objects.create(full_name='Seeker', email='seeker@example.com')
+        self.listener = User.objects.create(full_name='Listener', email='listener@example.com')
+        self.room, _ = get_or_create_direct_room(self.seeker, self.listener)
+
+    def test_one_broadcast_per_transition_across_sockets(self):
+        async def run():
+            watcher = await open_socket(f'/ws/chat/{self.room.id}/', self.listener)
+            first = await open_socket('/ws/multiplex/', self.seeker)
+            came_online = await frames_of(watcher, 'presence')
+            second = await open_socket('/ws/multiplex/', self.seeker)
+            await first.disconnect()
+            still_online = await frames_of(watcher, 'presence')
+            await second.disconnect()
+            went_offline = await frames_of(watcher, 'presence')
+            await watcher.disconnect()
+            return came_online, still_online, went_offline
+
+        came_online, still_online, went_offline = async_to_sync(run)()
+        self.assertEqual([(f['user_id'], f['online']) for f in came_online], [(self.seeker.u_id, True)])
+        self.assertEqual(still_online, [])
+        self.assertEqual([(f['user_id'], f['online']) for f in went_offline], [(self.seeker.u_id, False)])
+
+    def test_community_rooms_are_not_pushed_transitions(self):
+        community = ChatRoom.objects.create(name='Night owls', type='community')
+        community.participants.add(self.seeker, self.listener)
+
+        async def run():
+            direct = await open_socket(f'/ws/chat/{self.room.id}/', self.listener)
+            crowd = await open_socket(f'/ws/chat/{community.id}/', self.listener)
+            seeker = await open_socket('/ws/multiplex/', self.seeker)
+            pushed = await frames_of(direct, 'presence'), await frames_of(crowd, 'presence')
+            await crowd.send_json_to({'type': 'get_presence'})
+            pulled = await receive_type(crowd, 'presence_state')
+            for socket in (direct, crowd, seeker):
+                await socket.disconnect()
+            return pushed, pulled
+
+        (direct, crowd), pulled = async_to_sync(run)()
+        self.assertEqual([f['user_id'] for f in direct], [self.seeker.u_id])
+        self.assertEqual(crowd, [])
+        self.assertEqual(pulled['online'], sorted([self.seeker.u_id, self.listener.u_id]))
+
+    @mock.patch('chat_api.presence.TYPING_BROADCAST_INTERVAL', 0.2)
+    def test_typing_is_throttled_with_a_trailing_broadcast(self):
+        async def run():
+            watcher = await open_socket(f'/ws/chat/{self.room.id}/', self.listener)
+            viewing = await database_sync_to_async(room_viewers)(self.room.id)
+            typist = await open_socket('/ws/multiplex/', self.seeker)
+            await typist.send_json_to({'type': 'subscribe', 'room_id': self.room.id})
+            await typist.send_json_to({'type': 'focus', 'room_id': self.room.id})
+            await typist.send_json_to({'type': 'get_presence', 'room_id': self.room.id})
+            await receive_type(typist, 'presence_state')
+            both_viewing = await database_sync_to_async(room_viewers)(self.room.id)
+
+            for _ in range(5):
+                await typist.send_json_to({'type': 'typing', 'room_id': self.room.id})
+            typing = await frames_of(watcher, 'typing', wait=0.5)
+
+            await typist.disconnect()
+            await watcher.disconnect()
+            left = await database_sync_to_async(room_viewers)(self.room.id)
+            return viewing, both_viewing, typing, left
+
+        viewing, both_viewing, typing, left = async_to_sync(run)()
+        self.assertEqual(viewing, {self.listener.u_id})
+        self.assertEqual(both_viewing, {self.listener.u_id, self.seeker.u_id})
+        # The first frame goes out at once, the other four in one trailing broadcast
+        self.assertEqual([f['user_ids'] for f in typing], [[self.seeker.u_id], [self.seeker.u_id]])
+        self.assertEqual(left, set())
+
+
+AT = '2026-01-02T03:04:05.678000+00:00'
+AT_MS = 1767323045678
+
+# Server frames that come back from a MessagePack round trip unchanged
+UNCHANGED_FRAMES = [
+    {"type": "message_delivered", "room_id": 1, "message_id": 5},
+    {"type": "message_failed", "room_id": 1, "message_id": 5, "error": "Could not save the message."},
+    {"type": "presence", "room_id": 1, "user_id": 7, "online": True},
+    {"type": "presence_state", "room_id": 1, "online": [7, 8], "typing": [7]},
+    {"type": "typing", "room_id": 1, "user_ids": [7], "ttl": 6},
+    {"type": "subscribed", "room_ids": [1, 2], "rejected": [3]},
+    {"type": "unsubscribed", "room_ids": [1]},
+    {"type": "error", "room_id": None, "error": "Subscribe to the room first."},
+    {"type": "unread_count", "count": 3},
+    {"type": "notification", "notification": {"id": 9, "title": "Hi", "message": "there", "created_at": AT}},
+]
+
+
+class WireProtocolTests(SimpleTestCase):
+    """MessagePack frames decode back to what was sent, in short keys and epoch times"""
+
+    def round_trip(self, protocol, frame):
+        data = protocol.encode(frame)
+        self.assertIsInstance(data, bytes)
+        return protocol.decode(bytes_data=data)
+
+    def test_frames_round_trip(self):
+        protocol = MsgpackProtocol()
+        for frame in UNCHANGED_FRAMES:
+            with self.subTest(frame['type']):
+                self.assertEqual(self.round_trip(protocol, frame), frame)
+
+        read = {
+            "type": "messages_read", "room_id": 1, "seq": 4, "message_ids": [2, 3],
+            "first_message_id": 2, "last_message_id": 3, "user_id": 7, "read_at": AT,
+        }
+        self.assertEqual(self.round_trip(protocol, read), {**read, "read_at": AT_MS})
+        single = {"type": "message_read", "room_id": 1, "message_id": 3, "user_id": 7, "read_at": AT}
+        self.assertEqual(self.round_trip(protocol, single), {**single, "read_at": AT_MS})
+
+        sync = {
+            "type": "sync", "room_id": 1, "since_seq": 2, "seq": 4, "has_more": False,
+            "messages": [{"id": 3, "seq": 3, "content": "hi", "timestamp": AT, "is_read": True}],
+            "reads": [{"user_id": 7, "last_read_message_id": 3, "seq": 4}],
+        }
+        self.assertEqual(self.round_trip(protocol, sync), {
+            **sync, "messages": [{"id": 3, "seq": 3, "message": "hi", "timestamp": AT_MS, "is_read": True}],
+        })
+
+    def test_author_names_are_sent_once_per_connection(self):
+        protocol = MsgpackProtocol()
+        message = {
+            "type": "new_message", "room_id": 1, "message": "hi", "author": "Seeker", "author_id": 7,
+            "author_full_name": "Seeker", "message_id": 5, "seq": 3, "timestamp": AT, "unread_count": None,
+        }
+        expected = {
+            "type": "new_message", "room_id": 1, "message": "hi", "author_id": 7,
+            "message_id": 5, "seq": 3, "timestamp": AT_MS, "unread_count": None,
+        }
+        self.assertEqual(self.round_trip(protocol, message), {**expected, "author_name": "Seeker"})
+        self.assertEqual(self.round_trip(protocol, {**message, "message_id": 6}), {**expected, "message_id": 6})
+        self.assertEqual(self.round_trip(MsgpackProtocol(), message)["author_name"], "Seeker")
+
+    def test_negotiation(self):
+        self.assertIsInstance(negotiate_protocol({'subprotocols': ['lissnify.msgpack']}), MsgpackProtocol)
+        self.assertIsInstance(negotiate_protocol({'query_string': b'token=x&protocol=msgpack'}), MsgpackProtocol)
+        self.assertIsInstance(negotiate_protocol({'subprotocols': ['other'], 'query_string': b'token=x'}), JsonProtocol)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class MsgpackSocketTests(ChatTransactionTestCase):
+    """Sockets switch to binary MessagePack frames when the handshake asks for them"""
+
+    def test_subprotocol_and_query_string(self):
+        user = User.objects.create(full_name='Seeker', email='seeker@example.com')
+
+        async def ask(path, subprotocols=None):
+            socket = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path, subprotocols=subprotocols)
+            socket.scope['user'] = user
+            connected, subprotocol = await socket.connect()
+            await socket.send_to(bytes_data=msgpack.packb({'t': 'get_unread_count'}))
+            reply = await socket.receive_from()
+            await socket.disconnect()
+            return connected, subprotocol, reply
+
+        async def run():
+            return (
+                await ask('/ws/multiplex/', subprotocols=['lissnify.msgpack']),
+                await ask('/ws/multiplex/?protocol=msgpack'),
+            )
+
+        offered, queried = async_to_sync(run)()
+        self.assertEqual(offered[:2], (True, 'lissnify.msgpack'))
+        self.assertEqual(queried[:2], (True, None))
+        for _, _, reply in (offered, queried):
+            self.assertEqual(msgpack.unpackb(reply), {'t': 'unread_count', 'c': 0})
@@ -0,0 +1,228 @@
+# chat_api/unread.py
+import threading
+import traceback
+
+from .cache import get_redis
+from .models import ChatRoom
+from .receipts import participant_unread_counts, with_unread_counts
+
+# A user's counters are dropped this long after their hash is created and
+# rebuilt from the database on the next read. Later writes don't extend the
+# expiry (EXPIRE NX, Redis 7+), so a count thrown off by an increment racing
+# a rebuild is wrong for at most this long.
+COUNTER_TTL = 60 * 60
+
+
+class MemoryUnreadCounter:
+    """In-process stand-in used when the channel layer isn't Redis (tests, local dev)"""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, user_id, room_ids):
+        with self._lock:
+            counts = self._counts.get(user_id, {})
+            return {room_id: counts.get(room_id) for room_id in room_ids}
+
+    def get_room(self, room_id, user_ids):
+        with self._lock:
+            return {user_id: self._counts.get(user_id, {}).get(room_id) for user_id in user_ids}
+
+    def set_many(self, user_id, counts):
+        with self._lock:
+            self._counts.setdefault(user_id, {}).update(counts)
+
+    def set_room(self, room_id, counts_by_user):
+        with self._lock:
+            for user_id, count in counts_by_user.items():
+                self._counts.setdefault(user_id, {})[room_id] = count
+
+    def increment(self, room_id, user_ids, amount=1):
+        with self._lock:
+            for user_id in user_ids:
+                counts = self._counts.get(user_id, {})
+                if room_id in counts:
+                    counts[room_id] += amount
+
+    def decrement(self, user_id, room_id, amount):
+        with self._lock:
+            counts = self._counts.get(user_id, {})
+            if room_id in counts:
+                counts[room_id] = max(counts[room_id] - amount, 0)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+class RedisUnreadCounter:
+    """One hash per user, `chat:unread:<user_id>`, mapping room id to unread count"""
+
+    # Only touch rooms that already have a counter; a miss is rebuilt from the DB
+    INCREMENT_SCRIPT = """
+        for i, key in ipairs(KEYS) do
+            if redis.call('HEXISTS', key, ARGV[1]) == 1 then
+                redis.call('HINCRBY', key, ARGV[1], ARGV[2])
+            end
+        end
+    """
+    DECREMENT_SCRIPT = """
+        if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+            if redis.call('HINCRBY', KEYS[1], ARGV[1], -tonumber(ARGV[2])) < 0 then
+                redis.call('HSET', KEYS[1], ARGV[1], 0)
+            end
+        end
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._increment = client.register_script(self.INCREMENT_SCRIPT)
+        self._decrement = client.register_script(self.DECREMENT_SCRIPT)
+
+    @staticmethod
+    def key(user_id):
+        return f"chat:unread:{user_id}"
+
+    def get_many(self, user_id, room_ids):
+        room_ids = list(room_ids)
+        if not room_ids:
+            return {}
+        values = self.client.hmget(self.key(user_id), room_ids)
+        return {
+            room_id: int(value) if value is not None else None
+            for room_id, value in zip(room_ids, values)
+        }
+
+    def get_room(self, room_id, user_ids):
+        user_ids = list(user_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hget(self.key(user_id), room_id)
+        return {
+            user_id: int(value) if value is not None else None
+            for user_id, value in zip(user_ids, pipe.execute())
+        }
+
+    def set_many(self, user_id, counts):
+        if not counts:
+            return
+        pipe = self.client.pipeline()
+        pipe.hset(self.key(user_id), mapping=counts)
+        pipe.expire(self.key(user_id), COUNTER_TTL, nx=True)
+        pipe.execute()
+
+    def set_room(self, room_id, counts_by_user):
+        if not counts_by_user:
+            return
+        pipe = self.client.pipeline()
+        for user_id, count in counts_by_user.items():
+            pipe.hset(self.key(user_id), room_id, count)
+            pipe.expire(self.key(user_id), COUNTER_TTL, nx=True)
+        pipe.execute()
+
+    def increment(self, room_id, user_ids, amount=1):
+        keys = [self.key(user_id) for user_id in user_ids]
+        if keys:
+            self._increment(keys=keys, args=[room_id, amount])
+
+    def decrement(self, user_id, room_id, amount):
+        self._decrement(keys=[self.key(user_id)], args=[room_id, amount])
+
+
+_counter = None
+
+
+def get_unread_counter():
+    global _counter
+    if _counter is None:
+        client = get_redis()
+        _counter = RedisUnreadCounter(client) if client is not None else MemoryUnreadCounter()
+    return _counter
+
+
+def get_unread_counts(user, room_ids):
+    """
+    {room_id: unread count} for `user`, answered from the counter service.
+    Rooms without a counter are rebuilt from the database in one query.
+    Lazily fanned-out rooms never get a counter (nothing increments it), so
+    they are always counted from the user's watermark.
+    """
+    room_ids = [int(room_id) for room_id in room_ids]
+    counter = get_unread_counter()
+    try:
+        counts = counter.get_many(user.u_id, room_ids)
+    except Exception:
+        traceback.print_exc()
+        counts = {room_id: None for room_id in room_ids}
+
+    missing = [room_id for room_id, count in counts.items() if count is None]
+    if missing:
+        rows = list(
+            with_unread_counts(ChatRoom.objects.filter(id__in=missing), user)
+            .values_list('id', 'unread_count', 'type')
+        )
+        rebuilt = {room_id: count for room_id, count, _ in rows}
+        try:
+            counter.set_many(user.u_id, {
+                room_id: count for room_id, count, room_type in rows
+                if room_type not in ChatRoom.LAZY_FAN_OUT_TYPES
+            })
+        except Exception:
+            traceback.print_exc()
+        counts.update({room_id: rebuilt.get(room_id, 0) for room_id in missing})
+    return counts
+
+
+def get_room_unread_counts(room_id, user_ids):
+    """
+    {user_id: unread count} in `room_id` for each of `user_ids`, read from the
+    counter service in one round trip. Misses are rebuilt with one grouped query.
+    """
+    room_id = int(room_id)
+    user_ids = list(user_ids)
+    counter = get_unread_counter()
+    try:
+        counts = counter.get_room(room_id, user_ids)
+    except Exception:
+        traceback.print_exc()
+        counts = {user_id: None for user_id in user_ids}
+
+    missing = [user_id for user_id, count in counts.items() if count is None]
+    if missing:
+        rebuilt = participant_unread_counts(room_id, missing)
+        rebuilt = {user_id: rebuilt.get(user_id, 0) for user_id in missing}
+        try:
+            counter.set_room(room_id, rebuilt)
+        except Exception:
+            traceback.print_exc()
+        counts.update(rebuilt)
+    return counts
+
+
+def count_new_message(room_id, recipient_ids):
+    """A message was sent in `room_id`; everyone in `recipient_ids` has one more unread"""
+    try:
+        get_unread_counter().increment(int(room_id), recipient_ids)
+    except Exception:
+        traceback.print_exc()
+
+
+def uncount_new_message(room_id, recipient_ids):
+    """Undo count_new_message for a message that was never stored"""
+    counter = get_unread_counter()
+    try:
+        for user_id in recipient_ids:
+            counter.decrement(user_id, int(room_id), 1)
+    except Exception:
+        traceback.print_exc()
+
+
+def count_messages_read(user, room_id, read_count):
+    """`user` has just read `read_count` messages in `room_id`"""
+    if not read_count:
+        return
+    try:
+        get_unread_counter().decrement(user.u_id, int(room_id), read_count)
+    except Exception:
+        traceback.print_exc()
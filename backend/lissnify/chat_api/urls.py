@@ -1,13 +1,17 @@
 # chat_api/urls.py
 
 from django.urls import path
-from .views import StartDirectChatView, CommunityChatListView, MessageListView, ChatRoomListView, MarkMessagesAsReadView, UnreadCountView
+from .views import StartDirectChatView, CommunityChatListView, MessageListView, ChatRoomListView, InboxView, MarkMessagesAsReadView, UnreadCountView, RoomPresenceView, RoomSyncView, OutboundQueueStatsView
 
 urlpatterns = [
     path('start-direct/', StartDirectChatView.as_view(), name='start-direct-chat'),
     path('community/', CommunityChatListView.as_view(), name='community-chat-list'),
     path('<int:room_id>/messages/', MessageListView.as_view(), name='message-list'),
     path('rooms/', ChatRoomListView.as_view(), name='chat-room-list'),
+    path('inbox/', InboxView.as_view(), name='chat-inbox'),
     path('<int:room_id>/mark-read/', MarkMessagesAsReadView.as_view(), name='mark-messages-read'),
     path('unread-counts/', UnreadCountView.as_view(), name='unread-counts'),
-]
\ No newline at end of file
+    path('<int:room_id>/presence/', RoomPresenceView.as_view(), name='room-presence'),
+    path('<int:room_id>/sync/', RoomSyncView.as_view(), name='room-sync'),
+    path('metrics/outbound/', OutboundQueueStatsView.as_view(), name='outbound-queue-stats'),
+]
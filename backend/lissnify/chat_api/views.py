@@ -1,14 +1,23 @@
+import traceback
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated
-from django.db.models import Count
-from django.utils import timezone
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 
 # Import models from both apps
-from .models import ChatRoom, Message, MessageReadStatus
+from .models import ChatRoom, Message
 from api.models import Seeker, Listener, Connections
 from .serializer import ChatRoomSerializer, MessageSerializer, MessageReadStatusSerializer
+from .membership import get_user_room_ids, is_room_member
+from .inbox import inbox_page
+from .outbound import outbound_stats
+from .presence import room_presence
+from .rooms import get_or_create_direct_room
+from .sync import room_changes
+from .receipts import mark_messages_read, messages_read_event, read_horizon
+from .unread import count_messages_read, get_unread_counts
 
 
 class StartDirectChatView(APIView):
@@ -35,14 +44,7 @@ class StartDirectChatView(APIView):
             return Response({"error": "An accepted connection is required to start a chat."}, status=status.HTTP_403_FORBIDDEN)
 
         # Find or create one-to-one room
-        room = ChatRoom.objects.annotate(num_participants=Count('participants')) \
-                               .filter(type='one_to_one', num_participants=2) \
-                               .filter(participants=seeker_profile.user) \
-                               .filter(participants=listener_profile.user).first()
-
-        if not room:
-            room = ChatRoom.objects.create(type='one_to_one')
-            room.participants.add(seeker_profile.user, listener_profile.user)
+        room, _ = get_or_create_direct_room(seeker_profile.user, listener_profile.user)
 
         serializer = ChatRoomSerializer(room, context={'request': request})
         return Response(serializer.data, status=status.HTTP_200_OK)
@@ -52,8 +54,9 @@ class CommunityChatListView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        community_rooms = ChatRoom.objects.filter(type='community')
-        serializer = ChatRoomSerializer(community_rooms, many=True, context={'request': request})
+        community_rooms = list(ChatRoom.objects.filter(type='community'))
+        unread_counts = get_unread_counts(request.user, [room.id for room in community_rooms])
+        serializer = ChatRoomSerializer(community_rooms, many=True, context={'request': request, 'unread_counts': unread_counts})
         return Response(serializer.data)
 
     def post(self, request):
@@ -68,18 +71,62 @@ class CommunityChatListView(APIView):
 
 
 class MessageListView(APIView):
+    """
+    Message history, newest page first, paginated by message id.
+
+    `?before=<id>` loads older messages and `?after=<id>` newer ones, `limit`
+    sets the page size. Results are in ascending id order. `next` is the
+    cursor for the older page (pass as `before`), `prev` the cursor for the
+    newer page (pass as `after`); either is null when there is nothing more.
+    """
     permission_classes = [IsAuthenticated]
+    default_limit = 50
+    max_limit = 200
 
     def get(self, request, room_id):
-        if not request.user.chat_rooms.filter(id=room_id).exists():
+        if not is_room_member(request.user, room_id):
             return Response({"error": "You are not a member of this chat room."}, status=status.HTTP_403_FORBIDDEN)
 
-        # Fetch ordered messages - DO NOT mark as read here
-        messages = Message.objects.filter(room__id=room_id).order_by("timestamp")
+        try:
+            before = self._cursor(request, 'before')
+            after = self._cursor(request, 'after')
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            return Response({"error": "'before', 'after' and 'limit' must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1 or (before is not None and after is not None):
+            return Response({"error": "Use a positive 'limit' and at most one of 'before' or 'after'."}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Fetch one extra row to know whether another page exists - DO NOT mark as read here
+        messages = Message.objects.filter(room_id=room_id).select_related('author')
+        if after is not None:
+            page = list(messages.filter(id__gt=after).order_by('id')[:limit + 1])
+            has_more = len(page) > limit
+            page = page[:limit]
+            next_cursor = page[0].id if page else None
+            prev_cursor = page[-1].id if has_more else None
+        else:
+            if before is not None:
+                messages = messages.filter(id__lt=before)
+            page = list(messages.order_by('-id')[:limit + 1])
+            has_more = len(page) > limit
+            page = page[:limit][::-1]
+            next_cursor = page[0].id if has_more else None
+            prev_cursor = page[-1].id if before is not None and page else None
+
+        # Just return the messages with their current read status, resolved
+        # for the whole page with one query
+        context = {'request': request, 'read_horizon': read_horizon(room_id, request.user)}
+        serializer = MessageSerializer(page, many=True, context=context)
+        return Response({
+            "results": serializer.data,
+            "next": next_cursor,
+            "prev": prev_cursor,
+        })
 
-        # Just return the messages with their current read status
-        serializer = MessageSerializer(messages, many=True, context={'request': request})
-        return Response(serializer.data)
+    @staticmethod
+    def _cursor(request, name):
+        value = request.query_params.get(name)
+        return int(value) if value not in (None, '') else None
 
 
 class ChatRoomListView(APIView):
@@ -87,45 +134,61 @@ class ChatRoomListView(APIView):
 
     def get(self, request):
         user = request.user
-        chat_rooms = ChatRoom.objects.filter(participants=user)
-        serializer = ChatRoomSerializer(chat_rooms, many=True, context={'request': request})
+        chat_rooms = list(ChatRoom.objects.filter(id__in=get_user_room_ids(user)))
+        unread_counts = get_unread_counts(user, [room.id for room in chat_rooms])
+        serializer = ChatRoomSerializer(chat_rooms, many=True, context={'request': request, 'unread_counts': unread_counts})
         return Response(serializer.data)
 
 
+class InboxView(APIView):
+    """
+    The user's rooms ordered by latest activity, with a preview of each
+    room's newest message and the unread count. Pass `next_cursor` back as
+    `?before=` for the next page.
+    """
+    permission_classes = [IsAuthenticated]
+    default_limit = 30
+    max_limit = 100
+
+    def get(self, request):
+        try:
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            return Response({"error": "'limit' must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1:
+            return Response({"error": "Use a positive 'limit'."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            page = inbox_page(request.user, request.query_params.get('before'), limit, context={'request': request})
+        except (ValueError, OverflowError):
+            return Response({"error": "Invalid 'before' cursor."}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(page, status=status.HTTP_200_OK)
+
+
 class MarkMessagesAsReadView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, room_id):
         """Mark all messages in a room as read for the current user"""
-        if not request.user.chat_rooms.filter(id=room_id).exists():
+        if not is_room_member(request.user, room_id):
             return Response({"error": "You are not a member of this chat room."}, status=status.HTTP_403_FORBIDDEN)
 
-        read_message_ids = MessageReadStatus.objects.filter(
-            user=request.user,
-            message__room_id=room_id
-        ).values_list('message_id', flat=True)
-
-        unread_messages = Message.objects.filter(
-            room_id=room_id
-        ).exclude(
-            id__in=read_message_ids
-        ).exclude(
-            author=request.user
-        )
-
-        read_statuses = []
-        for message in unread_messages:
-            read_status, created = MessageReadStatus.objects.get_or_create(
-                message=message,
-                user=request.user,
-                defaults={'read_at': timezone.now()}
-            )
-            if created:
-                read_statuses.append(read_status)
+        read_ids, read_at, seq = mark_messages_read(request.user, room_id)
+        count_messages_read(request.user, room_id, len(read_ids))
+
+        # Let connected sockets update their read ticks
+        if read_ids:
+            try:
+                async_to_sync(get_channel_layer().group_send)(
+                    f'chat_{room_id}',
+                    messages_read_event(room_id, request.user.u_id, read_ids, read_at, seq)
+                )
+            except Exception:
+                traceback.print_exc()
 
         return Response({
-            "message": f"Marked {len(read_statuses)} messages as read",
-            "read_count": len(read_statuses)
+            "message": f"Marked {len(read_ids)} messages as read",
+            "read_count": len(read_ids)
         }, status=status.HTTP_200_OK)
 
 
@@ -135,23 +198,50 @@ class UnreadCountView(APIView):
     def get(self, request):
         """Get unread message counts for all chat rooms of the current user"""
         user = request.user
-        chat_rooms = ChatRoom.objects.filter(participants=user)
+        unread_counts = get_unread_counts(user, get_user_room_ids(user))
 
-        unread_counts = {}
-        for room in chat_rooms:
-            read_message_ids = MessageReadStatus.objects.filter(
-                user=user,
-                message__room=room
-            ).values_list('message_id', flat=True)
+        return Response(unread_counts, status=status.HTTP_200_OK)
 
-            unread_count = Message.objects.filter(
-                room=room
-            ).exclude(
-                id__in=read_message_ids
-            ).exclude(
-                author=user
-            ).count()
 
-            unread_counts[room.id] = unread_count
+class RoomPresenceView(APIView):
+    permission_classes = [IsAuthenticated]
 
-        return Response(unread_counts, status=status.HTTP_200_OK)
+    def get(self, request, room_id):
+        """Participants of a room who are online and who is typing"""
+        if not is_room_member(request.user, room_id):
+            return Response({"error": "You are not a member of this chat room."}, status=status.HTTP_403_FORBIDDEN)
+
+        return Response(room_presence(room_id), status=status.HTTP_200_OK)
+
+
+class RoomSyncView(APIView):
+    """
+    Delta sync for reconnecting clients: `?since_seq=<seq>` returns the
+    messages and read watermarks that changed after that sequence number
+    plus the new cursor (see chat_api.sync.room_changes).
+    """
+    permission_classes = [IsAuthenticated]
+    default_limit = 200
+    max_limit = 500
+
+    def get(self, request, room_id):
+        if not is_room_member(request.user, room_id):
+            return Response({"error": "You are not a member of this chat room."}, status=status.HTTP_403_FORBIDDEN)
+
+        try:
+            since_seq = int(request.query_params.get('since_seq', 0))
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            return Response({"error": "'since_seq' and 'limit' must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+        if since_seq < 0 or limit < 1:
+            return Response({"error": "Use a non-negative 'since_seq' and a positive 'limit'."}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(room_changes(request.user, room_id, since_seq, limit), status=status.HTTP_200_OK)
+
+
+class OutboundQueueStatsView(APIView):
+    """Depth of this worker's per-connection socket send queues, plus merge and drop counters"""
+    permission_classes = [IsAuthenticated, IsAdminUser]
+
+    def get(self, request):
+        return Response(outbound_stats.snapshot(), status=status.HTTP_200_OK)
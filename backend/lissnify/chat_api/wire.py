@@ -0,0 +1,156 @@
+# chat_api/wire.py
+"""
+Wire formats for the chat and notification sockets.
+
+JSON text frames are the default. A client opts into MessagePack by offering
+the `lissnify.msgpack` subprotocol (or `?protocol=msgpack` where it can't set
+subprotocols); frames are then binary maps keyed by the short codes in
+FIELD_CODES, timestamps are epoch milliseconds and an author's name is sent
+only the first time that author appears on the connection.
+"""
+import json
+from datetime import datetime
+from urllib.parse import parse_qs
+
+import msgpack
+
+MSGPACK_SUBPROTOCOL = 'lissnify.msgpack'
+
+FIELD_CODES = {
+    'type': 't',
+    'room_id': 'r',
+    'room_ids': 'rs',
+    'message': 'm',
+    'content': 'm',
+    'message_id': 'i',
+    'message_ids': 'is',
+    'first_message_id': 'fi',
+    'last_message_id': 'li',
+    'last_read_message_id': 'lr',
+    'author_id': 'a',
+    'author_name': 'an',
+    'user_id': 'u',
+    'user_ids': 'us',
+    'seq': 's',
+    'since_seq': 'ss',
+    'timestamp': 'ts',
+    'read_at': 'ra',
+    'unread_count': 'uc',
+    'is_read': 'ir',
+    'online': 'o',
+    'typing': 'ty',
+    'messages': 'ms',
+    'reads': 'rd',
+    'has_more': 'hm',
+    'notification': 'n',
+    'count': 'c',
+    'error': 'e',
+}
+# Both 'message' and 'content' carry message text; decode to 'message'
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items() if name != 'content'}
+
+TIME_FIELDS = frozenset(('timestamp', 'read_at'))
+
+
+class JsonProtocol:
+    subprotocol = None
+
+    def encode(self, payload):
+        return json.dumps(payload)
+
+    def decode(self, text_data=None, bytes_data=None):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+
+class MsgpackProtocol:
+    """MessagePack frames with short keys and a per-connection author dictionary"""
+
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def __init__(self):
+        self.known_authors = set()
+
+    def encode(self, payload):
+        payload = dict(payload)
+        if payload.get('type') == 'new_message' and payload.get('author_id') is not None:
+            name = payload.pop('author_full_name', None)
+            payload.pop('author', None)
+            if payload['author_id'] not in self.known_authors:
+                self.known_authors.add(payload['author_id'])
+                payload['author_name'] = name
+        return msgpack.packb(self._compact(payload))
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            return json.loads(text_data)
+        return self._expand(msgpack.unpackb(bytes_data))
+
+    def _expand(self, value):
+        expanded = {}
+        for key, item in value.items():
+            kind = type(item)
+            if kind is dict:
+                item = self._expand(item)
+            elif kind is list:
+                item = [self._expand(entry) if type(entry) is dict else entry for entry in item]
+            expanded[FIELD_NAMES.get(key, key)] = item
+        return expanded
+
+    def _compact(self, value):
+        compact = {}
+        for key, item in value.items():
+            kind = type(item)
+            if kind is str:
+                if key in TIME_FIELDS:
+                    item = _epoch_ms(item)
+            elif kind is dict:
+                item = self._compact(item)
+            elif kind is list:
+                item = [self._compact(entry) if type(entry) is dict else entry for entry in item]
+            compact[FIELD_CODES.get(key, key)] = item
+        return compact
+
+
+def _epoch_ms(value):
+    try:
+        return int(datetime.fromisoformat(value).timestamp() * 1000)
+    except ValueError:
+        return value
+
+
+def negotiate_protocol(scope):
+    """Pick the wire protocol the client asked for in its handshake"""
+    query = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+    if MSGPACK_SUBPROTOCOL in scope.get('subprotocols', []) or query.get('protocol', [None])[0] == 'msgpack':
+        return MsgpackProtocol()
+    return JsonProtocol()
+
+
+class WireProtocolMixin:
+    """
+    Socket helpers that speak whichever protocol was negotiated. Accept with
+    `accept_connection`, send with `send_frame` and decode incoming frames
+    with `decode_frame`.
+    """
+
+    @property
+    def wire(self):
+        if not hasattr(self, '_wire'):
+            self._wire = negotiate_protocol(self.scope)
+        return self._wire
+
+    async def accept_connection(self):
+        subprotocol = self.wire.subprotocol
+        if subprotocol not in self.scope.get('subprotocols', []):
+            subprotocol = None
+        await self.accept(subprotocol)
+
+    async def send_frame(self, payload):
+        data = self.wire.encode(payload)
+        if isinstance(data, bytes):
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        return self.wire.decode(text_data, bytes_data)
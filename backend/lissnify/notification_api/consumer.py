@@ -1,10 +1,14 @@
-import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from api.models import User, Notification, NotificationSettings
+from api.models import User, NotificationSettings
+from api.notification_counts import get_notification_counts
+from api.notifications import mark_notifications_read
+from chat_api.presence import PresenceMixin
+from chat_api.outbound import OutboundQueueMixin
+from chat_api.wire import WireProtocolMixin
 
 
-class NotificationConsumer(AsyncWebsocketConsumer):
+class NotificationConsumer(OutboundQueueMixin, WireProtocolMixin, PresenceMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
         self.notification_group_name = f'notifications_{self.user.u_id}'
@@ -24,7 +28,8 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             self.channel_name
         )
 
-        await self.accept()
+        await self.accept_connection()
+        await self.presence_connected()
         # print(f"✅ NotificationConsumer connected for user {self.user.u_id}")
 
     async def disconnect(self, close_code):
@@ -33,22 +38,23 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             self.notification_group_name,
             self.channel_name
         )
+        await self.presence_disconnected()
+        self.stop_outbound()
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         """Handle incoming messages from client"""
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = self.decode_frame(text_data, bytes_data)
             message_type = text_data_json.get('type')
 
             if message_type == 'mark_read':
-                notification_id = text_data_json.get('notification_id')
-                await self.mark_notification_read(notification_id)
+                await self.handle_mark_read(text_data_json)
             elif message_type == 'get_unread_count':
                 count = await self.get_unread_count()
-                await self.send(text_data=json.dumps({
+                await self.send_frame({
                     'type': 'unread_count',
                     'count': count
-                }))
+                })
 
         except Exception as e:
             print(f"Error in notification consumer receive: {e}")
@@ -63,44 +69,78 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         if notification.get('type') == 'message_read':
             # Handle read receipt notification
             print(f"📖 Sending read receipt to user {self.user.u_id}")
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'message_read',
                 'message_ids': notification.get('message_ids', []),
                 'room_id': notification.get('room_id')
-            }))
+            })
             print(f"✅ Read receipt sent to user {self.user.u_id}")
         else:
             # Handle regular notification
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'notification',
                 'notification': notification
-            }))
+            })
         print(f"✅ Notification sent to WebSocket for user {self.user.u_id}")
 
+    async def notification_batch(self, event):
+        """
+        Notifications removed, created or updated in one commit, then the
+        recipient's new unread count. A folded coalesced notification arrives
+        as its old id removed and a new notification.
+        """
+        if event.get('removed_ids'):
+            await self.send_frame({
+                'type': 'notifications_removed',
+                'notification_ids': event['removed_ids'],
+            })
+        for notification in event.get('notifications', []):
+            await self.send_frame({
+                'type': 'notification',
+                'notification': notification
+            })
+        await self.send_frame({
+            'type': 'unread_count',
+            'count': event.get('unread_count', 0)
+        })
+
     async def unread_count_update(self, event):
         """Send unread count update to WebSocket"""
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'unread_count',
             'count': event['count']
-        }))
+        })
 
-    @database_sync_to_async
-    def mark_notification_read(self, notification_id):
-        """Mark a notification as read"""
+    async def handle_mark_read(self, payload):
+        """
+        Mark notifications read: one `notification_id`, or any of
+        `notification_ids`, `up_to_id`, `before` and `room_id` (see
+        api.notifications.mark_read_filter). Replies with the new unread
+        count once, however many were marked.
+        """
+        scope = dict(payload)
+        if scope.get('notification_id') is not None:
+            scope['notification_ids'] = [scope['notification_id']]
         try:
-            notification = Notification.objects.get(
-                id=notification_id, 
-                recipient=self.user
-            )
-            notification.is_read = True
-            notification.save()
-        except Notification.DoesNotExist:
-            pass
+            count = await self.mark_notifications_read(scope)
+        except (TypeError, ValueError) as e:
+            await self.send_frame({
+                'type': 'error',
+                'error': str(e)
+            })
+            return
+        await self.send_frame({
+            'type': 'unread_count',
+            'count': count
+        })
+
+    @database_sync_to_async
+    def mark_notifications_read(self, scope):
+        """Mark the scoped notifications read with one UPDATE; returns the new unread count"""
+        mark_notifications_read(self.user, scope)
+        return get_notification_counts(self.user)['unread']
 
     @database_sync_to_async
     def get_unread_count(self):
         """Get unread notification count for user"""
-        return Notification.objects.filter(
-            recipient=self.user, 
-            is_read=False
-        ).count()
+        return get_notification_counts(self.user)['unread']